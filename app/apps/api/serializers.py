@@ -14,6 +14,7 @@ from rest_framework import fields, serializers
 
 from api.fields import DisplayChoiceField
 from core.models import (
+    AlreadyProcessingException,
     AnnotationComponent,
     AnnotationTaxonomy,
     AnnotationType,
@@ -41,7 +42,14 @@ from core.models import (
     TextualWitness,
     Transcription,
 )
-from core.tasks import segment, segtrain, train, transcribe
+from core.tasks import (
+    segment,
+    segment_parts,
+    segtrain,
+    train,
+    transcribe,
+    transcribe_parts,
+)
 from imports.forms import FileImportError, clean_import_uri, clean_upload_file
 from imports.models import DocumentImport
 from imports.tasks import document_import
@@ -962,6 +970,20 @@ class ProcessSerializerMixin():
             created_by=self.user,
             document=self.document)
 
+    def check_chunks(self, parts):
+        # the parts still waiting in a chunked task would be processed twice
+        if DocumentPart.chunk_reports([part.pk for part in parts]).exists():
+            raise AlreadyProcessingException
+
+    def chunk_parts(self, parts):
+        """
+        Splits the parts pks in chunks to be processed by a single task each in bulk mode.
+        """
+        chunk_size = getattr(settings, 'BULK_PROCESS_CHUNK_SIZE', 20)
+        part_pks = [part.pk for part in parts]
+        for i in range(0, len(part_pks), chunk_size):
+            yield part_pks[i:i + chunk_size]
+
 
 class SegmentSerializer(ProcessSerializerMixin, serializers.Serializer):
     PROCESS_NAME = 'segmentation'
@@ -991,6 +1013,8 @@ class SegmentSerializer(ProcessSerializerMixin, serializers.Serializer):
     text_direction = serializers.ChoiceField(default='horizontal-lr',
                                              required=False,
                                              choices=TEXT_DIRECTION_CHOICES)
+    # process several parts in the same task, better throughput but coarser reporting
+    bulk = serializers.BooleanField(required=False, default=False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -998,9 +1022,10 @@ class SegmentSerializer(ProcessSerializerMixin, serializers.Serializer):
         self.fields['parts'].queryset = DocumentPart.objects.filter(document=self.document)
 
     def process(self):
-        super().process()
         model = self.validated_data.get('model')
         parts = self.validated_data.get('parts') or self.document.parts.all()
+        self.check_chunks(parts)
+        super().process()
 
         if model:
             ocr_model_document, created = OcrModelDocument.objects.get_or_create(
@@ -1012,6 +1037,20 @@ class SegmentSerializer(ProcessSerializerMixin, serializers.Serializer):
                 ocr_model_document.executed_on = timezone.now()
                 ocr_model_document.save()
 
+        if self.validated_data.get('bulk'):
+            for part_pks in self.chunk_parts(parts):
+                segment_parts.delay(
+                    part_pks=part_pks,
+                    document_pk=self.document.pk,
+                    user_pk=self.user.pk,
+                    task_group_pk=self.task_group.pk,
+                    model_pk=model.pk if model else None,  # None means default model
+                    steps=self.validated_data.get('steps'),
+                    text_direction=self.validated_data.get('text_direction'),
+                    override=self.validated_data.get('override'),
+                    report_label='Segment %d parts in %s' % (len(part_pks), self.document.name))
+            return
+
         for part in parts:
             part.chain_tasks(
                 segment.si(instance_pk=part.pk,
@@ -1193,6 +1232,8 @@ class TranscribeSerializer(ProcessSerializerMixin, serializers.Serializer):
         queryset=OcrModel.objects.all())
     transcription = serializers.PrimaryKeyRelatedField(
         queryset=Transcription.objects.all())
+    # process several parts in the same task, better throughput but coarser reporting
+    bulk = serializers.BooleanField(required=False, default=False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1204,10 +1245,11 @@ class TranscribeSerializer(ProcessSerializerMixin, serializers.Serializer):
             document=self.document)
 
     def process(self):
-        super().process()
         model = self.validated_data.get('model')
         transcription = self.validated_data.get('transcription')
         parts = self.validated_data.get('parts') or self.document.parts.all()
+        self.check_chunks(parts)
+        super().process()
 
         ocr_model_document, created = OcrModelDocument.objects.get_or_create(
             document=self.document,
@@ -1218,6 +1260,18 @@ class TranscribeSerializer(ProcessSerializerMixin, serializers.Serializer):
             ocr_model_document.executed_on = timezone.now()
             ocr_model_document.save()
 
+        if self.validated_data.get('bulk'):
+            for part_pks in self.chunk_parts(parts):
+                transcribe_parts.delay(
+                    part_pks=part_pks,
+                    document_pk=self.document.pk,
+                    task_group_pk=self.task_group.pk,
+                    transcription_pk=transcription.pk,
+                    model_pk=model.pk,
+                    user_pk=self.user.pk,
+                    report_label='Transcribe %d parts in %s' % (len(part_pks), self.document.name))
+            return
+
         for part in parts:
             part.chain_tasks(
                 transcribe.si(
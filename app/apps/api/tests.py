@@ -23,7 +23,7 @@ from core.models import (
     Transcription,
 )
 from core.tests.factory import CoreFactoryTestCase
-from reporting.models import TaskGroup
+from reporting.models import TaskGroup, TaskReport
 
 
 class UserViewSetTestCase(CoreFactoryTestCase):
@@ -243,6 +243,49 @@ class DocumentViewSetTestCase(CoreFactoryTestCase):
         })
         self.assertEqual(resp.status_code, 200)
 
+    @override_settings(BULK_PROCESS_CHUNK_SIZE=1)
+    @patch('api.serializers.segment_parts')
+    def test_segment_bulk(self, mock_segment_parts):
+        uri = reverse('api:document-segment', kwargs={'pk': self.doc.pk})
+        self.client.force_login(self.doc.owner)
+        resp = self.client.post(uri, data={
+            'parts': [self.part.pk, self.part2.pk],
+            'steps': 'both',
+            'bulk': True,
+        })
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(mock_segment_parts.delay.call_count, 2)
+        self.assertEqual(
+            [call.kwargs['part_pks'] for call in mock_segment_parts.delay.call_args_list],
+            [[self.part.pk], [self.part2.pk]])
+
+    @patch('api.serializers.segment_parts')
+    def test_segment_in_chunk(self, mock_segment_parts):
+        TaskReport.objects.create(user=self.doc.owner, label="chunk", document=self.doc,
+                                  method="core.tasks.transcribe_parts", part_pks=[self.part2.pk])
+        uri = reverse('api:document-segment', kwargs={'pk': self.doc.pk})
+        self.client.force_login(self.doc.owner)
+        resp = self.client.post(uri, data={
+            'parts': [self.part.pk, self.part2.pk],
+            'steps': 'both',
+            'bulk': True,
+        })
+        # part2 is still waiting in a chunked task
+        self.assertEqual(resp.status_code, 400)
+        mock_segment_parts.delay.assert_not_called()
+
+    def test_crop_parts(self):
+        uri = reverse('api:document-crop-parts', kwargs={'pk': self.doc.pk})
+        self.client.force_login(self.doc.owner)
+        resp = self.client.post(uri, data={
+            'parts': [self.part.pk],
+            'x1': 5, 'y1': 5, 'x2': 55, 'y2': 55,
+        }, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.line.refresh_from_db()
+        self.assertEqual(self.line.baseline, [[5, 20], [45, 20]])
+        self.assertEqual(self.line.mask, [[5, 5], [45, 5], [45, 45], [5, 45]])
+
     @unittest.skip
     def test_train_new_model(self):
         self.client.force_login(self.doc.owner)
@@ -787,7 +830,7 @@ class PartViewSetTestCase(CoreFactoryTestCase):
         self.client.force_login(self.user)
         uri = reverse('api:part-list',
                       kwargs={'document_pk': self.part.document.pk})
-        with self.assertNumQueries(22):
+        with self.assertNumQueries(23):
             img = self.factory.make_image_file()
             resp = self.client.post(uri, {
                 'image': SimpleUploadedFile(
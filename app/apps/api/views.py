@@ -93,7 +93,7 @@ from core.models import (
     TextualWitness,
     Transcription,
 )
-from core.tasks import recalculate_masks
+from core.tasks import crop_parts, recalculate_masks, rotate_parts
 from imports.forms import ExportForm, ImportForm
 from imports.parsers import ParseError
 from reporting.models import TaskGroup, TaskReport
@@ -490,6 +490,18 @@ class DocumentViewSet(ModelViewSet):
         else:
             return self.form_error(json.dumps(form.errors))
 
+    @action(detail=True, methods=['post'])
+    def stream_export(self, request, pk=None):
+        document = self.get_object()
+        form = ExportForm(document, request.user, request.data)
+        if not form.is_valid():
+            return self.form_error(json.dumps(form.errors))
+        if form.is_streamable():
+            return form.stream()
+        # too large to be rendered during the request
+        form.process()
+        return Response({'status': 'ok'}, status=status.HTTP_202_ACCEPTED)
+
     def get_process_response(self, request, serializer_class):
         document = self.get_object()
         serializer = serializer_class(document=document,
@@ -571,6 +583,54 @@ class DocumentViewSet(ModelViewSet):
 
         return Response({'status': 'success'}, status=status.HTTP_200_OK)
 
+    def get_parts_from_request(self, document, request):
+        if 'parts' in request.data:
+            pks = request.data.get('parts')
+            try:
+                iter(pks)
+            except TypeError:
+                return None
+            return document.parts.filter(pk__in=pks)
+        return document.parts.all()
+
+    @action(detail=True, methods=['post'])
+    def rotate_parts(self, request, pk=None):
+        document = self.get_object()
+        parts = self.get_parts_from_request(document, request)
+        if parts is None:
+            return Response({'error': "'parts' has to be a list."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        angle = request.data.get('angle')
+        if not angle:
+            return Response({'error': "Post an angle."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        rotate_parts.delay(part_pks=list(parts.values_list('pk', flat=True)),
+                           document_pk=document.pk,
+                           user_pk=request.user.pk,
+                           angle=angle)
+        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'])
+    def crop_parts(self, request, pk=None):
+        document = self.get_object()
+        parts = self.get_parts_from_request(document, request)
+        if parts is None:
+            return Response({'error': "'parts' has to be a list."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        corners = {key: request.data.get(key) for key in ('x1', 'y1', 'x2', 'y2')}
+        if None in corners.values():
+            return Response({'error': "Post corners as x1, y1 (top left) and x2, y2 (bottom right)."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        crop_parts.delay(part_pks=list(parts.values_list('pk', flat=True)),
+                         document_pk=document.pk,
+                         user_pk=request.user.pk,
+                         **corners)
+        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['patch'])
     def modify_ontology(self, request, pk=None):
         # special PATCH action to modify documents' ontology nested relationships
@@ -908,7 +968,7 @@ class PartViewSet(DocumentPermissionMixin, ModelViewSet):
             and y1 is not None
             and x2 is not None
                 and y2 is not None):
-            document_part.crop(x1, y1, x2, y2)
+            document_part.crop(x1, y1, x2, y2, user=self.request.user)
             return Response({'status': 'done'}, status=200)
         else:
             return Response({'error': "Post corners as x1, y1 (top left) and x2, y2 (bottom right)."},
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.passim_service import serve
+
+
+class Command(BaseCommand):
+    help = "Run the Passim alignment service, keeping a Spark session warm between alignments."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "socket",
+            nargs="?",
+            help="Path of the unix socket to listen on, defaults to settings.ALIGNMENT_SERVICE_SOCKET.",
+        )
+
+    def handle(self, *args, **options):
+        serve(options["socket"] or settings.ALIGNMENT_SERVICE_SOCKET)
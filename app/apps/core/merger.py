@@ -1,8 +1,7 @@
-import itertools
-import sys
-from math import sqrt
+import time
 from typing import Any, Dict, List, Tuple
 
+import numpy as np
 from django.db.models import prefetch_related_objects
 from shapely.geometry import LineString, Polygon
 
@@ -10,50 +9,114 @@ from api.serializers import DetailedLineSerializer
 from core.models import Block, Line
 
 __all__ = ['merge_lines', 'MAX_MERGE_SIZE']
-MAX_MERGE_SIZE = 8  # Maximum numbers of segments we can merge
+MAX_MERGE_SIZE = 50  # Maximum numbers of segments we can merge
+EXACT_ORDER_MAX_SIZE = 12  # Above this size the order is approximated
+ORDER_TIME_BUDGET = 0.5  # in seconds, for the local search of approximated orders
 
 
 def distance(a: Line, b: Line) -> float:
     pt1 = a.baseline[-1]
     pt2 = b.baseline[0]
-    dist = sqrt((pt2[1] - pt1[1])**2 + (pt2[0] - pt1[0])**2)
+    return float(np.hypot(pt2[0] - pt1[0], pt2[1] - pt1[1]))
 
-    return dist
 
-
-def build_dist_matrix(lines: List[Line]) -> List[List[float]]:
+def build_dist_matrix(lines: List[Line]) -> np.ndarray:
     # The distance matrix contains the distance between every two lines
     # mat[i][j] is the distance from the end of lines[i] to the beginning of lines[j]
-
-    dist_matrix: List[List[float]] = []
-    for i in range(len(lines)):
-        line_dist = [distance(lines[i], lines[j]) if i != j else sys.maxsize for j in range(len(lines))]
-        dist_matrix.append(line_dist)
+    ends = np.array([line.baseline[-1] for line in lines], dtype=float).reshape(-1, 2)
+    starts = np.array([line.baseline[0] for line in lines], dtype=float).reshape(-1, 2)
+    dist_matrix = np.hypot(starts[np.newaxis, :, 0] - ends[:, np.newaxis, 0],
+                           starts[np.newaxis, :, 1] - ends[:, np.newaxis, 1])
+    np.fill_diagonal(dist_matrix, np.inf)
     return dist_matrix
 
 
+def path_score(mat: np.ndarray, path: List[int]) -> float:
+    return float(mat[path[:-1], path[1:]].sum())
+
+
+def exact_order(mat: np.ndarray) -> List[int]:
+    # Held-Karp dynamic programming over subsets, adapted to an open path with any starting line.
+    # best[mask, j] is the length of the shortest path visiting the lines in mask and ending at j.
+    n = len(mat)
+    best = np.full((1 << n, n), np.inf)
+    parent = np.full((1 << n, n), -1, dtype=int)
+    nodes = np.arange(n)
+    bits = 1 << nodes
+    best[bits, nodes] = 0
+
+    for mask in range(1, 1 << n):
+        candidates = best[mask][:, np.newaxis] + mat
+        prev = candidates.argmin(axis=0)
+        scores = candidates[prev, nodes]
+        free = (mask & bits) == 0
+        targets = mask | bits[free]
+        improved = scores[free] < best[targets, nodes[free]]
+        best[targets[improved], nodes[free][improved]] = scores[free][improved]
+        parent[targets[improved], nodes[free][improved]] = prev[free][improved]
+
+    mask = (1 << n) - 1
+    last = int(best[mask].argmin())
+    path = []
+    while last != -1:
+        path.append(last)
+        mask, last = mask ^ (1 << last), int(parent[mask, last])
+    return path[::-1]
+
+
+def approximate_order(mat: np.ndarray, budget: float = ORDER_TIME_BUDGET) -> List[int]:
+    # Nearest neighbour paths from every starting line, the best one is then improved
+    # by moving chains of up to 3 lines elsewhere (or-opt), which keeps their direction
+    # since the matrix is not symmetric.
+    n = len(mat)
+    deadline = time.monotonic() + budget
+    best_path, best_score = None, np.inf
+    for start in range(n):
+        path, visited = [start], np.zeros(n, dtype=bool)
+        visited[start] = True
+        for _i in range(n - 1):
+            dists = np.where(visited, np.inf, mat[path[-1]])
+            nxt = int(dists.argmin())
+            path.append(nxt)
+            visited[nxt] = True
+        score = path_score(mat, path)
+        if score < best_score:
+            best_path, best_score = path, score
+
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for length in range(1, 4):
+            for i in range(n - length + 1):
+                chain = best_path[i:i + length]
+                rest = best_path[:i] + best_path[i + length:]
+                for j in range(len(rest) + 1):
+                    if j == i:
+                        continue
+                    path = rest[:j] + chain + rest[j:]
+                    score = path_score(mat, path)
+                    if score < best_score - 1e-9:
+                        best_path, best_score, improved = path, score, True
+                        break
+                if improved or time.monotonic() >= deadline:
+                    break
+            if improved or time.monotonic() >= deadline:
+                break
+    return best_path
+
+
 def find_order(lines: List[Line]) -> Tuple[int, ...]:
-    # Brute force our way through all the permutations. MAX_MERGE_SIZE makes sure this will not explode.
+    # Shortest path going through all the lines, exact for small merges and approximated above
+    # EXACT_ORDER_MAX_SIZE. MAX_MERGE_SIZE bounds the work done in both cases.
     if len(lines) > MAX_MERGE_SIZE:  # Test again, in case someone calls this function from the outside
         raise ValueError(f"Can't find order of more than {MAX_MERGE_SIZE} lines")
-
-    def perm_score(perm):
-        score = 0.0
-        for i in range(len(perm) - 1):
-            score += mat[perm[i]][perm[i + 1]]
-        return score
+    if len(lines) < 2:
+        return tuple(range(len(lines)))
 
     mat = build_dist_matrix(lines)
-
-    best_score = sys.maxsize
-    best_perm: Tuple[int, ...] = (0, )
-
-    for perm in itertools.permutations(list(range(len(lines)))):
-        score = perm_score(perm)
-        if score < best_score:
-            best_score, best_perm = score, perm
-
-    return best_perm
+    if len(lines) <= EXACT_ORDER_MAX_SIZE:
+        return tuple(exact_order(mat))
+    return tuple(approximate_order(mat))
 
 
 def merge_baseline(ordered_lines: List[Line]) -> List[Tuple[int, int]]:
@@ -0,0 +1,125 @@
+"""
+Worker resident cache of deserialized kraken models.
+
+Celery worker processes are long lived, loading the same (multi-MB) model for every
+part of a document is wasteful, so models are kept in a per-process LRU cache.
+Entries are keyed by the OcrModel pk, its current revision and the file mtime so that
+a model being retrained or reverted is never served stale.
+The cache budget is given in Mb by settings.KRAKEN_MODEL_CACHE_SIZE (0 disables it),
+the size of an entry is approximated by the size of the model file on disk.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from kraken.kraken import SEGMENTATION_DEFAULT_MODEL
+from kraken.lib import models as kraken_models
+from kraken.lib import vgsl
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+MODEL_KIND_SEGMENTATION = 'segmentation'
+MODEL_KIND_RECOGNITION = 'recognition'
+
+cache_hits = Counter('escriptorium_kraken_model_cache_hits_total',
+                     'Number of kraken models served from the worker cache.',
+                     ['kind'])
+cache_misses = Counter('escriptorium_kraken_model_cache_misses_total',
+                       'Number of kraken models loaded from disk.',
+                       ['kind'])
+cache_evictions = Counter('escriptorium_kraken_model_cache_evictions_total',
+                          'Number of kraken models evicted from the worker cache.',
+                          ['kind'])
+cache_size = Gauge('escriptorium_kraken_model_cache_bytes',
+                   'Approximate size of the kraken models held in the worker cache.',
+                   multiprocess_mode='livesum')
+
+
+class ModelCache:
+    def __init__(self, max_size):
+        self.max_size = max_size  # in bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, kind, loader, path):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                cache_hits.labels(kind=kind).inc()
+                return self.entries[key][0]
+
+        cache_misses.labels(kind=kind).inc()
+        model = loader(path)
+
+        entry_size = os.path.getsize(path)
+        if not self.max_size or entry_size > self.max_size:
+            # doesn't fit, don't bother evicting everything else for it
+            return model
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (model, entry_size, kind)
+                self.size += entry_size
+                cache_size.inc(entry_size)
+            self.evict()
+        return model
+
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            key, (model, entry_size, kind) = self.entries.popitem(last=False)
+            self.size -= entry_size
+            cache_size.dec(entry_size)
+            cache_evictions.labels(kind=kind).inc()
+            logger.debug('Evicted %s from the model cache.', key)
+
+    def clear(self):
+        with self.lock:
+            cache_size.dec(self.size)
+            self.entries.clear()
+            self.size = 0
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ModelCache(getattr(settings, 'KRAKEN_MODEL_CACHE_SIZE', 0) * 1024 * 1024)
+    return _cache
+
+
+def make_key(kind, model, path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    if model is None:
+        return (kind, None, None, path, mtime)
+    return (kind, model.pk, model.revision.hex, path, mtime)
+
+
+def load_segmentation_model(model=None):
+    """
+    Returns a vgsl.TorchVGSLModel for the given OcrModel or kraken's default segmenter.
+    """
+    path = model.file.path if model else SEGMENTATION_DEFAULT_MODEL
+    return get_cache().get(make_key(MODEL_KIND_SEGMENTATION, model, path),
+                           MODEL_KIND_SEGMENTATION,
+                           vgsl.TorchVGSLModel.load_model,
+                           path)
+
+
+def load_recognition_model(model):
+    """
+    Returns a TorchSeqRecognizer for the given OcrModel.
+    """
+    path = model.file.path
+    return get_cache().get(make_key(MODEL_KIND_RECOGNITION, model, path),
+                           MODEL_KIND_RECOGNITION,
+                           kraken_models.load_any,
+                           path)
@@ -1,5 +1,4 @@
 import functools
-import itertools
 import json
 import logging
 import math
@@ -24,9 +23,10 @@ from django.core.validators import FileExtensionValidator
 from django.db import models, transaction
 from django.db.models import Avg, JSONField, Prefetch, Q, Sum
 from django.db.models.functions import Coalesce, Length
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, pre_delete
 from django.dispatch import receiver
 from django.forms import ValidationError
+from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
@@ -34,18 +34,19 @@ from django_prometheus.models import ExportModelOperationsMixin
 from easy_thumbnails.files import get_thumbnailer
 from kraken import blla, rpred
 from kraken.containers import BaselineLine, Segmentation
-from kraken.kraken import SEGMENTATION_DEFAULT_MODEL
-from kraken.lib import models as kraken_models
-from kraken.lib import vgsl
+from kraken.lib.default_specs import SEGMENTATION_HYPER_PARAMS
 from kraken.lib.segmentation import calculate_polygonal_environment
 from ordered_model.models import OrderedModel, OrderedModelManager
 from PIL import Image
-from shapely import affinity
 from shapely.geometry import LineString, Polygon
+from shapely.prepared import prep
 from skimage.measure import approximate_polygon
 from sklearn import preprocessing
 from sklearn.cluster import DBSCAN
 
+from core.model_cache import load_recognition_model, load_segmentation_model
+from core.passim_service import AlignmentServiceUnavailable
+from core.passim_service import submit as submit_alignments
 from core.tasks import (
     align,
     convert,
@@ -56,15 +57,23 @@ from core.tasks import (
     train,
     transcribe,
 )
-from core.utils import ColorField
+from core.utils import ColorField, get_polygonization_features
 from core.validators import JSONSchemaValidator
-from reporting.models import TASK_FINAL_STATES, TaskReport
+from reporting.models import (
+    CHUNKED_TASKS,
+    TASK_FINAL_STATES,
+    TaskReport,
+    remove_report_part,
+)
+from reporting.tasks import CLIENT_PROCESS_NAME_MAP
 from users.consumers import send_event
-from users.models import User
+from users.models import User, update_disk_usage
 from versioning.models import Versioned
 
 logger = logging.getLogger(__name__)
 
+ALIGNMENT_READ_CHUNK_SIZE = 64 * 1024  # characters read at once from textual witnesses
+
 
 class ProcessFailureException(Exception):
     pass
@@ -632,26 +641,24 @@ class Document(ExportModelOperationsMixin("Document"), models.Model):
             return True
         return False
 
-    def build_alignment_input_dict(self, line_transcriptions, pk):
-        """Helper function for alignment to create a dict of lines for Passim input"""
-        line_ids = []
+    def write_alignment_input(self, file, line_transcriptions, pk):
+        """
+        Helper function for alignment to write a document of Passim input (one JSON line),
+        the text and the line offsets are streamed from the database in two passes.
+        """
+        # ref distinguishes OCR from witness
+        file.write('{"id": %s, "ref": 0, "text": "' % json.dumps(pk))
+        for content in line_transcriptions.values_list("content", flat=True).iterator():
+            file.write(json.dumps(content + "\n", ensure_ascii=False)[1:-1])
+        file.write('", "lineIDs": [')
         line_start = 0
-        text = ""
-        for lt in line_transcriptions:
-            # prep the line transcription to serialize to json
-            line_dict = {
-                "id": str(lt.line.pk),
-                "start": line_start,
-            }
-            text = text + lt.content + "\n"
-            line_ids.append(line_dict)
-            line_start = line_start + len(lt.content + "\n")
-        return {
-            "text": text,
-            "id": pk,
-            "lineIDs": line_ids,
-            "ref": 0,  # distinguishes OCR from witness
-        }
+        lengths = line_transcriptions.values_list("line", Length("content")).iterator()
+        for i, (line_pk, length) in enumerate(lengths):
+            if i:
+                file.write(", ")
+            json.dump({"id": str(line_pk), "start": line_start}, file)
+            line_start += length + 1
+        file.write("]}\n")
 
     def align(self, part_pks, transcription_pk, witness_pk, n_gram, max_offset, merge, full_doc, threshold, region_types, layer_name, beam_size, gap):
         """Use subprocess call to Passim to align transcription with textual witness"""
@@ -676,62 +683,57 @@ class Document(ExportModelOperationsMixin("Document"), models.Model):
         region_filters = Block.get_filters(block_types=region_types, filtering_lines=True)
         all_line_transcriptions = all_line_transcriptions.filter(region_filters)
 
-        # ensure lines are in order
+        # ensure lines are in order, the pk makes it deterministic since the input is read twice
         all_line_transcriptions = all_line_transcriptions.order_by(
-            "line__document_part", "line__document_part__order", "line__order"
+            "line__document_part", "line__document_part__order", "line__order", "line"
         )
 
-        # build the JSON input for passim
-        input_list = []
-        if not full_doc:
-            for part in parts:
-                line_transcriptions = all_line_transcriptions.filter(
-                    line__document_part=part,  # has lines related to this DocumentPart
-                ).order_by(
-                    "line__document_part", "line__document_part__order", "line__order"
-                )
-                input_list.append(self.build_alignment_input_dict(line_transcriptions, part.pk))
-        else:
-            input_list.append(self.build_alignment_input_dict(all_line_transcriptions, self.pk))
-
-        witness = TextualWitness.objects.get(pk=witness_pk)
-        with witness.file.open('r') as f:
-            txt = f.read()
-            witness_dict = {
-                "id": "witness",
-                "text": txt,
-                "ref": 1,  # distinguishes witness from OCR
-            }
-            input_list.append(witness_dict)
-
-        # save to a file
+        # write the JSONL input for passim
         infile = f"{outdir}.json"
         if not path.exists(outdir):
             makedirs(outdir)
+        witness = TextualWitness.objects.get(pk=witness_pk)
         with open(infile, "w", encoding="utf-8") as file:
-            for entry in input_list:  # dump to JSONL
-                json.dump(entry, file, ensure_ascii=False)
-                file.write("\n")
+            if not full_doc:
+                for part in parts:
+                    line_transcriptions = all_line_transcriptions.filter(
+                        line__document_part=part,  # has lines related to this DocumentPart
+                    )
+                    self.write_alignment_input(file, line_transcriptions, part.pk)
+            else:
+                self.write_alignment_input(file, all_line_transcriptions, self.pk)
+
+            with witness.file.open('r') as f:
+                # ref distinguishes witness from OCR
+                file.write('{"id": "witness", "ref": 1, "text": "')
+                for chunk in iter(lambda: f.read(ALIGNMENT_READ_CHUNK_SIZE), ""):
+                    file.write(json.dumps(chunk, ensure_ascii=False)[1:-1])
+                file.write('"}\n')
 
         # set beam size if present and > 0, otherwise set max-offset
         offset_beam = ("--beam", str(beam_size)) if (
             beam_size and int(beam_size) > 0
         ) else ("--max-offset", str(max_offset))
 
+        args = [
+            "--docwise",  # docwise mode (instead of linewise/pairwise)
+            "--floating-ngrams",  # allow n-gram matches anywhere, not just at word boundaries
+            "-n", str(n_gram),  # index n-grams
+            offset_beam[0], offset_beam[1],
+            "--gap", str(gap),
+            "--fields", "ref",
+            "--filterpairs", "ref = 1 AND ref2 = 0",
+            infile,
+            outdir,
+        ]
         try:
-            # call passim
-            subprocess.check_call([
-                "seriatim",  # Passim call
-                "--docwise",  # docwise mode (instead of linewise/pairwise)
-                "--floating-ngrams",  # allow n-gram matches anywhere, not just at word boundaries
-                "-n", str(n_gram),  # index n-grams
-                offset_beam[0], offset_beam[1],
-                "--gap", str(gap),
-                "--fields", "ref",
-                "--filterpairs", "ref = 1 AND ref2 = 0",
-                infile,
-                outdir,
-            ])
+            try:
+                # runs in the Spark session kept warm by the service
+                submit_alignments([args])
+            except AlignmentServiceUnavailable as e:
+                logger.info(e)
+                # call passim
+                subprocess.check_call(["seriatim", *args])
         except Exception as e:
             # cleanup in case of exception
             shutil.rmtree(outdir, ignore_errors=True)
@@ -739,32 +741,32 @@ class Document(ExportModelOperationsMixin("Document"), models.Model):
 
         # get the output json file(s)
         out_json = glob(f"{outdir}/out.json/*.json")
-        aligned_lines = []
+        # text of the first match above threshold, indexed by line pk
+        aligned_lines = {}
         if out_json:
             # handle multi-part output
             for json_part in out_json:
-                json_file = open(json_part, "r", encoding="utf-8")
-                for line in json_file.readlines():
-                    # iterate through lines in output with "wits" entries
-                    out_dict = json.loads(line)
-                    for line in out_dict.get("lines", []):
-                        for match in line.get("wits", []):
-                            match_text = match.get("text", "")
-                            n_matches = float(match.get("matches", 0))
-                            # if the % of matches is greater than or equal to threshold:
-                            if (
-                                n_matches / max(len(line.get("text", "")), len(match_text))
-                            ) >= threshold:
-                                # find the matching line id in line_ids based on character position
-                                match_line_id = next((
-                                    identified_line for identified_line in out_dict.get("lineIDs", [])
-                                    if identified_line["start"] == line["begin"]
-                                ), {})
-                                aligned_lines.append({
-                                    "id": match_line_id.get("id", -1),
-                                    "text": match_text,
-                                    "alg": match.get("alg", ""),
-                                })
+                with open(json_part, "r", encoding="utf-8") as json_file:
+                    for line in json_file:
+                        # iterate through lines in output with "wits" entries
+                        out_dict = json.loads(line)
+                        # index line ids by their character position
+                        line_ids = {
+                            identified_line["start"]: identified_line["id"]
+                            for identified_line in reversed(out_dict.get("lineIDs", []))
+                        }
+                        for line in out_dict.get("lines", []):
+                            for match in line.get("wits", []):
+                                match_text = match.get("text", "")
+                                n_matches = float(match.get("matches", 0))
+                                # if the % of matches is greater than or equal to threshold:
+                                if (
+                                    n_matches / max(len(line.get("text", "")), len(match_text))
+                                ) >= threshold:
+                                    # find the matching line id based on character position
+                                    match_line_id = int(line_ids.get(line["begin"], -1))
+                                    # use "alg" instead for forced alignment with dashes
+                                    aligned_lines.setdefault(match_line_id, match_text)
 
         # build the new transcription layer
         original_trans = Transcription.objects.get(pk=transcription_pk)
@@ -775,29 +777,43 @@ class Document(ExportModelOperationsMixin("Document"), models.Model):
             name=layer_name,
             document=self,
         )
-        for part in parts:
-            lines = part.lines.all()
-            for line in lines:
-                # find this line by "id" key in the output
-                matches = list(filter(lambda alg: int(alg["id"]) == line.pk, aligned_lines))
-
-                # build LineTranscription
-                # if this line is present in the aligned output, set its content to aligned text
-                if matches:
-                    lt, created = LineTranscription.objects.get_or_create(line=line, transcription=trans)
-                    # use matches[0]["alg"] instead for forced alignment with dashes
-                    # lt.content = matches[0]["alg"]
-                    lt.content = matches[0]["text"]
-                    lt.save()
-                # if "merge" is checked and this line is not present, get content from original transcription
-                elif merge:
-                    try:
-                        old_lt = LineTranscription.objects.get(line=line, transcription=original_trans)
-                        lt, created = LineTranscription.objects.get_or_create(line=line, transcription=trans)
-                        lt.content = old_lt.content
-                        lt.save()
-                    except LineTranscription.DoesNotExist:
-                        pass
+        line_pks = Line.objects.filter(document_part__in=parts).values_list("pk", flat=True)
+        existing = {
+            lt.line_id: lt
+            for lt in LineTranscription.objects.filter(transcription=trans, line__in=line_pks)
+        }
+        if merge:
+            original_contents = dict(
+                LineTranscription.objects.filter(
+                    transcription=original_trans, line__in=line_pks
+                ).values_list("line", "content")
+            )
+        else:
+            original_contents = {}
+
+        to_create, to_update = [], []
+        now = timezone.now()
+        for line_pk in line_pks:
+            # if this line is present in the aligned output, set its content to aligned text
+            # if "merge" is checked and this line is not present, get content from original transcription
+            if line_pk in aligned_lines:
+                content = aligned_lines[line_pk]
+            elif line_pk in original_contents:
+                content = original_contents[line_pk]
+            else:
+                continue
+
+            if line_pk in existing:
+                lt = existing[line_pk]
+                lt.content = content
+                lt.version_updated_at = now
+                to_update.append(lt)
+            else:
+                to_create.append(LineTranscription(line_id=line_pk, transcription=trans, content=content))
+
+        with transaction.atomic():
+            LineTranscription.objects.bulk_create(to_create, batch_size=1000)
+            LineTranscription.objects.bulk_update(to_update, ["content", "version_updated_at"], batch_size=1000)
 
         # clean up temp files
         if not getattr(settings, "KEEP_ALIGNMENT_TEMPFILES", None):
@@ -844,11 +860,66 @@ class Document(ExportModelOperationsMixin("Document"), models.Model):
         DocumentPart.objects.bulk_update(parts, ["workflow_state"])
 
 
+class DiskUsageMixin:
+    """
+    Keeps the disk usage of the owner of a stored file up to date, from the difference between
+    its size when the object was loaded and when it is saved or deleted.
+
+    disk_usage_fields holds the attribute names of the reference to the owner and of the file
+    size, and get_disk_usage_owner returns the queryset of the owner from that reference.
+    """
+    disk_usage_fields = None
+    _disk_usage = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._disk_usage = instance.get_disk_usage()
+        return instance
+
+    @classmethod
+    def get_disk_usage_owner(cls, reference):
+        raise NotImplementedError
+
+    def get_disk_usage(self):
+        # deferred fields are not loaded, the usage will be fixed by the next reconciliation
+        if any(field not in self.__dict__ for field in self.disk_usage_fields):
+            return None
+        reference, size = (self.__dict__[field] for field in self.disk_usage_fields)
+        return reference, size or 0
+
+    def update_disk_usage(self, usage):
+        deltas = {}
+        if self._disk_usage is not None:
+            reference, size = self._disk_usage
+            deltas[reference] = deltas.get(reference, 0) - size
+        if usage is not None:
+            reference, size = usage
+            deltas[reference] = deltas.get(reference, 0) + size
+        for reference, delta in deltas.items():
+            if reference is not None and delta:
+                update_disk_usage(self.get_disk_usage_owner(reference), delta)
+        self._disk_usage = usage
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        update_fields = kwargs.get("update_fields")
+        tracked = created or (
+            self._disk_usage is not None
+            and (update_fields is None or self.disk_usage_fields[1] in update_fields)
+        )
+        with transaction.atomic(savepoint=False):
+            instance = super().save(*args, **kwargs)
+            if tracked:
+                self.update_disk_usage(self.get_disk_usage())
+        return instance
+
+
 def document_images_path(instance, filename):
     return "documents/{0}/{1}".format(instance.document.pk, filename)
 
 
-class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
+class DocumentPart(DiskUsageMixin, ExportModelOperationsMixin("DocumentPart"), OrderedModel):
     """
     Represents a physical part of a larger document that is usually a page
     """
@@ -900,6 +971,8 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
     # this is denormalized because it's too heavy to calculate on the fly
     transcription_progress = models.PositiveSmallIntegerField(default=0)
 
+    disk_usage_fields = ("document_id", "image_file_size")
+
     class Meta(OrderedModel.Meta):
         pass
 
@@ -908,6 +981,10 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
             return self.name
         return "%s %d" % (self.typology or _("Element"), self.order + 1)
 
+    @classmethod
+    def get_disk_usage_owner(cls, document_pk):
+        return User.objects.filter(document=document_pk)
+
     @property
     def title(self):
         return str(self)
@@ -950,31 +1027,24 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         read_direction = read_direction or self.document.read_direction
         # imgbox = ((0, 0), (self.image.width, self.image.height))
 
-        origin_box = [
+        origin_box = np.array([
             self.image.width if read_direction == Document.READ_DIRECTION_RTL else 0,
             0,
-        ]
+        ], dtype=float)
 
-        def distance(x, y):
-            return math.sqrt(sum([(a - b) ** 2 for a, b in zip(x, y)]))
+        def distances(pts):
+            return np.sqrt(((pts - origin_box) ** 2).sum(axis=1))
 
         def poly_origin_pt(shape):
-            return min(shape, key=lambda pt: distance(pt, origin_box))
-
-        def baseline_origin_pt(baseline_, read_direction_):
-            return baseline_[
-                -1 if read_direction_ == Document.READ_DIRECTION_RTL else 0
-            ]
-
-        def line_origin_pt(line_, read_direction_):
-            return (
-                baseline_origin_pt(line_.baseline, read_direction_)
-                if line_.baseline
-                else poly_origin_pt(line_.mask)
-            )
+            pts = np.array(shape, dtype=float)
+            return pts[np.argmin(distances(pts))]
 
-        def line_block_pk(line_):
-            return line_.block.pk if line_.block else 0
+        def line_origin_pt(line_):
+            if line_.baseline:
+                return np.array(
+                    line_.baseline[-1 if read_direction == Document.READ_DIRECTION_RTL else 0],
+                    dtype=float)
+            return poly_origin_pt(line_.mask)
 
         def avg_line_height_column(y_origins_np, line_labels):
             """ "Return the min of the averages line heights of the columns"""
@@ -988,17 +1058,13 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                 line_heights_list.append(column_height)
             return min(line_heights_list)
 
-        def avg_line_height_block(lines_in_block, read_direction_):
+        def avg_line_height_block(origins_np):
             """Returns the average line height in the block taking into account devising number of columns
             based on x lines origins clustering. Key parameters of the algorithm:
             x_cluster: tolerance used to gather lines in a column
             line_height_decrease: scaling factor to avoid over gathering of lines"""
             x_cluster, line_height_decrease = 0.1, 0.8
 
-            origins_np = np.array(
-                list(map(lambda line: line_origin_pt(line, read_direction_), lines_in_block))
-            )
-
             # Devise the number of columns by performing DBSCAN clustering on x coordinate of line origins
             x_origins_np = origins_np[:, 0].reshape(-1, 1)
             scaler = preprocessing.MinMaxScaler()
@@ -1014,60 +1080,69 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                 * line_height_decrease
             )
 
-        def avg_lines_heights_dict(lines, read_direction_):
-            """Returns a dictionary with block.pk (or 0 if None) as keys and average lines height
-            in the block as values"""
-            sorted_by_block = sorted(lines, key=line_block_pk)
-            organized_by_block = itertools.groupby(sorted_by_block, key=line_block_pk)
-
-            avg_heights = {}
-            for block_pk, lines_in_block in organized_by_block:
-                avg_heights[block_pk] = avg_line_height_block(
-                    lines_in_block, read_direction_
-                )
-            return avg_heights
-
-        # fetch all lines and regroup them by block
-        qs = self.lines.select_related("block").all()
-        ls = list(qs)
+        # fetch all lines with their block
+        ls = list(self.lines.select_related("block").all())
         if len(ls) == 0:
             return
 
-        dict_avg_heights = avg_lines_heights_dict(ls, read_direction)
-
-        def cmp_lines(a, b):
-            # cache origin pts for efficiency
-            if not hasattr(a, "origin_pt"):
-                a.origin_pt = line_origin_pt(a, read_direction)
-            if not hasattr(b, "origin_pt"):
-                b.origin_pt = line_origin_pt(b, read_direction)
-
+        # precompute everything the comparison needs once, in arrays
+        nb_lines = len(ls)
+        origins = np.full((nb_lines, 2), np.nan)
+        for i, line in enumerate(ls):
             try:
-                if a.block != b.block:
-                    pt1 = poly_origin_pt(a.block.box) if a.block else a.origin_pt
-                    pt2 = poly_origin_pt(b.block.box) if b.block else b.origin_pt
+                origins[i] = line_origin_pt(line)
+            except (TypeError, ValueError, IndexError):  # invalid line
+                pass
+        valid = ~np.isnan(origins).any(axis=1)
+        line_dists = distances(origins)
+
+        block_keys = np.array([line.block_id or 0 for line in ls])
+        block_dists = line_dists.copy()
+        avg_heights = np.zeros(nb_lines)
+        for block_key in np.unique(block_keys):
+            in_block = block_keys == block_key
+            if block_key:
+                block = ls[int(np.argmax(in_block))].block
+                try:
+                    block_dists[in_block] = distances(poly_origin_pt(block.box).reshape(1, 2))[0]
+                except (TypeError, ValueError, IndexError):  # invalid block
+                    block_dists[in_block] = np.nan
+            block_origins = origins[in_block & valid]
+            if len(block_origins):
+                avg_heights[in_block] = avg_line_height_block(block_origins)
+
+        # python scalars are much faster than numpy ones to compare one by one
+        valid = valid.tolist()
+        line_dists = line_dists.tolist()
+        block_dists = block_dists.tolist()
+        block_keys = block_keys.tolist()
+        avg_heights = avg_heights.tolist()
+        ys = origins[:, 1].tolist()
 
-                    # when comparing blocks we can use the distance
-                    return distance(pt1, origin_box) - distance(pt2, origin_box)
-                else:
-                    pt1 = a.origin_pt
-                    pt2 = b.origin_pt
-
-                    # # 2 lines more or less on the same level
-                    avg_height = dict_avg_heights[line_block_pk(a)]
-                    if abs(pt1[1] - pt2[1]) < avg_height:
-                        return distance(pt1, origin_box) - distance(pt2, origin_box)
-                return pt1[1] - pt2[1]
-            except TypeError:  # invalid line
+        def cmp_lines(a, b):
+            if not (valid[a] and valid[b]):  # invalid line
                 return 0
+            if block_keys[a] != block_keys[b]:
+                # when comparing blocks we can use the distance
+                diff = block_dists[a] - block_dists[b]
+                return 0 if math.isnan(diff) else diff
+            # 2 lines more or less on the same level
+            if abs(ys[a] - ys[b]) < avg_heights[a]:
+                return line_dists[a] - line_dists[b]
+            return ys[a] - ys[b]
 
         # sort depending on the distance to the origin
-        ls.sort(key=functools.cmp_to_key(lambda a, b: cmp_lines(a, b)))
-        # one query / line, super gory
-        for order, line in enumerate(ls):
+        # Note: the comparison isn't transitive (tolerance on the line height),
+        # a plain key sort would give a different order on some pages.
+        ordered = sorted(range(nb_lines), key=functools.cmp_to_key(cmp_lines))
+
+        to_update = []
+        for order, i in enumerate(ordered):
+            line = ls[i]
             if line.order != order:
                 line.order = order
-                line.save()
+                to_update.append(line)
+        Line.objects.bulk_update(to_update, ['order'])
 
     def save(self, *args, **kwargs):
         new = self.pk is None
@@ -1098,9 +1173,11 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         if self.workflow_state == self.WORKFLOW_STATE_ALIGNED:
             w["align"] = "done"
 
-        for report in self.reports.filter(method__in=["core.tasks.segment", "core.tasks.transcribe", "core.tasks.align"]):
+        methods = ["core.tasks.segment", "core.tasks.transcribe", "core.tasks.align"] + CHUNKED_TASKS
+        for report in self.task_reports().filter(method__in=methods):
             # Only the last registered state for each group of tasks will be kept
             short_name = report.method.split(".")[-1]
+            short_name = CLIENT_PROCESS_NAME_MAP.get(short_name, short_name)
             if report.workflow_state == TaskReport.WORKFLOW_STATE_QUEUED:
                 w[short_name] = "pending"
             elif report.workflow_state == TaskReport.WORKFLOW_STATE_STARTED:
@@ -1117,10 +1194,29 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         except (KeyError, TypeError):
             return True
 
+    def task_reports(self):
+        """
+        Reports of the tasks processing this part, including the chunked tasks processing it
+        among other parts, which aren't tied to it but keep it in their part_pks until it is done.
+        """
+        return TaskReport.objects.filter(
+            Q(document_part=self) | Q(method__in=CHUNKED_TASKS, part_pks__contains=[self.pk])
+        )
+
+    @staticmethod
+    def chunk_reports(part_pks):
+        """
+        Unfinished reports of the chunked tasks still having to process any of part_pks.
+        """
+        return (TaskReport.objects
+                .filter(method__in=CHUNKED_TASKS, part_pks__overlap=list(part_pks))
+                .exclude(workflow_state__in=TASK_FINAL_STATES))
+
     def in_queue(self):
         try:
-            return (self.reports.filter(workflow_state=TaskReport.WORKFLOW_STATE_STARTED).count() == 0
-                    and self.reports.filter(workflow_state=TaskReport.WORKFLOW_STATE_QUEUED).count() > 0)
+            reports = self.task_reports()
+            return (reports.filter(workflow_state=TaskReport.WORKFLOW_STATE_STARTED).count() == 0
+                    and reports.filter(workflow_state=TaskReport.WORKFLOW_STATE_QUEUED).count() > 0)
         except (KeyError, TypeError):
             return False
 
@@ -1143,15 +1239,24 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                 if report.task_id:  # if not, it is still pending
                     report.cancel(username)
 
-                try:
-                    send_event('document', self.document.pk, 'part:workflow',
-                               {'id': self.id,
-                                'process': report.method.split('.')[-1],
-                                'status': 'error',
-                                'reason': _('Canceled.')})
-                except Exception as e:
-                    # don't crash on websocket error
-                    logger.exception(e)
+                self.send_canceled_event(report)
+
+        # chunked tasks processing this part among others only skip it, see core.tasks.is_canceled
+        for report in self.chunk_reports([self.pk]):
+            remove_report_part(TaskReport.objects.filter(pk=report.pk), self.pk)
+            self.send_canceled_event(report)
+
+    def send_canceled_event(self, report):
+        process = report.method.split('.')[-1]
+        try:
+            send_event('document', self.document.pk, 'part:workflow',
+                       {'id': self.id,
+                        'process': CLIENT_PROCESS_NAME_MAP.get(process, process),
+                        'status': 'error',
+                        'reason': _('Canceled.')})
+        except Exception as e:
+            # don't crash on websocket error
+            logger.exception(e)
 
     def recoverable(self):
         now = round(datetime.utcnow().timestamp())
@@ -1182,10 +1287,17 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                 self.WORKFLOW_STATE_TRANSCRIBING,
             ),
         }
+        # the chunked tasks processing this part among others
+        tasks_map["core.tasks.segment_parts"] = tasks_map["core.tasks.segment"]
+        tasks_map["core.tasks.transcribe_parts"] = tasks_map["core.tasks.transcribe"]
+        reports = self.task_reports()
         for task_name in tasks_map:
-            if self.workflow_state == tasks_map[task_name][0] and self.reports.filter(method=task_name).exists():
-                report = self.reports.filter(method=task_name).last()
+            if self.workflow_state == tasks_map[task_name][0] and reports.filter(method=task_name).exists():
+                report = reports.filter(method=task_name).last()
                 report.error("error")
+                if report.method in CHUNKED_TASKS:
+                    # a chunk still alive skips the part, see core.tasks.is_canceled
+                    remove_report_part(TaskReport.objects.filter(pk=report.pk), self.pk)
                 self.workflow_state = tasks_map[task_name][1]
 
         self.save()
@@ -1247,11 +1359,7 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         self.workflow_state = self.WORKFLOW_STATE_SEGMENTING
         self.save()
 
-        if model:
-            model_path = model.file.path
-        else:
-            model_path = SEGMENTATION_DEFAULT_MODEL
-        model_ = vgsl.TorchVGSLModel.load_model(model_path)
+        model_ = load_segmentation_model(model)
 
         # TODO: check model_type [None, 'recognition', 'segmentation']
         #    &  seg_type [None, 'bbox', 'baselines']
@@ -1275,23 +1383,44 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
             res = blla.segment(im, **options)
 
             if steps in ["regions", "both"]:
+                order = self.blocks.aggregate(max=models.Max("order"))["max"]
+                order = -1 if order is None else order
+                blocks = []
                 for region_type, regions in res.regions.items():
-                    try:
-                        typo, created = self.document.valid_block_types.get_or_create(
-                            name=region_type)
-                    except BlockType.MultipleObjectsReturned:
-                        # Note: this should not happen if the modelisation was alright
-                        # but for now we hack
-                        typo = self.document.valid_block_types.filter(name=region_type)[0]
+                    typo = self.get_or_create_typology(self.document.valid_block_types, BlockType, region_type)
                     for region in regions:
-                        Block.objects.create(
+                        order += 1
+                        block = Block(
                             document_part=self,
                             typology=typo,
                             box=region.boundary,
+                            order=order,
                         )
+                        block.make_external_id()
+                        blocks.append(block)
+                Block.objects.bulk_create(blocks)
 
-            regions = self.blocks.all()
             if steps in ["lines", "both"]:
+                regions = list(self.blocks.all())
+                # bounding boxes to quickly discard most regions, then an exact test on prepared polygons
+                bounds = np.array([[*map(min, *r.box), *map(max, *r.box)] for r in regions]).reshape(-1, 4)
+                polygons = [None] * len(regions)
+
+                def find_region(pt):
+                    candidates = np.nonzero((bounds[:, 0] <= pt.x) & (bounds[:, 2] >= pt.x)
+                                            & (bounds[:, 1] <= pt.y) & (bounds[:, 3] >= pt.y))[0]
+                    # candidates are sorted so the first matching region stays the first one
+                    for i in candidates:
+                        if polygons[i] is None:
+                            polygons[i] = prep(Polygon(regions[i].box))
+                        if polygons[i].contains(pt):
+                            return regions[i]
+                    return None
+
+                line_types = {}
+                order = self.lines.aggregate(max=models.Max("order"))["max"]
+                order = -1 if order is None else order
+                lines = []
                 for line in res.lines:
                     mask = line.boundary if line.boundary is not None else None
                     baseline = line.baseline
@@ -1299,23 +1428,22 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                     # calculate if the center of the line is contained in one of the region
                     # (pick the first one that matches)
                     center = LineString(baseline).interpolate(0.5, normalized=True)
-                    region = next(
-                        (r for r in regions if Polygon(r.box).contains(center)), None
-                    )
-                    try:
-                        typo, created = self.document.valid_line_types.get_or_create(
-                            name=line.tags.get("type"))
-                    except LineType.MultipleObjectsReturned:
-                        # Note: this should not happen if the modelisation was alright
-                        # but for now we hack
-                        typo = self.document.valid_line_types.filter(name=line.tags.get("type"))[0]
-                    Line.objects.create(
+                    type_name = line.tags.get("type")
+                    if type_name not in line_types:
+                        line_types[type_name] = self.get_or_create_typology(
+                            self.document.valid_line_types, LineType, type_name)
+                    order += 1
+                    line_ = Line(
                         document_part=self,
-                        typology=typo,
-                        block=region,
+                        typology=line_types[type_name],
+                        block=find_region(center),
                         baseline=baseline,
                         mask=mask,
+                        order=order,
                     )
+                    line_.make_external_id()
+                    lines.append(line_)
+                Line.objects.bulk_create(lines)
 
         im.close()
 
@@ -1323,10 +1451,18 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         self.save()
         self.recalculate_ordering(read_direction=read_direction)
 
+    def get_or_create_typology(self, valid_types, typology_class, name):
+        try:
+            typo, created = valid_types.get_or_create(name=name)
+        except typology_class.MultipleObjectsReturned:
+            # Note: this should not happen if the modelisation was alright
+            # but for now we hack
+            typo = valid_types.filter(name=name)[0]
+        return typo
+
     def transcribe(self, model, transcription, text_direction=None, user=None):
-        model_ = kraken_models.load_any(model.file.path)
+        model_ = load_recognition_model(model)
 
-        lines = self.lines.all()
         text_direction = (
             text_direction
             or (self.document.main_script and self.document.main_script.text_direction)
@@ -1340,22 +1476,28 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         else:
             reorder = 'L'
 
-        with Image.open(self.image.file.name) as im:
-            line_confidences = []
-            for line in lines:
-                if not line.baseline:
-                    # bypass lines without baseline
-                    continue
-                else:
-                    bll = BaselineLine(id='foo',
-                                       baseline=line.baseline,
-                                       boundary=line.mask)
-                    seg = Segmentation(type='baselines',
-                                       imagename='/dummy.png',
-                                       text_direction=text_direction,
-                                       script_detection=False,
-                                       lines=[bll])
+        # bypass lines without baseline
+        lines = [line for line in self.lines.all() if line.baseline]
+        line_confidences = []
+        to_create, to_update = [], []
+
+        if lines:
+            # one segmentation for the whole page, rpred yields a record per line in order
+            seg = Segmentation(type='baselines',
+                               imagename='/dummy.png',
+                               text_direction=text_direction,
+                               script_detection=False,
+                               lines=[BaselineLine(id=str(line.pk),
+                                                   baseline=line.baseline,
+                                                   boundary=line.mask)
+                                      for line in lines])
+            existing = {
+                lt.line_id: lt
+                for lt in LineTranscription.objects.filter(
+                    line__in=lines, transcription=transcription)
+            }
 
+            with Image.open(self.image.file.name) as im:
                 it = rpred.rpred(
                     model_,
                     im,
@@ -1363,17 +1505,17 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                     pad=16,
                     bidi_reordering=reorder
                 )
-                lt, created = LineTranscription.objects.get_or_create(
-                    line=line, transcription=transcription
-                )
-
-                if not created:
-                    lt.new_version()
-
-                lt.version_author = user and user.username or ''
-                lt.version_source = 'kraken:' + model.name
-
-                for pred in it:
+                for line, pred in zip(lines, it):
+                    lt = existing.get(line.pk)
+                    if lt is None:
+                        lt = LineTranscription(line=line, transcription=transcription)
+                        to_create.append(lt)
+                    else:
+                        lt.new_version()
+                        to_update.append(lt)
+
+                    lt.version_author = user and user.username or ''
+                    lt.version_source = 'kraken:' + model.name
                     lt.content = pred.prediction
                     lt.graphs = [{
                         'c': letter,
@@ -1381,12 +1523,18 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                         'confidence': float(confidence)
                     } for letter, poly, confidence in zip(
                         pred.prediction, pred.cuts, pred.confidences)]
-                if lt.graphs:
-                    line_avg_confidence = mean([graph['confidence'] for graph in lt.graphs if "confidence" in graph])
-                    lt.avg_confidence = line_avg_confidence
-                    line_confidences.append(line_avg_confidence)
+                    if lt.graphs:
+                        line_avg_confidence = mean([graph['confidence'] for graph in lt.graphs if "confidence" in graph])
+                        lt.avg_confidence = line_avg_confidence
+                        line_confidences.append(line_avg_confidence)
+
+            with transaction.atomic():
+                LineTranscription.objects.bulk_create(to_create)
+                LineTranscription.objects.bulk_update(to_update, [
+                    'content', 'graphs', 'avg_confidence',
+                    'revision', 'versions', 'version_author', 'version_source',
+                    'version_created_at', 'version_updated_at'])
 
-                lt.save()
         if line_confidences:
             # calculate and set all avg confidence values on models
             avg_line_confidence = mean(line_confidences)
@@ -1399,7 +1547,7 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         self.save()
 
         # overall avg recalculations; may use DB aggregation so run after self.save()
-        if line_confidences and not created:
+        if line_confidences and to_update:
             # if new line_confidences have been added to existing transcription,
             # then recalculate average confidence across the transcription
             lines_with_confidence = transcription.linetranscription_set.filter(avg_confidence__isnull=False)
@@ -1451,34 +1599,73 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         return tasks
 
     def make_masks(self, only=None):
-        im = Image.open(self.image).convert("L")
-        lines = list(self.lines.filter(baseline__isnull=False))
+        lines = [line for line in self.lines.filter(baseline__isnull=False).select_related("block")
+                 if line.baseline]
         to_calc = [line for line in lines if (only and line.pk in only) or (only is None)]
+        if not to_calc:
+            return to_calc
 
+        # the image features are the same for every line, compute them once (and cache them)
+        im_feats, scale = get_polygonization_features(self.image.path, height=1200)
+
+        if self.document.line_offset == Document.LINE_OFFSET_TOPLINE:
+            topline = True
+        elif self.document.line_offset == Document.LINE_OFFSET_CENTERLINE:
+            topline = None
+        else:
+            topline = False
+
+        # all the baselines in a single array to find the neighbours of a line in a few vectorized operations
+        baselines = [np.array(line.baseline, dtype=float) for line in lines]
+        points = np.concatenate(baselines)
+        starts = np.cumsum([0] + [len(bl) for bl in baselines[:-1]])
+        index = {line.pk: i for i, line in enumerate(lines)}
+        # the polygonizer casts its rays from the baseline offset by line_width (on the rescaled image),
+        # whose ends can stick out of the baseline's projection, plus the rounding of coordinates
+        margin = (SEGMENTATION_HYPER_PARAMS["line_width"] + 2) / scale.min()
+
+        def neighbours(i):
+            """
+            The polygonizer only considers lines crossing the area swept by rays perpendicular
+            to the baseline, ie lines whose projection on the baseline direction overlaps it.
+            """
+            diffs = np.diff(baselines[i].T)
+            lengths = np.linalg.norm(diffs, axis=0)
+            if not lengths.sum():
+                return [j for j in range(len(lines)) if j != i]
+            p_dir = np.mean(diffs * lengths / lengths.sum(), axis=1)
+            p_dir = p_dir / np.sqrt(np.sum(p_dir ** 2))
+            proj = points @ p_dir
+            mins = np.minimum.reduceat(proj, starts)
+            maxs = np.maximum.reduceat(proj, starts)
+            overlaps = (maxs >= mins[i] - margin) & (mins <= maxs[i] + margin)
+            return [j for j in np.nonzero(overlaps)[0] if j != i]
+
+        def rescale(polyline):
+            return (np.array(polyline) * scale).astype("int").tolist()
+
+        updated = []
         for line in to_calc:
-            context = [line_.baseline for line_ in lines if line_.pk != line.pk]
+            context = [lines[j].baseline for j in neighbours(index[line.pk])]
             if line.block:
-                poly = line.block.box
-                poly.append(line.block.box[0])  # close it
-                context.append(poly)
-
-            if self.document.line_offset == Document.LINE_OFFSET_TOPLINE:
-                topline = True
-            elif self.document.line_offset == Document.LINE_OFFSET_CENTERLINE:
-                topline = None
-            else:
-                topline = False
+                # close it
+                context.append(line.block.box + [line.block.box[0]])
 
             mask = calculate_polygonal_environment(
-                im, [line.baseline], suppl_obj=context, scale=(1200, 0), topline=topline
+                baselines=[rescale(line.baseline)],
+                suppl_obj=[rescale(obj) for obj in context],
+                im_feats=im_feats,
+                topline=topline,
             )
             if mask[0]:
-                if len(mask[0]) > 50:
-                    line.mask = approximate_polygon(np.array(mask[0]), 2).tolist()
+                mask = (np.array(mask[0]) / scale).astype("uint").tolist()
+                if len(mask) > 50:
+                    line.mask = approximate_polygon(np.array(mask), 2).tolist()
                 else:
-                    line.mask = mask[0]
-                line.save()
+                    line.mask = mask
+                updated.append(line)
 
+        Line.objects.bulk_update(updated, ["mask"])
         return to_calc
 
     def rotate(self, angle, user=None):
@@ -1531,41 +1718,21 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         )
         generate_part_thumbnails.delay(instance_pk=self.pk)
 
-        # rotate lines
-        for line in self.lines.all():
-            if line.baseline:
-                poly = affinity.rotate(LineString(line.baseline), angle, origin=center)
-                line.baseline = [
-                    (int(x - offset[0]), int(y - offset[1])) for x, y in poly.coords
-                ]
-            if line.mask:
-                poly = affinity.rotate(Polygon(line.mask), angle, origin=center)
-                line.mask = [
-                    (int(x - offset[0]), int(y - offset[1]))
-                    for x, y in poly.exterior.coords
-                ]
-            line.save()
-
-        # rotate regions
-        for region in self.blocks.all():
-            poly = affinity.rotate(Polygon(region.box), angle, origin=center)
-            region.box = [
-                (int(x - offset[0]), int(y - offset[1]))
-                for x, y in poly.exterior.coords
-            ]
-            region.save()
-
-        # rotate img annotations
-        for annotation in self.imageannotation_set.prefetch_related('taxonomy'):
-            poly = affinity.rotate(Polygon(annotation.coordinates), angle, origin=center)
-            annotation.coordinates = [
-                (int(x - offset[0]), int(y - offset[1]))
-                for x, y in poly.exterior.coords
-            ]
-
-            annotation.save()
-
-    def crop(self, x1, y1, x2, y2):
+        # rotate lines, regions and image annotations
+        # same matrix as shapely.affinity.rotate
+        theta = math.radians(angle)
+        cosp, sinp = math.cos(theta), math.sin(theta)
+        if abs(cosp) < 2.5e-16:
+            cosp = 0.0
+        if abs(sinp) < 2.5e-16:
+            sinp = 0.0
+        x0, y0 = center
+        matrix = np.array([[cosp, sinp], [-sinp, cosp]])
+        translation = np.array([x0 - x0 * cosp + y0 * sinp, y0 - x0 * sinp - y0 * cosp])
+        # polygons used to go through shapely which closed their ring
+        self.transform_shapes(lambda points: points @ matrix + translation - offset, close_polygons=True)
+
+    def crop(self, x1, y1, x2, y2, user=None):
         """
         Crops the image outside the rectangle defined
         by top left (x1, y1) and bottom right (x2, y2) points.
@@ -1576,16 +1743,48 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
             cim.save(self.image.file.name)
             cim.close()
 
-        for line in self.lines.all():
+        self.transform_shapes(lambda points: points - (x1, y1), with_annotations=False)
+
+    def transform_shapes(self, transform, close_polygons=False, with_annotations=True):
+        """
+        Applies transform, a function taking and returning a (n, 2) array, to the coordinates
+        of all lines, regions and (unless with_annotations is False) image annotations of the part
+        at once then saves them in bulk in a single transaction.
+        """
+        lines = list(self.lines.all())
+        blocks = list(self.blocks.all())
+        annotations = list(self.imageannotation_set.all()) if with_annotations else []
+
+        shapes = []  # (instance, field name, coordinates)
+        for line in lines:
             if line.baseline:
-                line.baseline = [(int(x - x1), int(y - y1)) for x, y in line.baseline]
+                shapes.append((line, "baseline", line.baseline))
             if line.mask:
-                line.mask = [(int(x - x1), int(y - y1)) for x, y in line.mask]
-            line.save()
+                shapes.append((line, "mask", line.mask))
+        for block in blocks:
+            shapes.append((block, "box", block.box))
+        for annotation in annotations:
+            shapes.append((annotation, "coordinates", annotation.coordinates))
+        if not shapes:
+            return
 
-        for region in self.blocks.all():
-            region.box = [(int(x - x1), int(y - y1)) for x, y in region.box]
-            region.save()
+        if close_polygons:
+            shapes = [
+                (obj, field, list(coords) + [coords[0]]
+                 if field != "baseline" and list(coords[0]) != list(coords[-1]) else coords)
+                for obj, field, coords in shapes
+            ]
+
+        points = np.array([pt for obj, field, coords in shapes for pt in coords], dtype=float)
+        points = transform(points).astype(int)
+        splits = np.cumsum([len(coords) for obj, field, coords in shapes])[:-1]
+        for (obj, field, old_coords), coords in zip(shapes, np.split(points, splits)):
+            setattr(obj, field, coords.tolist())
+
+        with transaction.atomic():
+            Line.objects.bulk_update(lines, ["baseline", "mask"])
+            Block.objects.bulk_update(blocks, ["box"])
+            ImageAnnotation.objects.bulk_update(annotations, ["coordinates"])
 
     def enforce_line_order(self):
         # django-ordered-model doesn't care about unicity and linearity...
@@ -1898,7 +2097,7 @@ def models_path(instance, filename):
     return "models/%s/%s%s" % (hash, slugify(fn), ext)
 
 
-class OcrModel(ExportModelOperationsMixin("OcrModel"), Versioned, models.Model):
+class OcrModel(DiskUsageMixin, ExportModelOperationsMixin("OcrModel"), Versioned, models.Model):
     name = models.CharField(max_length=256)
     file = models.FileField(
         upload_to=models_path,
@@ -1939,6 +2138,8 @@ class OcrModel(ExportModelOperationsMixin("OcrModel"), Versioned, models.Model):
 
     parent = models.ForeignKey("self", blank=True, null=True, on_delete=models.SET_NULL)
 
+    disk_usage_fields = ("owner_id", "file_size")
+
     class Meta:
         ordering = ["-version_updated_at"]
         permissions = (("can_train", "Can train models"),)
@@ -1946,6 +2147,10 @@ class OcrModel(ExportModelOperationsMixin("OcrModel"), Versioned, models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def get_disk_usage_owner(cls, owner_pk):
+        return User.objects.filter(pk=owner_pk)
+
     @cached_property
     def accuracy_percent(self):
         return self.training_accuracy * 100
@@ -2110,3 +2315,25 @@ class TextualWitness(models.Model):
 def delete_thumbnails(sender, instance, using, **kwargs):
     thumbnailer = get_thumbnailer(instance.image)
     thumbnailer.delete()
+
+
+@receiver(pre_delete, sender=Document, dispatch_uid="document_disk_usage_delete_signal")
+def release_document_disk_usage(sender, instance, using, **kwargs):
+    # the parts deleted along with their document are released in a single query
+    # instead of one per part, they are still there when pre_delete is sent
+    size = instance.parts.aggregate(size=Sum("image_file_size"))["size"]
+    if size:
+        update_disk_usage(DocumentPart.get_disk_usage_owner(instance.pk), -size)
+
+
+@receiver(post_delete, sender=DocumentPart, dispatch_uid="part_disk_usage_delete_signal")
+@receiver(post_delete, sender=OcrModel, dispatch_uid="model_disk_usage_delete_signal")
+def release_disk_usage(sender, instance, using, origin=None, **kwargs):
+    if sender is DocumentPart and origin is not None:
+        origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+        if origin_model is not DocumentPart:
+            # cascaded from the deletion of its document, already released
+            return
+    if instance._disk_usage is None:
+        instance._disk_usage = instance.get_disk_usage()
+    instance.update_disk_usage(None)
@@ -0,0 +1,145 @@
+"""
+Long-lived Passim alignment service.
+
+Running seriatim from the command line starts a JVM and a Spark session for every alignment,
+which dominates the time spent on short ones. The service starts the Spark session once and
+runs the seriatim jobs it receives on a unix socket in that session, one after the other and
+whatever document they come from. Each request holds a batch of jobs, the command line arguments
+of seriatim, and its output files are the ones of the command line.
+
+It is enabled by settings.ALIGNMENT_SERVICE_SOCKET, and started by the celery workers consuming
+the jvm queue (or with the alignment_service management command).
+"""
+import json
+import logging
+import os
+import runpy
+import socket
+import socketserver
+import subprocess
+import sys
+from contextlib import contextmanager
+
+from celery.signals import worker_ready, worker_shutdown
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_service = None
+
+
+class AlignmentServiceError(Exception):
+    pass
+
+
+class AlignmentServiceUnavailable(AlignmentServiceError):
+    pass
+
+
+def run_seriatim(args):
+    """
+    Runs seriatim with the command line arguments args in this process, its Spark session
+    being the one already started.
+    """
+    argv = sys.argv
+    sys.argv = ["seriatim", *args]
+    try:
+        runpy.run_module(settings.PASSIM_SERIATIM_MODULE, run_name="__main__", alter_sys=True)
+    except SystemExit as e:
+        if e.code:
+            raise AlignmentServiceError(f"seriatim exited with status {e.code}")
+    finally:
+        sys.argv = argv
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        results = []
+        for args in request["jobs"]:
+            try:
+                self.server.run_job(args)
+            except Exception as e:
+                logger.exception(e)
+                results.append({"status": "error", "error": str(e)})
+            else:
+                results.append({"status": "ok"})
+        self.wfile.write(json.dumps({"results": results}).encode() + b"\n")
+
+
+def make_server(socket_path, run_job=run_seriatim):
+    if os.path.exists(socket_path):
+        # left behind by a previous service
+        os.unlink(socket_path)
+    server = socketserver.UnixStreamServer(socket_path, JobHandler)
+    server.run_job = run_job
+    return server
+
+
+@contextmanager
+def kept_session(session_class):
+    """
+    seriatim stops its Spark session at the end of a run, keep it for the next job.
+    """
+    stop = session_class.stop
+    session_class.stop = lambda self: None
+    try:
+        yield
+    finally:
+        session_class.stop = stop
+
+
+def serve(socket_path):
+    from pyspark.sql import SparkSession
+
+    # seriatim's getOrCreate returns this session from now on
+    spark = SparkSession.builder.appName("escriptorium-alignment").getOrCreate()
+    with kept_session(SparkSession), make_server(socket_path) as server:
+        logger.info("Alignment service listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            spark.stop()
+
+
+def submit(jobs, socket_path=None):
+    """
+    Runs a batch of seriatim jobs, each one a list of command line arguments, on the service.
+    Raises AlignmentServiceUnavailable if it can't be reached and AlignmentServiceError if a job failed.
+    """
+    socket_path = socket_path or settings.ALIGNMENT_SERVICE_SOCKET
+    if not socket_path:
+        raise AlignmentServiceUnavailable("The alignment service is disabled.")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            raise AlignmentServiceUnavailable(f"The alignment service can't be reached: {e}")
+        sock.sendall(json.dumps({"jobs": jobs}).encode() + b"\n")
+        with sock.makefile("rb") as fh:
+            response = fh.readline()
+
+    if not response:
+        raise AlignmentServiceError("The alignment service closed the connection before the end of the jobs.")
+    errors = [result["error"] for result in json.loads(response)["results"] if result["status"] != "ok"]
+    if errors:
+        raise AlignmentServiceError("; ".join(errors))
+
+
+@worker_ready.connect
+def start_service(sender, **kwargs):
+    # the worker's children are recycled after every task, the service belongs to the main process
+    global _service
+    if not settings.ALIGNMENT_SERVICE_SOCKET or "jvm" not in sender.app.amqp.queues.consume_from:
+        return
+    _service = subprocess.Popen([
+        sys.executable, os.path.join(settings.BASE_DIR, "manage.py"),
+        "alignment_service", settings.ALIGNMENT_SERVICE_SOCKET,
+    ])
+
+
+@worker_shutdown.connect
+def stop_service(**kwargs):
+    if _service is not None:
+        _service.terminate()
+        _service.wait()
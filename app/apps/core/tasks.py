@@ -2,10 +2,7 @@ import logging
 import os
 import os.path
 import shutil
-import tempfile
-from collections import defaultdict
 from itertools import groupby
-from pathlib import Path
 from typing import List
 
 import numpy as np
@@ -13,14 +10,14 @@ from celery import shared_task
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import F, Q
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.html import strip_tags
 from django.utils.text import slugify
 from django.utils.translation import gettext as _
 from easy_thumbnails.files import get_thumbnailer
 from kraken.containers import BaselineLine, Region, Segmentation
 from kraken.kraken import SEGMENTATION_DEFAULT_MODEL
-from kraken.lib.arrow_dataset import build_binary_dataset
 from kraken.lib.default_specs import RECOGNITION_HYPER_PARAMS, SEGMENTATION_HYPER_PARAMS
 from kraken.lib.train import KrakenTrainer, RecognitionModel, SegmentationModel
 from lightning.pytorch.callbacks import Callback
@@ -32,6 +29,8 @@ from core.search import (
     search_content_psql_regex,
     search_content_psql_word,
 )
+from core.training_data import recognition_dataset
+from reporting.models import remove_report_part
 
 # DO NOT REMOVE THIS IMPORT, it will break celery tasks located in this file
 from reporting.tasks import create_task_reporting  # noqa F401
@@ -104,27 +103,6 @@ def lossless_compression(instance_pk=None, user_pk=None, **kwargs):
     part.compress()
 
 
-def make_recognition_segmentation(lines) -> List[Segmentation]:
-    """
-    Groups training data by image for optimized compilation and returns a list
-    of Segmentation objects.
-    """
-    lines_by_img = defaultdict(list)
-    for lt in lines:
-        lines_by_img[lt['image']].append(BaselineLine(id='foo',
-                                                      baseline=lt['baseline'],
-                                                      boundary=lt['mask'],
-                                                      text=lt['content']))
-    segs = []
-    for img, lines in lines_by_img.items():
-        segs.append(Segmentation(text_direction='horizontal-lr',
-                                 imagename=os.path.join(settings.MEDIA_ROOT, img),
-                                 type='baselines',
-                                 lines=lines,
-                                 script_detection=False))
-    return segs
-
-
 def make_segmentation_training_data(parts) -> List[Segmentation]:
     """
     Converts eScriptorium data model to list of Segmentation objects.
@@ -405,6 +383,119 @@ def segment(instance_pk=None, user_pk=None, model_pk=None,
                         id="segmentation-success", level='success')
 
 
+def is_canceled(task_id, part_pk):
+    """
+    Chunked tasks check their own report before each part, to stop early when it was canceled
+    or to skip a part that was canceled on its own (and removed from the report's part_pks).
+    """
+    TaskReport = apps.get_model('reporting', 'TaskReport')
+    report = TaskReport.objects.filter(task_id=task_id).values_list('workflow_state', 'part_pks').first()
+    if report is None:
+        # the reporting is disabled for this task
+        return False
+    workflow_state, part_pks = report
+    return workflow_state == TaskReport.WORKFLOW_STATE_CANCELED or part_pk not in part_pks
+
+
+def release_part(task_id, part_pk):
+    """
+    Marks a part of a chunked task as processed, it can't be canceled anymore.
+    """
+    TaskReport = apps.get_model('reporting', 'TaskReport')
+    remove_report_part(TaskReport.objects.filter(task_id=task_id), part_pk)
+
+
+def send_part_workflow(part, process, status, task_id=None):
+    try:
+        send_event('document', part.document_id, "part:workflow", {
+            "id": part.pk,
+            "process": process,
+            "status": status,
+            "task_id": task_id,
+            "data": {}
+        })
+    except Exception as e:
+        # don't crash on websocket error
+        logger.exception(e)
+
+
+def retry_chunk(task, part_pks, outcome, exc):
+    """
+    Retries a chunked task later on the parts it didn't process yet, the processed ones were
+    already released from its report and would be mistaken for canceled ones.
+    """
+    processed = [pk for pks in outcome.values() for pk in pks]
+    left = [pk for pk in part_pks if pk not in processed]
+    raise task.retry(exc=exc, kwargs={**task.request.kwargs, 'part_pks': left})
+
+
+@shared_task(bind=True, default_retry_delay=5 * 60)
+def segment_parts(task, part_pks=[], document_pk=None, user_pk=None, model_pk=None,
+                  steps=None, text_direction=None, override=None,
+                  task_group_pk=None, **kwargs):
+    """
+    Segments a chunk of parts of the same document in a single worker invocation.
+    """
+    DocumentPart = apps.get_model('core', 'DocumentPart')
+
+    try:
+        OcrModel = apps.get_model('core', 'OcrModel')
+        model = OcrModel.objects.get(pk=model_pk)
+    except OcrModel.DoesNotExist:
+        model = None
+
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+        except User.DoesNotExist:
+            user = None
+    else:
+        user = None
+
+    parts = DocumentPart.objects.filter(pk__in=part_pks).order_by('order')
+    outcome = {'done': [], 'error': [], 'canceled': []}
+    for part in parts:
+        if is_canceled(task.request.id, part.pk):
+            outcome['canceled'].append(part.pk)
+            send_part_workflow(part, 'segment', 'canceled', task_id=task.request.id)
+            continue
+
+        # If quotas are enforced, assert that the user still has free CPU minutes
+        if user and not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() is not None:
+            assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+
+        send_part_workflow(part, 'segment', 'ongoing', task_id=task.request.id)
+        try:
+            if steps == 'masks':
+                part.make_masks()
+            else:
+                part.segment(steps=steps,
+                             override=override,
+                             text_direction=text_direction,
+                             model=model)
+        except MemoryError as e:
+            retry_chunk(task, part_pks, outcome, e)
+        except Exception as e:
+            outcome['error'].append(part.pk)
+            part.workflow_state = part.WORKFLOW_STATE_CONVERTED
+            part.save()
+            logger.exception(e)
+            send_part_workflow(part, 'segment', 'error', task_id=task.request.id)
+        else:
+            outcome['done'].append(part.pk)
+            send_part_workflow(part, 'segment', 'done', task_id=task.request.id)
+        release_part(task.request.id, part.pk)
+
+    if user:
+        if outcome['error']:
+            user.notify(_("Something went wrong during the segmentation!"),
+                        id="segmentation-error", level='danger')
+        else:
+            user.notify(_("Segmentation done!"),
+                        id="segmentation-success", level='success')
+    return outcome
+
+
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=60)
 def recalculate_masks(instance_pk=None, user_pk=None, only=None, **kwargs):
     if user_pk:
@@ -430,21 +521,63 @@ def recalculate_masks(instance_pk=None, user_pk=None, only=None, **kwargs):
     })
 
 
-def train_(qs, document, transcription, model=None, user=None):
+def transform_parts(task, part_pks, user_pk, process, transform, notifications):
+    """
+    Applies transform to each part of part_pks, the failure of a part doesn't stop the others.
+    """
+    DocumentPart = apps.get_model('core', 'DocumentPart')
+    user = User.objects.filter(pk=user_pk).first() if user_pk else None
+
+    outcome = {'done': [], 'error': []}
+    for part in DocumentPart.objects.filter(pk__in=part_pks).order_by('order'):
+        send_part_workflow(part, process, 'ongoing', task_id=task.request.id)
+        try:
+            transform(part, user)
+        except MemoryError as e:
+            retry_chunk(task, part_pks, outcome, e)
+        except Exception as e:
+            outcome['error'].append(part.pk)
+            logger.exception(e)
+            send_part_workflow(part, process, 'error', task_id=task.request.id)
+        else:
+            outcome['done'].append(part.pk)
+            send_part_workflow(part, process, 'done', task_id=task.request.id)
+
+    if user:
+        if outcome['error']:
+            user.notify(notifications['error'], id=f"{process}-error", level='danger')
+        else:
+            user.notify(notifications['success'], id=f"{process}-success", level='success')
+    return outcome
+
+
+@shared_task(bind=True, default_retry_delay=60)
+def rotate_parts(task, part_pks=[], document_pk=None, user_pk=None, angle=None, **kwargs):
+    """
+    Rotates many parts of a document in a single task.
+    """
+    return transform_parts(task, part_pks, user_pk, 'rotate',
+                           lambda part, user: part.rotate(angle, user=user),
+                           {'error': _("Something went wrong during the rotation!"),
+                            'success': _("Rotation done!")})
+
+
+@shared_task(bind=True, default_retry_delay=60)
+def crop_parts(task, part_pks=[], document_pk=None, user_pk=None, x1=None, y1=None, x2=None, y2=None, **kwargs):
+    """
+    Crops many parts of a document to the same rectangle in a single task.
+    """
+    return transform_parts(task, part_pks, user_pk, 'crop',
+                           lambda part, user: part.crop(x1, y1, x2, y2, user=user),
+                           {'error': _("Something went wrong during the crop!"),
+                            'success': _("Crop done!")})
+
+
+def train_(qs, document, transcription, model=None, user=None, part_pks=None):
     # # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
     from multiprocessing import current_process
     current_process().daemon = False
 
-    # try to minimize what is loaded in memory for large datasets
-    ground_truth = list(qs.values('content',
-                                  baseline=F('line__baseline'),
-                                  mask=F('line__mask'),
-                                  image=F('line__document_part__image')))
-
-    # shuffle ground truth lines
-    np.random.default_rng(241960353267317949653744176059648850006).shuffle(ground_truth)
-    partition = int(len(ground_truth) / 10)
-
     LOAD_THREADS = getattr(settings, 'KRAKEN_TRAINING_LOAD_THREADS', 0)
 
     AMP_MODE = getattr(settings, 'KRAKEN_TRAINING_PRECISION', '32')
@@ -453,23 +586,8 @@ def train_(qs, document, transcription, model=None, user=None):
                                                      'KRAKEN_TRAINING_BATCH_SIZE',
                                                      RECOGNITION_HYPER_PARAMS['batch_size'])
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-
-        train_dir = Path(tmp_dir)
-
-        logger.info(f'Compiling training dataset to {train_dir}/train.arrow')
-        train_segs = make_recognition_segmentation(ground_truth[partition:])
-        build_binary_dataset(train_segs,
-                             output_file=str(train_dir / 'train.arrow'),
-                             num_workers=LOAD_THREADS,
-                             format_type=None)
-
-        logger.info(f'Compiling validation dataset to {train_dir}/val.arrow')
-        val_segs = make_recognition_segmentation(ground_truth[:partition])
-        build_binary_dataset(val_segs,
-                             output_file=str(train_dir / 'val.arrow'),
-                             num_workers=LOAD_THREADS,
-                             format_type=None)
+    with recognition_dataset(qs, transcription, part_pks, num_workers=LOAD_THREADS) as (train_dir, counts):
+        train_size, partition = counts
 
         load = None
         try:
@@ -495,7 +613,7 @@ def train_(qs, document, transcription, model=None, user=None):
 
         logger.info(f'Starting recognition training on {accelerator}/{device} '
                     f'(precision: {AMP_MODE}, batch_size {RECOGNITION_HYPER_PARAMS["batch_size"]} '
-                    f', workers: {LOAD_THREADS}) with {len(ground_truth[partition:])} lines')
+                    f', workers: {LOAD_THREADS}) with {train_size} lines')
 
         kraken_model = RecognitionModel(hyper_params=RECOGNITION_HYPER_PARAMS,
                                         output=os.path.join(model_dir, 'version'),
@@ -565,7 +683,7 @@ def train(transcription_pk=None, model_pk=None, task_group_pk=None,
               .filter(transcription=transcription,
                       line__document_part__pk__in=part_pks)
               .exclude(Q(content='') | Q(content=None)))
-        train_(qs, document, transcription, model=model, user=user)
+        train_(qs, document, transcription, model=model, user=user, part_pks=part_pks)
     except DidNotConverge:
         send_event('document', document.pk, "training:error", {
             "id": model.pk,
@@ -603,7 +721,8 @@ def forced_align(instance_pk=None, model_pk=None, transcription_pk=None,
                  part_pk=None, user_pk=None, **kwargs):
 
     from kraken.align import forced_align as kraken_forced_align
-    from kraken.lib import models as kraken_models
+
+    from core.model_cache import load_recognition_model
 
     OcrModel = apps.get_model('core', 'OcrModel')
     DocumentPart = apps.get_model('core', 'DocumentPart')
@@ -611,7 +730,7 @@ def forced_align(instance_pk=None, model_pk=None, transcription_pk=None,
     LineTranscription = apps.get_model('core', 'LineTranscription')
 
     ocrmodel = OcrModel.objects.get(pk=model_pk)
-    model = kraken_models.load_any(ocrmodel.file.path)
+    model = load_recognition_model(ocrmodel)
     transcription = Transcription.objects.get(pk=transcription_pk)
 
     part = DocumentPart.objects.get(pk=instance_pk)
@@ -622,39 +741,55 @@ def forced_align(instance_pk=None, model_pk=None, transcription_pk=None,
         or "horizontal-lr"
     )
 
-    linetrans = LineTranscription.objects.filter(
+    linetrans = list(LineTranscription.objects.filter(
         line__document_part=part,
-        transcription=transcription
-    ).select_related('line')
-
-    for lt in linetrans:
-        data = {
-            'image': part.image,
-            "lines": [{
-                "text": lt.content,
-                "baseline": lt.line.baseline,
-                "boundary": lt.line.mask,
-                "text_direction": text_direction,
-                "tags": {'type': lt.line.typology and lt.line.typology.name or 'default'},
-            }],
-            "type": "baselines"
-        }
-
-        records = kraken_forced_align(data, model)  # base_dir = L,R
-        for pred in records:
-            # lt.content = pred.prediction
-            if text_direction == 'horizontal-rl' or text_direction == 'vertical-rl':
-                reorder = 'R'
-            else:
-                reorder = 'L'
-            pred = pred.logical_order(reorder)
-            lt.graphs = [{
-                'c': letter,
-                'poly': poly,
-                'confidence': float(confidence)
-            } for letter, poly, confidence in zip(
-                pred.prediction, pred.cuts, pred.confidences)]
-            lt.save()
+        transcription=transcription,
+        line__baseline__isnull=False,
+        line__mask__isnull=False,
+    ).select_related('line', 'line__typology').order_by('line__order'))
+    if not linetrans:
+        return
+
+    # all the lines of the part are aligned in a single pass over the page image
+    seg = Segmentation(
+        type='baselines',
+        imagename=part.image.path,
+        text_direction=text_direction,
+        script_detection=False,
+        lines=[BaselineLine(
+            id=str(lt.pk),
+            text=lt.content,
+            baseline=lt.line.baseline,
+            boundary=lt.line.mask,
+            tags={'type': lt.line.typology and lt.line.typology.name or 'default'},
+        ) for lt in linetrans]
+    )
+
+    # kraken switches the last layer to training mode to get the log_softmax output,
+    # the model may be shared through the cache so restore it afterwards
+    last_layer = model.nn.nn[-1]
+    training = last_layer.training
+    try:
+        records = kraken_forced_align(seg, model).lines  # base_dir = L,R
+    finally:
+        last_layer.training = training
+
+    if text_direction == 'horizontal-rl' or text_direction == 'vertical-rl':
+        reorder = 'R'
+    else:
+        reorder = 'L'
+
+    now = timezone.now()
+    for lt, pred in zip(linetrans, records):
+        pred = pred.logical_order(reorder)
+        lt.graphs = [{
+            'c': letter,
+            'poly': poly,
+            'confidence': float(confidence)
+        } for letter, poly, confidence in zip(
+            pred.prediction, pred.cuts, pred.confidences)]
+        lt.version_updated_at = now
+    LineTranscription.objects.bulk_update(linetrans, ['graphs', 'version_updated_at'], batch_size=1000)
 
 
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
@@ -704,6 +839,67 @@ def transcribe(instance_pk=None, model_pk=None, user_pk=None,
                         level='success')
 
 
+@shared_task(bind=True, default_retry_delay=10 * 60)
+def transcribe_parts(task, part_pks=[], document_pk=None, model_pk=None, user_pk=None,
+                     transcription_pk=None, text_direction=None, task_group_pk=None,
+                     **kwargs):
+    """
+    Transcribes a chunk of parts of the same document in a single worker invocation.
+    """
+    DocumentPart = apps.get_model('core', 'DocumentPart')
+    OcrModel = apps.get_model('core', 'OcrModel')
+    Transcription = apps.get_model('core', 'Transcription')
+
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+        except User.DoesNotExist:
+            user = None
+    else:
+        user = None
+
+    model = OcrModel.objects.get(pk=model_pk)
+    transcription = Transcription.objects.get(pk=transcription_pk)
+
+    parts = DocumentPart.objects.filter(pk__in=part_pks).order_by('order')
+    outcome = {'done': [], 'error': [], 'canceled': []}
+    for part in parts:
+        if is_canceled(task.request.id, part.pk):
+            outcome['canceled'].append(part.pk)
+            send_part_workflow(part, 'transcribe', 'canceled', task_id=task.request.id)
+            continue
+
+        # If quotas are enforced, assert that the user still has free CPU minutes
+        if user and not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() is not None:
+            assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+
+        send_part_workflow(part, 'transcribe', 'ongoing', task_id=task.request.id)
+        try:
+            part.transcribe(model, transcription, text_direction=text_direction, user=user)
+        except MemoryError as e:
+            retry_chunk(task, part_pks, outcome, e)
+        except Exception as e:
+            outcome['error'].append(part.pk)
+            part.workflow_state = part.WORKFLOW_STATE_SEGMENTED
+            part.save()
+            logger.exception(e)
+            send_part_workflow(part, 'transcribe', 'error', task_id=task.request.id)
+        else:
+            outcome['done'].append(part.pk)
+            send_part_workflow(part, 'transcribe', 'done', task_id=task.request.id)
+        release_part(task.request.id, part.pk)
+
+    if user:
+        if outcome['error']:
+            user.notify(_("Something went wrong during the transcription!"),
+                        id="transcription-error", level='danger')
+        else:
+            user.notify(_("Transcription done!"),
+                        id="transcription-success",
+                        level='success')
+    return outcome
+
+
 @shared_task(bind=True, autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
 def align(
     task,
@@ -0,0 +1,32 @@
+import itertools
+import random
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from core.merger import build_dist_matrix, find_order, path_score
+
+
+class FindOrderTestCase(SimpleTestCase):
+    def make_lines(self, n):
+        return [SimpleNamespace(baseline=[(random.randint(0, 1000), random.randint(0, 1000))
+                                          for _i in range(2)])
+                for _j in range(n)]
+
+    def test_exact_order(self):
+        random.seed(42)
+        for n in range(2, 8):
+            lines = self.make_lines(n)
+            mat = build_dist_matrix(lines)
+            brute = min(path_score(mat, list(perm)) for perm in itertools.permutations(range(n)))
+            order = find_order(lines)
+            self.assertEqual(sorted(order), list(range(n)))
+            self.assertAlmostEqual(path_score(mat, list(order)), brute)
+
+    def test_large_merge(self):
+        # fragments of a single horizontal line, shuffled
+        lines = [SimpleNamespace(baseline=[(i * 100, 10), (i * 100 + 80, 10)]) for i in range(40)]
+        random.seed(42)
+        random.shuffle(lines)
+        order = find_order(lines)
+        self.assertEqual([lines[i].baseline[0][0] for i in order], list(range(0, 4000, 100)))
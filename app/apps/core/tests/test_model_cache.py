@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from core.model_cache import ModelCache
+
+
+class ModelCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tmp_dir.name, f'model{i}.mlmodel')
+            with open(path, 'wb') as fh:
+                fh.write(b'0' * 100)
+            self.paths.append(path)
+        self.loaded = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def loader(self, path):
+        self.loaded.append(path)
+        return object()
+
+    def test_hit(self):
+        cache = ModelCache(max_size=1000)
+        model = cache.get('a', 'recognition', self.loader, self.paths[0])
+        self.assertIs(cache.get('a', 'recognition', self.loader, self.paths[0]), model)
+        self.assertEqual(self.loaded, [self.paths[0]])
+
+    def test_eviction(self):
+        cache = ModelCache(max_size=250)
+        cache.get('a', 'recognition', self.loader, self.paths[0])
+        cache.get('b', 'recognition', self.loader, self.paths[1])
+        # touch a so that b is the least recently used
+        cache.get('a', 'recognition', self.loader, self.paths[0])
+        cache.get('c', 'recognition', self.loader, self.paths[2])
+        self.assertEqual(list(cache.entries.keys()), ['a', 'c'])
+        self.assertEqual(cache.size, 200)
+
+    def test_disabled(self):
+        cache = ModelCache(max_size=0)
+        cache.get('a', 'recognition', self.loader, self.paths[0])
+        cache.get('a', 'recognition', self.loader, self.paths[0])
+        self.assertEqual(len(self.loaded), 2)
+        self.assertEqual(cache.size, 0)
@@ -1,14 +1,30 @@
 import json
 import os
+import re
 import subprocess
 from shutil import copyfile
 from unittest.mock import patch
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-
-from core.models import LineTranscription, Transcription
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from kraken.containers import BaselineLine, Region, Segmentation
+from kraken.lib.segmentation import calculate_polygonal_environment
+from shapely.geometry import LineString, Polygon
+
+from core.models import (
+    Block,
+    Document,
+    DocumentPart,
+    Line,
+    LineTranscription,
+    Transcription,
+)
+from core.passim_service import AlignmentServiceUnavailable
 from core.tests.factory import CoreFactoryTestCase
+from users.models import User, reconcile_disk_usage
 
 
 class DocumentPartTestCase(CoreFactoryTestCase):
@@ -134,6 +150,42 @@ class DocumentPartTestCase(CoreFactoryTestCase):
         self.part.refresh_from_db()
         self.assertEqual(self.part.workflow_state, self.part.WORKFLOW_STATE_ALIGNED)
 
+    @override_settings(ALIGNMENT_SERVICE_SOCKET="/tmp/alignment.sock")
+    @patch("core.models.hex")
+    @patch("core.models.subprocess")
+    @patch("core.models.submit_alignments")
+    def test_align_service(self, mock_submit, mock_subprocess, mock_hex):
+        """The alignment runs on the service when it is enabled, seriatim is only called when it can't be reached"""
+        self.makeTranscriptionContent()
+        mock_hex.return_value = "0x1"
+        args = [
+            "--docwise",
+            "--floating-ngrams",
+            "-n", str(self.n_gram),
+            "--max-offset", str(self.max_offset),
+            "--gap", str(self.gap),
+            "--fields", "ref",
+            "--filterpairs", "ref = 1 AND ref2 = 0",
+            f"{self.outdir}-1.json",
+            f"{self.outdir}-1",
+        ]
+        align_kwargs = dict(
+            merge=True, full_doc=False, threshold=0.0, region_types=self.region_types,
+            layer_name=None, beam_size=0, gap=self.gap,
+        )
+
+        self.part.document.align(
+            [self.part.pk], self.transcription.pk, self.witness.pk, self.n_gram, self.max_offset, **align_kwargs
+        )
+        mock_submit.assert_called_once_with([args])
+        mock_subprocess.check_call.assert_not_called()
+
+        mock_submit.side_effect = AlignmentServiceUnavailable("The alignment service can't be reached.")
+        self.part.document.align(
+            [self.part.pk], self.transcription.pk, self.witness.pk, self.n_gram, self.max_offset, **align_kwargs
+        )
+        mock_subprocess.check_call.assert_called_once_with(["seriatim", *args])
+
     @patch("core.models.subprocess")
     def test_align_deleted_line(self, _):
         """Unit tests for DocumentPart text alignment when a line is missing a LineTranscription"""
@@ -524,3 +576,203 @@ class DocumentPartTestCase(CoreFactoryTestCase):
             f"{self.outdir}-1.json",
             f"{self.outdir}-1",
         ])
+
+    def test_recalculate_ordering(self):
+        """Unit test for line ordering, regions first then lines top to bottom"""
+        part = self.factory.make_part()
+        top = Block.objects.create(document_part=part, box=[[0, 0], [50, 0], [50, 20], [0, 20]])
+        bottom = Block.objects.create(document_part=part, box=[[0, 30], [50, 30], [50, 60], [0, 60]])
+        # created in a scrambled order
+        l3 = Line.objects.create(document_part=part, block=bottom, baseline=[[5, 40], [45, 40]])
+        l2 = Line.objects.create(document_part=part, block=top, baseline=[[5, 15], [45, 15]])
+        l4 = Line.objects.create(document_part=part, block=bottom, baseline=[[5, 55], [45, 55]])
+        l1 = Line.objects.create(document_part=part, block=top, baseline=[[5, 5], [45, 5]])
+
+        part.recalculate_ordering(read_direction=Document.READ_DIRECTION_LTR)
+
+        self.assertEqual(list(part.lines.order_by('order').values_list('pk', flat=True)),
+                         [l1.pk, l2.pk, l3.pk, l4.pk])
+
+    def segment_per_object(self, part, res):
+        """The regions and lines of a segmentation saved one by one, as DocumentPart.segment used to"""
+        for region_type, regions in res.regions.items():
+            typo, _created = part.document.valid_block_types.get_or_create(name=region_type)
+            for region in regions:
+                Block.objects.create(document_part=part, typology=typo, box=region.boundary)
+        regions = part.blocks.all()
+        for line in res.lines:
+            center = LineString(line.baseline).interpolate(0.5, normalized=True)
+            region = next((r for r in regions if Polygon(r.box).contains(center)), None)
+            typo, _created = part.document.valid_line_types.get_or_create(name=line.tags.get("type"))
+            Line.objects.create(document_part=part, typology=typo, block=region,
+                                baseline=line.baseline, mask=line.boundary)
+
+    def segmentation_result(self, part):
+        blocks = list(part.blocks.order_by("order"))
+        regions = {block.pk: i for i, block in enumerate(blocks)}
+        for block in blocks:
+            self.assertTrue(re.match(r"^eSc_textblock_[0-9a-f]{8}$", block.external_id))
+        lines = list(part.lines.order_by("order"))
+        for line in lines:
+            self.assertTrue(re.match(r"^eSc_line_[0-9a-f]{8}$", line.external_id))
+        return ([(block.order, block.typology.name, block.box) for block in blocks],
+                [(line.order, line.typology.name, regions.get(line.block_id), line.baseline, line.mask)
+                 for line in lines])
+
+    def test_segment(self):
+        """Segmenting gives the regions and lines the former per object path gave"""
+        def line(pk, baseline, type_name):
+            (x1, y), (x2, _y) = baseline
+            return BaselineLine(id=str(pk), baseline=baseline, tags={"type": type_name},
+                                boundary=[[x1, y - 10], [x2, y - 10], [x2, y + 5], [x1, y + 5]])
+
+        res = Segmentation(
+            type="baselines",
+            imagename="test.png",
+            text_direction="horizontal-lr",
+            script_detection=False,
+            regions={
+                "text": [
+                    Region(id="r1", boundary=[[0, 0], [400, 0], [400, 100], [0, 100]], tags={"type": "text"}),
+                    # overlaps the first one
+                    Region(id="r2", boundary=[[200, 0], [600, 0], [600, 100], [200, 100]], tags={"type": "text"}),
+                ],
+                "marginalia": [
+                    Region(id="r3", boundary=[[600, 100], [860, 100], [860, 200]], tags={"type": "marginalia"}),
+                ],
+            },
+            lines=[
+                line(1, [[10, 50], [190, 50]], "default"),
+                # in both text regions, goes to the first one
+                line(2, [[250, 60], [350, 60]], "default"),
+                line(3, [[450, 50], [550, 50]], "heading"),
+                # in the bounding box of the marginalia but not in the triangle
+                line(4, [[620, 180], [680, 180]], "default"),
+                line(5, [[800, 120], [840, 120]], "heading"),
+            ],
+        )
+        part = self.factory.make_part()
+        legacy_part = self.factory.make_part()
+        with patch("core.models.load_segmentation_model"), \
+                patch("core.models.blla.segment", return_value=res), \
+                patch.object(DocumentPart, "recalculate_ordering"):
+            part.segment(steps="both", override=True)
+        self.segment_per_object(legacy_part, res)
+
+        blocks, lines = self.segmentation_result(part)
+        self.assertEqual((blocks, lines), self.segmentation_result(legacy_part))
+        self.assertEqual([region for _order, _typo, region, _baseline, _mask in lines], [0, 0, 1, None, 2])
+        # each type is created once for the document
+        for name in ["text", "marginalia"]:
+            self.assertEqual(part.document.valid_block_types.filter(name=name).count(), 1)
+        for name in ["default", "heading"]:
+            self.assertEqual(part.document.valid_line_types.filter(name=name).count(), 1)
+
+    def test_make_masks_neighbours(self):
+        """The masks computed against the neighbours of a line are the ones computed against every other line"""
+        part = self.factory.make_part()
+        part.document.line_offset = Document.LINE_OFFSET_TOPLINE
+        part.document.save()
+        for baseline in [
+            [[50, 60], [400, 60]],
+            # starts right after the end of the previous one
+            [[402, 66], [800, 66]],
+            [[50, 100], [420, 112]],
+            [[60, 140], [200, 128], [790, 142]],
+            # short lines squeezed between the others
+            [[410, 95], [440, 95]],
+            [[30, 180], [45, 180]],
+        ]:
+            Line.objects.create(document_part=part, baseline=baseline)
+
+        calls = []
+
+        def polygonize(**kwargs):
+            result = calculate_polygonal_environment(**kwargs)
+            calls.append((kwargs, result))
+            return result
+
+        with patch("core.models.calculate_polygonal_environment", side_effect=polygonize):
+            part.make_masks()
+
+        self.assertEqual(len(calls), 6)
+        filtered = 0
+        for kwargs, result in calls:
+            others = [other["baselines"][0] for other, _ in calls if other["baselines"] != kwargs["baselines"]]
+            filtered += len(others) - len(kwargs["suppl_obj"])
+            self.assertEqual(result, calculate_polygonal_environment(**{**kwargs, "suppl_obj": others}))
+        # the filter did leave some lines out
+        self.assertGreater(filtered, 0)
+
+
+class DiskUsageTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.factory.make_document()
+        self.user = self.document.owner
+
+    def test_parts(self):
+        part1 = self.factory.make_part(document=self.document, image_file_size=1000)
+        self.factory.make_part(document=self.document, image_file_size=500)
+        self.assertEqual(self.user.calc_disk_usage(), 1500)
+
+        part1 = DocumentPart.objects.get(pk=part1.pk)
+        part1.image_file_size = 800
+        part1.save()
+        self.assertEqual(self.user.calc_disk_usage(), 1300)
+
+        # saving without changing the size doesn't touch the counter, only the part and its progress
+        with self.assertNumQueries(2):
+            part1.save(update_fields=["name"])
+
+        part1.delete()
+        self.assertEqual(self.user.calc_disk_usage(), 500)
+
+        # the parts are deleted along with their document
+        self.document.delete()
+        self.assertEqual(self.user.calc_disk_usage(), 0)
+
+    def test_document_delete(self):
+        for size in (1000, 500, 250):
+            self.factory.make_part(document=self.document, image_file_size=size)
+        other = self.factory.make_part(image_file_size=100)
+        self.assertEqual(self.user.calc_disk_usage(), 1750)
+
+        with CaptureQueriesContext(connection) as context:
+            self.document.delete()
+        # a single update for all the parts of the document
+        updates = [query for query in context.captured_queries if query["sql"].startswith('UPDATE "users_user"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.user.calc_disk_usage(), 0)
+        self.assertEqual(other.document.owner.calc_disk_usage(), 100)
+
+    def test_user_save(self):
+        stale = User.objects.get(pk=self.user.pk)
+        self.factory.make_part(document=self.document, image_file_size=1000)
+
+        # the user loaded before the part was added doesn't write back its usage
+        stale.first_name = "changed"
+        stale.save()
+        self.assertEqual(self.user.calc_disk_usage(), 1000)
+        self.assertEqual(User.objects.get(pk=self.user.pk).first_name, "changed")
+
+        deferred = User.objects.only("last_name").get(pk=self.user.pk)
+        deferred.last_name = "deferred"
+        deferred.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).last_name, "deferred")
+        self.assertEqual(self.user.calc_disk_usage(), 1000)
+
+    def test_model(self):
+        model = self.factory.make_model(self.document)
+        self.assertEqual(self.user.calc_disk_usage(), model.file_size)
+
+        model.delete()
+        self.assertEqual(self.user.calc_disk_usage(), 0)
+
+    def test_reconcile(self):
+        part = self.factory.make_part(document=self.document, image_file_size=1000)
+        DocumentPart.objects.filter(pk=part.pk).update(image_file_size=2000)
+        self.assertEqual(self.user.calc_disk_usage(), 1000)
+
+        reconcile_disk_usage(User.objects.all())
+        self.assertEqual(self.user.calc_disk_usage(), 2000)
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+
+from django.test import SimpleTestCase
+
+from core.passim_service import (
+    AlignmentServiceError,
+    AlignmentServiceUnavailable,
+    make_server,
+    run_seriatim,
+    submit,
+)
+
+
+class AlignmentServiceTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmp_dir.name, "alignment.sock")
+        self.jobs = []
+
+        def run_job(args):
+            if "fail" in args:
+                raise ValueError("Uhoh")
+            self.jobs.append(args)
+
+        self.server = make_server(self.socket_path, run_job=run_job)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_submit(self):
+        submit([["-n", "4", "doc1.json", "doc1"], ["-n", "4", "doc2.json", "doc2"]], socket_path=self.socket_path)
+        # the same service runs the jobs of successive requests
+        submit([["doc3.json", "doc3"]], socket_path=self.socket_path)
+        self.assertListEqual(self.jobs, [
+            ["-n", "4", "doc1.json", "doc1"], ["-n", "4", "doc2.json", "doc2"], ["doc3.json", "doc3"],
+        ])
+
+    def test_submit_error(self):
+        with self.assertRaises(AlignmentServiceError) as context:
+            submit([["fail"], ["doc.json", "doc"]], socket_path=self.socket_path)
+        self.assertEqual(str(context.exception), "Uhoh")
+        # the other jobs of the batch still ran
+        self.assertListEqual(self.jobs, [["doc.json", "doc"]])
+
+    def test_unavailable(self):
+        with self.assertRaises(AlignmentServiceUnavailable):
+            submit([["doc.json", "doc"]], socket_path=os.path.join(self.tmp_dir.name, "missing.sock"))
+        with self.settings(ALIGNMENT_SERVICE_SOCKET=None):
+            with self.assertRaises(AlignmentServiceUnavailable):
+                submit([["doc.json", "doc"]])
+
+    def test_run_seriatim(self):
+        with open(os.path.join(self.tmp_dir.name, "fake_seriatim.py"), "w") as fh:
+            fh.write(
+                "import json, sys\n"
+                "if '--fail' in sys.argv:\n"
+                "    sys.exit(2)\n"
+                "with open(sys.argv[-1], 'w') as out:\n"
+                "    json.dump(sys.argv[1:], out)\n"
+            )
+        sys.path.insert(0, self.tmp_dir.name)
+        self.addCleanup(sys.path.remove, self.tmp_dir.name)
+        out = os.path.join(self.tmp_dir.name, "out.json")
+        argv = list(sys.argv)
+
+        with self.settings(PASSIM_SERIATIM_MODULE="fake_seriatim"):
+            run_seriatim(["-n", "4", out])
+            with self.assertRaises(AlignmentServiceError):
+                run_seriatim(["--fail", out])
+
+        with open(out) as fh:
+            self.assertListEqual(json.load(fh), ["-n", "4", out])
+        self.assertListEqual(sys.argv, argv)
@@ -3,9 +3,10 @@ from unittest.mock import patch
 
 from django.urls import reverse
 
-from core.models import Document, Line
-from core.tasks import align
+from core.models import Document, DocumentPart, ImageAnnotation, Line
+from core.tasks import align, crop_parts, segment_parts
 from core.tests.factory import CoreFactoryTestCase
+from reporting.models import TaskReport
 
 # DO NOT REMOVE THIS IMPORT, it will break a lot of tests
 # It is used to trigger Celery signals when running tests
@@ -189,3 +190,125 @@ class TasksTestCase(CoreFactoryTestCase):
                     parts = apps_mock.get_model.return_value.objects.filter.return_value
                     apps_mock.get_model.return_value.objects.bulk_update.assert_called_with(parts, ["workflow_state"])
                     self.assertEqual(mock_log.output[0][:17], "ERROR:core.tasks:")
+
+
+@patch("reporting.models.app.control.revoke")
+class ChunkedTasksTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.factory.make_document()
+        self.parts = [self.factory.make_part(document=self.document) for i in range(3)]
+        self.part_pks = [part.pk for part in self.parts]
+        self.report = TaskReport.objects.create(
+            user=self.document.owner,
+            label="chunk",
+            document=self.document,
+            task_id="chunk-task",
+            method="core.tasks.segment_parts",
+            part_pks=self.part_pks,
+        )
+
+    def run_chunk(self, make_masks):
+        with patch.object(DocumentPart, "make_masks", autospec=True, side_effect=make_masks) as mock:
+            result = segment_parts.apply(kwargs={"part_pks": self.part_pks, "steps": "masks"},
+                                         task_id="chunk-task")
+        self.report.refresh_from_db()
+        return result.get(), [call.args[0].pk for call in mock.call_args_list]
+
+    def test_cancel_halfway(self, mock_revoke):
+        def make_masks(part):
+            # the chunk is canceled while its first part is processed
+            TaskReport.objects.get(pk=self.report.pk).cancel(None)
+
+        outcome, processed = self.run_chunk(make_masks)
+        self.assertEqual(processed, self.part_pks[:1])
+        self.assertEqual(outcome["canceled"], self.part_pks[1:])
+        self.assertEqual(self.report.workflow_state, TaskReport.WORKFLOW_STATE_CANCELED)
+        # the running task is left to stop by itself
+        mock_revoke.assert_called_once_with("chunk-task", terminate=False)
+
+    def test_cancel_part(self, mock_revoke):
+        def make_masks(part):
+            if part.pk == self.part_pks[0]:
+                DocumentPart.objects.get(pk=self.part_pks[1]).cancel_tasks()
+
+        outcome, processed = self.run_chunk(make_masks)
+        self.assertEqual(processed, [self.part_pks[0], self.part_pks[2]])
+        self.assertEqual(outcome["canceled"], [self.part_pks[1]])
+        self.assertEqual(self.report.workflow_state, TaskReport.WORKFLOW_STATE_DONE)
+        self.assertEqual(self.report.part_pks, [])
+        mock_revoke.assert_not_called()
+
+    def test_workflow(self, mock_revoke):
+        part = self.parts[1]
+        self.assertEqual(part.workflow.get("segment"), "pending")
+        self.assertTrue(part.in_queue())
+
+        self.report.start()
+        self.assertEqual(part.workflow.get("segment"), "ongoing")
+        self.assertFalse(part.in_queue())
+
+        # processed parts are released by the chunk
+        TaskReport.objects.filter(pk=self.report.pk).update(part_pks=self.part_pks[2:])
+        self.assertNotIn("segment", part.workflow)
+
+    def test_recover(self, mock_revoke):
+        self.report.start()
+        part = self.parts[1]
+        part.workflow_state = DocumentPart.WORKFLOW_STATE_SEGMENTING
+        part.save()
+
+        part.recover()
+        part.refresh_from_db()
+        self.report.refresh_from_db()
+        self.assertEqual(part.workflow_state, DocumentPart.WORKFLOW_STATE_CONVERTED)
+        self.assertEqual(self.report.workflow_state, TaskReport.WORKFLOW_STATE_ERROR)
+        self.assertEqual(self.report.part_pks, [self.part_pks[0], self.part_pks[2]])
+
+    def test_part_error(self, mock_revoke):
+        def make_masks(part):
+            if part.pk == self.part_pks[1]:
+                raise ValueError("broken part")
+
+        outcome, processed = self.run_chunk(make_masks)
+        self.assertEqual(processed, self.part_pks)
+        self.assertEqual(outcome["error"], [self.part_pks[1]])
+        # a failing part isn't reported as a success
+        self.assertEqual(self.report.workflow_state, TaskReport.WORKFLOW_STATE_ERROR)
+
+
+class TransformPartsTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.factory.make_document()
+        self.parts = [self.factory.make_part(document=self.document) for i in range(2)]
+        self.factory.make_content(self.parts[0], amount=3)
+        self.factory.make_img_annotations(self.parts[0])
+
+    @patch("users.models.User.notify")
+    def test_crop_parts(self, mock_notify):
+        line = self.parts[0].lines.last()
+        annotation = ImageAnnotation.objects.filter(part=self.parts[0]).first()
+        crop = DocumentPart.crop
+
+        def crop_or_fail(part, *args, **kwargs):
+            if part.pk == self.parts[0].pk:
+                return crop(part, *args, **kwargs)
+            raise ValueError("broken part")
+
+        with patch.object(DocumentPart, "crop", autospec=True, side_effect=crop_or_fail):
+            outcome = crop_parts.apply(kwargs={
+                "part_pks": [part.pk for part in self.parts],
+                "user_pk": self.document.owner.pk,
+                "x1": 5, "y1": 5, "x2": 400, "y2": 150,
+            }).get()
+
+        self.assertEqual(outcome, {"done": [self.parts[0].pk], "error": [self.parts[1].pk]})
+        baseline = line.baseline
+        line.refresh_from_db()
+        self.assertEqual(line.baseline, [[x - 5, y - 5] for x, y in baseline])
+        # image annotations are left in place
+        coordinates = annotation.coordinates
+        annotation.refresh_from_db()
+        self.assertEqual(annotation.coordinates, coordinates)
+        mock_notify.assert_called_once_with("Something went wrong during the crop!", id="crop-error", level="danger")
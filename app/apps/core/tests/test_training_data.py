@@ -0,0 +1,110 @@
+import os
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.test import SimpleTestCase
+from kraken.lib.dataset import ArrowIPCRecognitionDataset
+
+from core.models import Line, LineTranscription
+from core.tests.factory import CoreFactoryTestCase
+from core.training_data import (
+    VALIDATION_RATIO,
+    compile_recognition_dataset,
+    dataset_cache_key,
+    evict_datasets,
+    is_validation_line,
+    use_dataset,
+)
+
+
+class TrainingDataTestCase(SimpleTestCase):
+    def test_validation_split(self):
+        pks = range(1, 20001)
+        split = [is_validation_line(pk) for pk in pks]
+        # stable from one run to another
+        self.assertEqual(split, [is_validation_line(pk) for pk in pks])
+        self.assertAlmostEqual(sum(split) / len(pks), 1 / VALIDATION_RATIO, delta=0.01)
+
+    def test_evict_datasets(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = Path(tmp_dir)
+            old = time.time() - 2 * 60 * 60
+            for i, name in enumerate(['a', 'b', 'c']):
+                entry = cache_dir / name
+                entry.mkdir()
+                (entry / 'train.arrow').write_bytes(b'0' * 100)
+                os.utime(entry, (old + i, old + i))
+            evict_datasets(cache_dir, 200, keep=[cache_dir / 'a'])
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['a', 'c'])
+
+    def test_evict_datasets_in_use(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = Path(tmp_dir)
+            old = time.time() - 2 * 60 * 60
+            for name in ['a', 'b']:
+                entry = cache_dir / name
+                entry.mkdir()
+                (entry / 'train.arrow').write_bytes(b'0' * 100)
+            # a long training started with 'a' from another worker
+            with use_dataset(cache_dir / 'a'):
+                for name in ['a', 'b']:
+                    os.utime(cache_dir / name, (old, old))
+                evict_datasets(cache_dir, 0)
+                self.assertEqual(os.listdir(cache_dir), ['a'])
+            os.utime(cache_dir / 'a', (old, old))
+            evict_datasets(cache_dir, 0)
+            self.assertEqual(os.listdir(cache_dir), [])
+
+
+class RecognitionDatasetTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.part = self.factory.make_part()
+        self.transcription = self.factory.make_transcription(document=self.part.document)
+        self.texts = ['lorem ipsum', 'dolor sit', 'amet', 'consectetur', 'adipiscing', 'elit sed', 'do eiusmod']
+        for i, text in enumerate(self.texts, start=1):
+            y = i * 25
+            line = Line.objects.create(document_part=self.part,
+                                       baseline=[[10, y], [200, y]],
+                                       mask=[[10, y - 10], [200, y - 10], [200, y + 5], [10, y + 5]])
+            LineTranscription.objects.create(transcription=self.transcription, line=line, content=text)
+        self.qs = LineTranscription.objects.filter(transcription=self.transcription)
+
+    def test_compile_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            train_file = Path(tmp_dir) / 'train.arrow'
+            val_file = Path(tmp_dir) / 'val.arrow'
+            train_count, val_count = compile_recognition_dataset(self.qs, train_file, val_file)
+
+            expected_val = sum(is_validation_line(lt.line_id) for lt in self.qs)
+            self.assertEqual((train_count, val_count), (len(self.texts) - expected_val, expected_val))
+
+            datasets = []
+            for path in [train_file, val_file]:
+                ds = ArrowIPCRecognitionDataset()
+                ds.add(file=str(path))
+                datasets.append(ds)
+            self.assertEqual([len(ds) for ds in datasets], [train_count, val_count])
+            # the metadata alphabet is the one of the lines written to the file
+            self.assertEqual(sum((ds.alphabet for ds in datasets), Counter()), Counter(''.join(self.texts)))
+
+            train = datasets[0]
+            train.encode(None)
+            sample = train[0]
+            self.assertIn(len(sample['target']), [len(text) for text in self.texts])
+
+    def test_cache_key(self):
+        key = dataset_cache_key(self.qs, self.transcription, [self.part.pk])
+        self.assertEqual(key, dataset_cache_key(self.qs.order_by('-pk'), self.transcription, [self.part.pk]))
+
+        # a geometry edit doesn't touch the transcriptions, only the fingerprint catches it
+        line = self.part.lines.first()
+        line.baseline = [[10, 30], [200, 30]]
+        line.save()
+        edited = dataset_cache_key(self.qs, self.transcription, [self.part.pk])
+        self.assertNotEqual(key, edited)
+
+        LineTranscription.objects.filter(pk=self.qs.first().pk).update(content='changed')
+        self.assertNotEqual(edited, dataset_cache_key(self.qs, self.transcription, [self.part.pk]))
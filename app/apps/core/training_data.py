@@ -0,0 +1,347 @@
+"""
+Streaming compilation of recognition ground truth into kraken's binary (Arrow) datasets.
+
+Lines are read from the database in chunks, grouped by image, and sent either to the
+training or to the validation set depending on a hash of their pk, so the split is
+stable from one run to the next without having to load and shuffle the whole corpus.
+Line images are flushed to the Arrow files in small record batches, peak memory doesn't
+depend on the number of lines.
+
+Compiled datasets are kept in an on disk cache (settings.KRAKEN_DATASET_CACHE_DIR) addressed
+by a hash of the transcription, the parts and a fingerprint of the lines they contain,
+retraining on unchanged ground truth reuses them. The least recently used datasets are
+evicted when the cache grows over settings.KRAKEN_DATASET_CACHE_SIZE Mb (0 disables it).
+"""
+import hashlib
+import importlib.metadata
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from itertools import groupby, islice
+from multiprocessing import Pool
+from operator import itemgetter
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+from django.conf import settings
+from django.db.models import BigIntegerField, Count, Func, Max, Sum, TextField, Value
+from django.db.models.functions import MD5, Cast, Concat, Substr
+from kraken.containers import BaselineLine, Segmentation
+from kraken.lib.exceptions import KrakenInputException
+from kraken.lib.segmentation import extract_polygons
+from kraken.lib.util import is_bitonal
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+VALIDATION_RATIO = 10  # one line out of VALIDATION_RATIO goes to the validation set
+DB_CHUNK_SIZE = 2000
+RECORDBATCH_SIZE = 100
+PAGES_PER_WORKER = 4  # number of pages queued for each extraction process
+DATASET_CACHE_GRACE = 60 * 60  # in seconds, datasets used more recently than that are never evicted
+DATASET_IN_USE_TIMEOUT = 7 * 24 * 60 * 60  # in seconds, after that a training is considered dead
+IN_USE_PREFIX = '.in-use-'
+
+LINE_TYPE = pa.struct([('text', pa.string()), ('im', pa.binary())])
+SCHEMA = pa.schema([('lines', LINE_TYPE),
+                    ('train', pa.bool_()),
+                    ('validation', pa.bool_()),
+                    ('test', pa.bool_())])
+
+
+def is_validation_line(pk):
+    digest = hashlib.blake2b(str(pk).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % VALIDATION_RATIO == 0
+
+
+def iter_ground_truth(qs, chunk_size=DB_CHUNK_SIZE):
+    """
+    Yields an (image path, training lines, validation lines) tuple for every image
+    of a LineTranscription queryset.
+    """
+    rows = (qs.order_by('line__document_part', 'line')
+            .values_list('line', 'content', 'line__baseline', 'line__mask', 'line__document_part__image')
+            .iterator(chunk_size=chunk_size))
+    for image, group in groupby(rows, key=itemgetter(4)):
+        train, val = [], []
+        for line_pk, content, baseline, mask, _image in group:
+            line = BaselineLine(id=str(line_pk), baseline=baseline, boundary=mask, text=content)
+            (val if is_validation_line(line_pk) else train).append(line)
+        yield os.path.join(settings.MEDIA_ROOT, image), train, val
+
+
+def _extract_lines(im, imagename, lines):
+    records = []
+    for line in lines:
+        seg = Segmentation(text_direction='horizontal-lr',
+                           imagename=imagename,
+                           type='baselines',
+                           lines=[line],
+                           script_detection=False)
+        try:
+            line_im, line = next(extract_polygons(im, seg))
+        except KrakenInputException:
+            logger.warning(f'Invalid line {line.id} in {imagename}')
+            continue
+        except Exception as e:
+            logger.warning(f'Unexpected exception {e} from line {line.id} in {imagename}')
+            continue
+        fp = io.BytesIO()
+        line_im.save(fp, format='png')
+        records.append({'text': line.text, 'im': fp.getvalue()})
+    return records
+
+
+def extract_page(page):
+    """
+    Extracts the line images of a page yielded by iter_ground_truth, the image is
+    opened only once for both sets.
+    """
+    imagename, train, val = page
+    try:
+        im = Image.open(imagename)
+    except (FileNotFoundError, UnidentifiedImageError):
+        logger.warning(f'Could not open {imagename}')
+        return [], [], None
+    if is_bitonal(im):
+        im = im.convert('1')
+    return _extract_lines(im, imagename, train), _extract_lines(im, imagename, val), im.mode
+
+
+class ArrowDatasetWriter:
+    """
+    Incrementally writes line records to a kraken binary dataset.
+
+    kraken expects the alphabet and line counts in the schema metadata, which are only
+    known once every line has been written, so records go to a temporary file first and
+    are copied batch by batch, through a memory map, to the final file on close.
+    """
+    def __init__(self, output_file, recordbatch_size=RECORDBATCH_SIZE):
+        self.output_file = str(output_file)
+        self.tmp_file = self.output_file + '.tmp'
+        self.recordbatch_size = recordbatch_size
+        self.sink = pa.OSFile(self.tmp_file, 'wb')
+        self.writer = pa.ipc.new_file(self.sink, SCHEMA)
+        self.cache = []
+        self.alphabet = Counter()
+        self.im_mode = '1'
+        self.count = 0
+
+    def add(self, records, im_mode):
+        if not records:
+            return
+        self.cache.extend(records)
+        for record in records:
+            self.alphabet.update(record['text'])
+        # comparison RGB(A) > L > 1
+        if im_mode > self.im_mode:
+            self.im_mode = im_mode
+        if len(self.cache) >= self.recordbatch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.cache:
+            return
+        lines = pa.array(self.cache, type=LINE_TYPE)
+        # splits are given by the file itself, not by the masks
+        mask = pa.array(np.zeros(len(self.cache), dtype=bool))
+        self.writer.write_batch(pa.RecordBatch.from_arrays([lines, mask, mask, mask], schema=SCHEMA))
+        self.count += len(self.cache)
+        self.cache = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.sink.close()
+
+        metadata = {'type': 'kraken_recognition_baseline',
+                    'alphabet': self.alphabet,
+                    'text_type': 'raw',
+                    'image_type': 'raw',
+                    'splits': ['train', 'eval', 'test'],
+                    'im_mode': self.im_mode,
+                    'legacy_polygons': False,
+                    'counts': {'all': self.count, 'train': 0, 'validation': 0, 'test': 0}}
+        schema = SCHEMA.with_metadata({'lines': json.dumps(metadata)})
+        with pa.memory_map(self.tmp_file, 'rb') as source:
+            reader = pa.ipc.open_file(source)
+            with pa.OSFile(self.output_file, 'wb') as sink:
+                with pa.ipc.new_file(sink, schema) as writer:
+                    for i in range(reader.num_record_batches):
+                        writer.write_batch(reader.get_batch(i))
+        os.remove(self.tmp_file)
+
+
+def compile_recognition_dataset(qs, train_file, val_file, num_workers=0):
+    """
+    Compiles the lines of a LineTranscription queryset to a training and a validation
+    binary dataset, returns the number of (training, validation) lines written.
+    """
+    train_writer = ArrowDatasetWriter(train_file)
+    val_writer = ArrowDatasetWriter(val_file)
+
+    def write(results):
+        for train, val, im_mode in results:
+            train_writer.add(train, im_mode)
+            val_writer.add(val, im_mode)
+
+    pages = iter_ground_truth(qs)
+    if num_workers and num_workers > 1:
+        with Pool(num_workers) as pool:
+            # Pool.imap would consume the whole queryset upfront, feed it a bounded window instead
+            for window in iter(lambda: list(islice(pages, num_workers * PAGES_PER_WORKER)), []):
+                write(pool.imap(extract_page, window))
+    else:
+        write(map(extract_page, pages))
+
+    train_writer.close()
+    val_writer.close()
+    logger.info(f'Compiled {train_writer.count} training lines to {train_file} '
+                f'and {val_writer.count} validation lines to {val_file}.')
+    return train_writer.count, val_writer.count
+
+
+def dataset_cache_key(qs, transcription, part_pks):
+    """
+    Hashes everything the compiled dataset depends on, the fingerprint catches edits of
+    the lines geometry which don't touch the transcriptions.
+    """
+    line = Concat(Cast('line', TextField()), Value(':'),
+                  'line__document_part__image', Value(':'),
+                  Cast('line__baseline', TextField()), Value(':'),
+                  Cast('line__mask', TextField()), Value(':'),
+                  'content',
+                  output_field=TextField())
+    # each line is hashed on its own and the first 60 bits of the digests are summed, the
+    # lines of the whole corpus are never concatenated in a single (size limited) string
+    line_hash = Func(Concat(Value('x'), Substr(MD5(line), 1, 15)),
+                     template='(%(expressions)s)::bit(60)::bigint',
+                     output_field=BigIntegerField())
+    stats = qs.aggregate(count=Count('pk'),
+                         last_update=Max('version_updated_at'),
+                         fingerprint=Sum(line_hash))
+    key = json.dumps([importlib.metadata.version('kraken'),
+                      VALIDATION_RATIO,
+                      transcription.pk,
+                      sorted(part_pks or []),
+                      stats['count'],
+                      stats['last_update'],
+                      stats['fingerprint']], default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _compile_cache_entry(qs, cache_dir, entry, num_workers=0):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir))
+    try:
+        counts = compile_recognition_dataset(qs,
+                                             tmp_dir / 'train.arrow',
+                                             tmp_dir / 'val.arrow',
+                                             num_workers=num_workers)
+        # written last, its presence means the entry is complete
+        with open(tmp_dir / 'counts.json', 'w') as fh:
+            json.dump(counts, fh)
+        try:
+            tmp_dir.rename(entry)
+        except OSError:
+            # the same dataset was compiled concurrently by another worker
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return counts
+
+
+def is_in_use(entry, now):
+    """
+    Tells if a dataset is used by a running training, see use_dataset.
+    """
+    return any(f.name.startswith(IN_USE_PREFIX) and now - f.stat().st_mtime < DATASET_IN_USE_TIMEOUT
+               for f in entry.iterdir())
+
+
+@contextmanager
+def use_dataset(entry):
+    """
+    Marks a dataset as used by a training for the duration of the context, it is never evicted
+    meanwhile, whatever the number of workers sharing the cache.
+    """
+    marker = entry / (IN_USE_PREFIX + uuid.uuid4().hex)
+    marker.touch()
+    try:
+        yield entry
+    finally:
+        marker.unlink(missing_ok=True)
+
+
+def evict_datasets(cache_dir, max_size, keep=()):
+    """
+    Removes the least recently used datasets until the cache fits in max_size bytes,
+    the entries of keep and the datasets of running trainings are always kept.
+    """
+    now = time.time()
+    entries = []
+    keep = set(keep)
+    for entry in cache_dir.iterdir():
+        try:
+            mtime = entry.stat().st_mtime
+            if entry.name.startswith('.tmp-'):
+                # leftover of a crashed compilation
+                if now - mtime > 24 * 60 * 60:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir())
+            if is_in_use(entry, now):
+                keep.add(entry)
+        except FileNotFoundError:  # evicted concurrently
+            continue
+        entries.append((mtime, size, entry))
+
+    total = sum(size for _mtime, size, _entry in entries)
+    for mtime, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        if entry in keep or now - mtime < DATASET_CACHE_GRACE:
+            continue
+        logger.info(f'Evicting training dataset {entry} from the cache.')
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+@contextmanager
+def recognition_dataset(qs, transcription, part_pks, num_workers=0):
+    """
+    Yields the directory containing train.arrow and val.arrow for the lines of qs, and
+    the number of (training, validation) lines, compiling them only if needed.
+    """
+    max_size = getattr(settings, 'KRAKEN_DATASET_CACHE_SIZE', 0) * 1024 * 1024
+    if not max_size:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            train_dir = Path(tmp_dir)
+            yield train_dir, compile_recognition_dataset(qs,
+                                                         train_dir / 'train.arrow',
+                                                         train_dir / 'val.arrow',
+                                                         num_workers=num_workers)
+        return
+
+    cache_dir = Path(settings.KRAKEN_DATASET_CACHE_DIR)
+    entry = cache_dir / dataset_cache_key(qs, transcription, part_pks)
+    try:
+        with open(entry / 'counts.json') as fh:
+            counts = tuple(json.load(fh))
+        os.utime(entry)
+        logger.info(f'Reusing cached training dataset {entry}.')
+    except (FileNotFoundError, ValueError):
+        logger.info(f'Compiling training dataset to {entry}.')
+        counts = _compile_cache_entry(qs, cache_dir, entry, num_workers=num_workers)
+    with use_dataset(entry):
+        evict_datasets(cache_dir, max_size, keep=[entry])
+        yield entry, counts
@@ -1,7 +1,13 @@
+import functools
+import os
 import random
 
+import numpy as np
 from django.db.models import CharField
 from django.forms.widgets import Input
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+from skimage.filters import sobel
 
 
 def random_color():
@@ -22,3 +28,23 @@ class ColorField(CharField):
     def formfield(self, **kwargs):
         kwargs['widget'] = ColorWidget
         return super(ColorField, self).formfield(**kwargs)
+
+
+@functools.lru_cache(maxsize=8)
+def _polygonization_features(path, mtime, height):
+    with Image.open(path) as im:
+        im = im.convert("L")
+        w, h = im.size
+        ow = int(w * height / h)
+        scaled = np.array(im.resize((ow, height)))
+    return gaussian_filter(sobel(scaled), 0.5), np.array((ow / w, height / h))
+
+
+def get_polygonization_features(path, height=1200):
+    """
+    Returns the seamcarving energy map kraken uses to calculate line masks,
+    for the image rescaled to the given height, along with the (x, y) scale.
+    The result is cached in the process as long as the image file doesn't change,
+    so that successive mask recalculations on the same part don't redo it.
+    """
+    return _polygonization_features(path, os.path.getmtime(path), height)
@@ -1,17 +1,26 @@
+import hashlib
+import json
+import math
 import os.path
-import re
 import time
 import zipfile
 from datetime import datetime
+from functools import partial
+from multiprocessing import current_process, get_context
 
 import oitei
 from django.apps import apps
 from django.conf import settings
-from django.db.models import Avg, Prefetch
+from django.contrib.postgres.aggregates import StringAgg
+from django.db import connections
+from django.db.models import Avg, OuterRef, Prefetch, Subquery, TextField, Value
+from django.db.models.functions import MD5, Cast, Concat
 from django.template import loader
+from django.template.loader_tags import IncludeNode
 from django.utils.text import slugify
 
 from core.models import Block
+from imports import export_cache
 
 TEXT_FORMAT = "text"
 PAGEXML_FORMAT = "pagexml"
@@ -19,16 +28,53 @@ ALTO_FORMAT = "alto"
 OPENITI_MARKDOWN_FORMAT = "openitimarkdown"
 TEI_XML_FORMAT = "teixml"
 
+# number of parts whose regions, lines and transcriptions are fetched together
+EXPORT_PARTS_CHUNK_SIZE = 50
+
 
 class EsZipFile(zipfile.ZipFile):
-    def writestr(self, arcname, data,
-                 compress_type=None, compresslevel=None):
+    def make_zipinfo(self, arcname):
         zinfo = zipfile.ZipInfo(filename=arcname,
                                 date_time=time.localtime(time.time())[:6])
         zinfo.compress_type = self.compression
         zinfo._compresslevel = self.compresslevel
         zinfo.external_attr = 0o644 << 16
-        return super().writestr(zinfo, data, compress_type, compresslevel)
+        return zinfo
+
+    def writestr(self, arcname, data,
+                 compress_type=None, compresslevel=None):
+        return super().writestr(self.make_zipinfo(arcname), data, compress_type, compresslevel)
+
+    def open_entry(self, arcname):
+        """
+        Opens a new entry for writing, with the same attributes as the ones added by writestr.
+        """
+        return self.open(self.make_zipinfo(arcname), "w")
+
+
+class StreamBuffer:
+    """
+    Write-only file object keeping what is written to it until it is drained, used to
+    stream an export while it is rendered.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def render_parts_chunk(exporter, part_pks):
+    return list(exporter.render_chunk(part_pks))
 
 
 class BaseExporter:
@@ -49,6 +95,7 @@ class BaseExporter:
         self.document = document
         self.report = report
         self.transcription = transcription
+        self.processes = getattr(settings, "EXPORT_PROCESSES", 0)
 
         self.prepare_for_rendering()
 
@@ -62,15 +109,85 @@ class BaseExporter:
         assert hasattr(
             self, "file_extension"
         ), "file_extension attribute is mandatory and must be defined on your exporter"
-        filename = f"{base_filename}.{self.file_extension}"
-        self.filepath = os.path.join(self.user.get_document_store_path(), filename)
+        self.filename = f"{base_filename}.{self.file_extension}"
+        self.filepath = os.path.join(self.user.get_document_store_path(), self.filename)
+
+    def write(self, fh):
+        """
+        Writes the export to the binary file object fh, yields each time a part was written.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        with open(self.filepath, "wb") as fh:
+            for _ in self.write(fh):
+                pass
+
+    def stream(self):
+        """
+        Yields the export by chunks while it is rendered, without storing it.
+        """
+        # the parts are rendered by the calling process, streamed exports are small
+        self.processes = 0
+        buffer = StreamBuffer()
+        for _ in self.write(buffer):
+            data = buffer.drain()
+            if data:
+                yield data
+        yield buffer.drain()
+
+    def get_part_chunks(self):
+        """
+        Splits the parts to export, in order, in chunks small enough to be spread over
+        settings.EXPORT_PROCESSES workers.
+        """
+        DocumentPart = apps.get_model("core", "DocumentPart")
+        part_pks = list(
+            DocumentPart.objects.filter(
+                document=self.document, pk__in=self.part_pks
+            ).values_list("pk", flat=True)
+        )
+        size = EXPORT_PARTS_CHUNK_SIZE
+        if self.processes > 1:
+            size = max(1, min(size, math.ceil(len(part_pks) / (self.processes * 4))))
+        return [part_pks[i:i + size] for i in range(0, len(part_pks), size)]
+
+    def iter_rendered_chunks(self, chunks):
+        """
+        Yields the result of render_chunk for every chunk of parts, in order, rendering them
+        in a pool of processes if settings.EXPORT_PROCESSES is greater than 1.
+        """
+        if self.processes > 1 and len(chunks) > 1:
+            # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
+            current_process().daemon = False
+            # the workers can't share the connections of their parent, they will open their own
+            connections.close_all()
+            with get_context("fork").Pool(min(self.processes, len(chunks))) as pool:
+                yield from pool.imap(partial(render_parts_chunk, self), chunks)
+        else:
+            yield from map(self.render_chunk, chunks)
+
+    def render_chunk(self, part_pks):
+        """
+        Renders a list of parts, returns an iterable of dicts with the name, filename and image
+        path of each part, and either its rendered 'content' or the 'error' that prevented it.
+        """
+        raise NotImplementedError
+
+    def report_skipped(self, result):
+        self.report.append(
+            "Skipped {element}({image}) because '{reason}'.".format(
+                element=result["name"], image=result["filename"], reason=result["error"]
+            )
+        )
 
 
 class TextExporter(BaseExporter):
     file_format = TEXT_FORMAT
     file_extension = "txt"
+    content_type = "text/plain; charset=utf-8"
 
-    def render(self):
+    def write(self, fh):
         region_filters = Block.get_filters(block_types=self.region_types, filtering_lines=True)
 
         LineTranscription = apps.get_model("core", "LineTranscription")
@@ -87,94 +204,216 @@ class TextExporter(BaseExporter):
             )
         )
         docid = None
-        with open(self.filepath, "w") as fh:
-            for trans in lines:
-                if trans.line.document_part.pk != docid:
-                    fh.write("--------------- %s (%s) ---------------\n" % (
-                        trans.line.document_part.title,
-                        trans.line.document_part.filename
-                    ))
-                    docid = trans.line.document_part.pk
-                fh.write("%s\n" % trans.content)
-            fh.close()
+        for trans in lines:
+            if trans.line.document_part.pk != docid:
+                if docid is not None:
+                    yield
+                fh.write(("--------------- %s (%s) ---------------\n" % (
+                    trans.line.document_part.title,
+                    trans.line.document_part.filename
+                )).encode("utf-8"))
+                docid = trans.line.document_part.pk
+            fh.write(("%s\n" % trans.content).encode("utf-8"))
+        yield
 
 
 class XMLTemplateExporter(BaseExporter):
     file_extension = "zip"
+    content_type = "application/zip"
 
-    def render(self):
-        tplt = loader.get_template(self.template_path)
-
+    def get_parts(self, part_pks):
+        """
+        Returns the given parts with their regions, lines and transcriptions, fetched in
+        a constant number of queries.
+        """
         DocumentPart = apps.get_model("core", "DocumentPart")
-        parts = DocumentPart.objects.filter(
-            document=self.document, pk__in=self.part_pks
+        Line = apps.get_model("core", "Line")
+
+        lines = Line.objects.prefetch_transcription(self.transcription).select_related("typology")
+        prefetches = [
+            Prefetch(
+                "blocks",
+                to_attr="export_blocks",
+                queryset=(
+                    Block.objects.filter(self.region_filters)
+                    .select_related("typology")
+                    .annotate(avglo=Avg("lines__order"))
+                    .order_by("avglo")
+                    .prefetch_related(Prefetch("lines", queryset=lines))
+                ),
+            )
+        ]
+        if self.include_orphans:
+            prefetches.append(
+                Prefetch("lines", to_attr="orphan_lines", queryset=lines.filter(block=None))
+            )
+        return DocumentPart.objects.filter(pk__in=part_pks).prefetch_related(*prefetches)
+
+    def fingerprint(self, qs, field, *fields):
+        """
+        Subquery hashing the given fields of the rows of qs related to a part through field.
+        """
+        values = []
+        for name in fields:
+            values += [Cast(name, TextField()), Value("|")]
+        return Subquery(
+            qs.filter(**{field: OuterRef("pk")})
+            .order_by()
+            .values(field)
+            .annotate(fp=MD5(StringAgg(Concat(*values, output_field=TextField()), delimiter="\n", ordering="pk")))
+            .values("fp")
         )
 
+    def get_template_sources(self):
+        """
+        Returns the file and modification time of the page template and of the templates it
+        includes, so that overriding or editing one of them invalidates the cached pages.
+        """
+        sources = {}
+        names = [self.template_path]
+        while names:
+            name = names.pop()
+            if name in sources:
+                continue
+            template = loader.get_template(name)
+            path = template.origin.name
+            sources[name] = (path, os.path.getmtime(path))
+            names += [
+                node.template.var for node in template.template.nodelist.get_nodes_by_type(IncludeNode)
+                if isinstance(node.template.var, str)
+            ]
+        return list(sources.values())
+
+    def get_cache_keys(self, part_pks):
+        """
+        Returns the part and the export cache key of each part pk, hashing everything its
+        rendered page depends on.
+        """
+        DocumentPart = apps.get_model("core", "DocumentPart")
+        Line = apps.get_model("core", "Line")
+        LineTranscription = apps.get_model("core", "LineTranscription")
+
+        parts = DocumentPart.objects.filter(pk__in=part_pks).annotate(
+            lines_fp=self.fingerprint(
+                Line.objects.all(), "document_part",
+                "pk", "order", "external_id", "block", "typology", "baseline", "mask"
+            ),
+            blocks_fp=self.fingerprint(
+                Block.objects.all(), "document_part",
+                "pk", "external_id", "typology", "box"
+            ),
+            transcriptions_fp=self.fingerprint(
+                LineTranscription.objects.filter(transcription=self.transcription), "line__document_part",
+                "line", "content", "avg_confidence"
+            ),
+        )
+        common = [
+            self.get_template_sources(),
+            settings.VERSION_DATE,
+            self.transcription.pk,
+            str(self.region_filters),
+            self.include_orphans,
+            [(t.pk, t.name) for t in self.valid_block_types],
+            [(t.pk, t.name) for t in self.valid_line_types],
+        ]
+        keys = {}
+        for part in parts:
+            key = common + [
+                part.pk, part.order, part.image.name, part.original_filename, part.source,
+                # a crop keeps the image name and doesn't touch the lines of an empty page
+                part.image.width, part.image.height,
+                part.created_at, part.updated_at,
+                part.lines_fp, part.blocks_fp, part.transcriptions_fp,
+            ]
+            keys[part.pk] = (part, hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest())
+        return keys
+
+    def render_chunk(self, part_pks):
+        tplt = loader.get_template(self.template_path)
+        all_part_pks = part_pks
+        keys, results = {}, {}
+        if export_cache.is_enabled():
+            for pk, (part, key) in self.get_cache_keys(part_pks).items():
+                content = export_cache.get_page(key, self.file_format)
+                if content is None:
+                    keys[pk] = key
+                else:
+                    results[pk] = {
+                        "name": part.name, "filename": part.filename, "image": part.image.path, "content": content
+                    }
+            part_pks = [pk for pk in part_pks if pk not in results]
+
+        for part in self.get_parts(part_pks):
+            result = {"name": part.name, "filename": part.filename, "image": part.image.path}
+            render_orphans = (
+                {}
+                if not self.include_orphans
+                else {"orphan_lines": part.orphan_lines}
+            )
+            try:
+                result["content"] = tplt.render(
+                    {
+                        "valid_block_types": self.valid_block_types,
+                        "valid_line_types": self.valid_line_types,
+                        "part": part,
+                        "blocks": part.export_blocks,
+                        **render_orphans,
+                    }
+                )
+            except Exception as e:
+                result["error"] = str(e)
+            else:
+                if part.pk in keys:
+                    export_cache.store_page(keys[part.pk], result["content"])
+            results[part.pk] = result
+        return [results[pk] for pk in all_part_pks if pk in results]
+
+    def write_page(self, zip_, filename, page):
+        # Remove empty lines from XML output while writing it to the archive.
+        segments = page.split("\n")
+        with zip_.open_entry(filename) as entry:
+            entry.write(segments[0].encode("utf-8"))
+            for index, segment in enumerate(segments[1:], start=2):
+                if index == len(segments) or segment.strip(" \t"):
+                    entry.write(("\n" + segment).encode("utf-8"))
+
+    def write(self, fh):
         # since this is filtering Blocks and not LineTranscriptions, it needs to handle orphans
         # separately
-        include_orphans = False
+        self.include_orphans = False
         if "Orphan" in self.region_types:
-            include_orphans = True
+            self.include_orphans = True
             self.region_types.remove("Orphan")
-        region_filters = Block.get_filters(block_types=self.region_types, filtering_lines=False)
+        self.region_filters = Block.get_filters(block_types=self.region_types, filtering_lines=False)
+
+        self.valid_block_types = list(self.document.valid_block_types.all())
+        self.valid_line_types = list(self.document.valid_line_types.all())
 
-        with EsZipFile(self.filepath, "w") as zip_:
+        with EsZipFile(fh, "w") as zip_:
             mets_elements = []
-            for index, part in enumerate(parts, start=1):
-                mets_element = {"id": index, "page": None, "image": None}
-
-                render_orphans = (
-                    {}
-                    if not include_orphans
-                    else {
-                        "orphan_lines": part.lines.prefetch_transcription(
-                            self.transcription
-                        ).filter(block=None)
-                    }
-                )
+            index = 0
+            for results in self.iter_rendered_chunks(self.get_part_chunks()):
+                for result in results:
+                    index += 1
+                    mets_element = {"id": index, "page": None, "image": None}
+
+                    if self.include_images:
+                        # Note adds image before the xml file
+                        zip_.write(result["image"], result["filename"])
+                        mets_element["image"] = result["filename"]
+
+                    if "error" in result:
+                        self.report_skipped(result)
+                    else:
+                        filename = "%s.xml" % os.path.splitext(result["filename"])[0]
+                        self.write_page(zip_, filename, result["content"])
+                        mets_element["page"] = filename
 
-                if self.include_images:
-                    # Note adds image before the xml file
-                    zip_.write(part.image.path, part.filename)
-                    mets_element["image"] = part.filename
-
-                try:
-                    Line = apps.get_model("core", "Line")
-                    page = tplt.render(
-                        {
-                            "valid_block_types": self.document.valid_block_types.all(),
-                            "valid_line_types": self.document.valid_line_types.all(),
-                            "part": part,
-                            "blocks": (
-                                part.blocks.filter(region_filters)
-                                .annotate(avglo=Avg("lines__order"))
-                                .order_by("avglo")
-                                .prefetch_related(
-                                    Prefetch(
-                                        "lines",
-                                        queryset=Line.objects.prefetch_transcription(
-                                            self.transcription
-                                        ),
-                                    )
-                                )
-                            ),
-                            **render_orphans,
-                        }
-                    )
-                    # Remove empty lines from XML output.
-                    page = re.sub(r'\n[ \t]*(?=\n)', '', page)
-                except Exception as e:
-                    self.report.append(
-                        "Skipped {element}({image}) because '{reason}'.".format(
-                            element=part.name, image=part.filename, reason=str(e)
-                        )
-                    )
-                else:
-                    filename = "%s.xml" % os.path.splitext(part.filename)[0]
-                    zip_.writestr(filename, page)
-                    mets_element["page"] = filename
+                    mets_elements.append(mets_element)
+                    yield
 
-                mets_elements.append(mets_element)
+            if export_cache.is_enabled():
+                export_cache.evict()
 
             # Adding METS file in the archive
             mets_template = loader.get_template("export/METS.xml")
@@ -197,67 +436,94 @@ class AltoExporter(XMLTemplateExporter):
 class OpenITIMARkdownExporter(BaseExporter):
     file_format = OPENITI_MARKDOWN_FORMAT
     file_extension = "zip"
-
-    def render_part_markdown(self, part, region_filters):
+    content_type = "application/zip"
+    tei_conversion = False
+
+    def get_part_chunks(self):
+        # all the lines of the export come from a single cursor unless they are spread over processes
+        chunks = super().get_part_chunks()
+        if self.processes > 1:
+            return chunks
+        return [[pk for chunk in chunks for pk in chunk]]
+
+    def iter_lines(self, part_pks):
+        """
+        Yields each part with its line transcriptions, fetched in one ordered query.
+        """
+        DocumentPart = apps.get_model("core", "DocumentPart")
         LineTranscription = apps.get_model("core", "LineTranscription")
+        lines = (
+            LineTranscription.objects.filter(
+                transcription=self.transcription,
+                line__document_part__pk__in=part_pks,
+            )
+            .filter(self.region_filters)
+            .exclude(content="")
+            .select_related("line")
+            .order_by("line__document_part__order", "line__document_part", "line__order", "line")
+            .iterator(chunk_size=2000)
+        )
+        trans = next(lines, None)
+        for part in DocumentPart.objects.filter(pk__in=part_pks).order_by("order", "pk"):
+            # parts without any selected line are exported too
+            part_lines = []
+            while trans is not None and trans.line.document_part_id == part.pk:
+                part_lines.append(trans)
+                trans = next(lines, None)
+            yield part, part_lines
+
+    def render_part_markdown(self, part, lines):
         return self.template.render(
             {
                 "version": settings.VERSION_DATE,
                 "part": part,
-                "lines": LineTranscription.objects.filter(
-                    transcription=self.transcription,
-                    line__document_part=part,
-                )
-                .filter(region_filters)
-                .exclude(content="")
-                .order_by("line__order"),
+                "lines": lines,
             }
         )
 
-    def render(self, tei_conversion=False):
+    def render_chunk(self, part_pks):
         self.template = loader.get_template("export/openiti_markdown.mARkdown")
+        for part, lines in self.iter_lines(part_pks):
+            result = {"name": part.name, "filename": part.filename, "image": part.image.path}
+            try:
+                markdown_content = self.render_part_markdown(part, lines)
 
-        DocumentPart = apps.get_model("core", "DocumentPart")
-        parts = DocumentPart.objects.filter(
-            document=self.document, pk__in=self.part_pks
-        )
-
-        region_filters = Block.get_filters(block_types=self.region_types, filtering_lines=True)
-
-        with EsZipFile(self.filepath, "w") as zip_:
-            for part in parts:
-                if self.include_images:
-                    # Note adds image before the mARkdown file
-                    zip_.write(part.image.path, part.filename)
-                try:
-                    markdown_content = self.render_part_markdown(part, region_filters)
-
-                    if tei_conversion:
-                        content = oitei.convert(markdown_content).tostring()
+                if self.tei_conversion:
+                    result["content"] = oitei.convert(markdown_content).tostring()
+                else:
+                    result["content"] = markdown_content
+            except Exception as e:
+                result["error"] = str(e)
+            yield result
+
+    def write(self, fh):
+        # the template is loaded by each process rendering parts
+        self.template = None
+        self.region_filters = Block.get_filters(block_types=self.region_types, filtering_lines=True)
+
+        with EsZipFile(fh, "w") as zip_:
+            for results in self.iter_rendered_chunks(self.get_part_chunks()):
+                for result in results:
+                    if self.include_images:
+                        # Note adds image before the mARkdown file
+                        zip_.write(result["image"], result["filename"])
+
+                    if "error" in result:
+                        self.report_skipped(result)
                     else:
-                        content = markdown_content
-
-                except Exception as e:
-                    self.report.append(
-                        "Skipped {element}({image}) because '{reason}'.".format(
-                            element=part.name, image=part.filename, reason=str(e)
+                        ext = "xml" if self.tei_conversion else "mARkdown"
+                        zip_.writestr(
+                            "%s.%s" % (os.path.splitext(result["filename"])[0], ext), result["content"]
                         )
-                    )
-                else:
-                    ext = "xml" if tei_conversion else "mARkdown"
-                    zip_.writestr(
-                        "%s.%s" % (os.path.splitext(part.filename)[0], ext), content
-                    )
+                    yield
 
             zip_.close()
 
 
 class TEIXMLExporter(OpenITIMARkdownExporter):
     file_format = TEI_XML_FORMAT
-
-    def render(self):
-        # We need an extra TEI conversion after the OpenITI mARkdown generation
-        super().render(tei_conversion=True)
+    # We need an extra TEI conversion after the OpenITI mARkdown generation
+    tei_conversion = True
 
 
 ENABLED_EXPORTERS = {
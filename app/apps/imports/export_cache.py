@@ -0,0 +1,87 @@
+"""
+On disk cache of the pages rendered by the XML exporters.
+
+Pages are stored under MEDIA_ROOT/export_cache, addressed by a key computed by the exporter
+from everything the rendered page depends on, re-exporting a document only renders the
+parts that changed since the previous export. The least recently used pages are evicted
+when the cache grows over settings.EXPORT_CACHE_SIZE Mb (0 disables it).
+"""
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+cache_hits = Counter('escriptorium_export_cache_hits_total',
+                     'Number of exported pages served from the cache.',
+                     ['format'])
+cache_misses = Counter('escriptorium_export_cache_misses_total',
+                       'Number of exported pages rendered.',
+                       ['format'])
+cache_evictions = Counter('escriptorium_export_cache_evictions_total',
+                          'Number of exported pages evicted from the cache.')
+
+
+def is_enabled():
+    return getattr(settings, 'EXPORT_CACHE_SIZE', 0) > 0
+
+
+def get_cache_dir():
+    return Path(settings.MEDIA_ROOT) / 'export_cache'
+
+
+def get_page_path(key):
+    return get_cache_dir() / key[:2] / f'{key}.xml'
+
+
+def get_page(key, file_format):
+    path = get_page_path(key)
+    try:
+        with open(path, 'r', encoding='utf-8') as fh:
+            content = fh.read()
+        # keeps track of the last use for the eviction
+        os.utime(path)
+    except FileNotFoundError:
+        cache_misses.labels(format=file_format).inc()
+        return None
+    cache_hits.labels(format=file_format).inc()
+    return content
+
+
+def store_page(key, content):
+    path = get_page_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # several processes can render the same page, only complete files are moved in place
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        fh.write(content)
+    os.replace(tmp_path, path)
+
+
+def evict():
+    """
+    Removes the least recently used pages until the cache fits in settings.EXPORT_CACHE_SIZE.
+    """
+    max_size = getattr(settings, 'EXPORT_CACHE_SIZE', 0) * 1024 * 1024
+    entries = []
+    for path in get_cache_dir().glob('*/*.xml'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # evicted concurrently
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _mtime, size, _path in entries)
+    for _mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        total -= size
+        cache_evictions.inc()
+    logger.debug('Export cache holds %d bytes.', total)
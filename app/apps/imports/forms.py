@@ -7,16 +7,19 @@ import requests
 from bootstrap.forms import BootstrapFormMixin
 from django import forms
 from django.conf import settings
+from django.core.exceptions import PermissionDenied
 from django.core.files.base import ContentFile
 from django.core.validators import FileExtensionValidator
+from django.http import StreamingHttpResponse
 from django.utils.translation import gettext as _
 
 from core.forms import RegionTypesFormMixin
-from core.models import DocumentPart, Transcription
+from core.models import DocumentPart, Line, Transcription
 from imports.export import ALTO_FORMAT, ENABLED_EXPORTERS
 from imports.models import DocumentImport
 from imports.parsers import ParseError, make_parser
 from imports.tasks import document_export, document_import
+from reporting.models import TaskReport
 from users.consumers import send_event
 
 
@@ -232,9 +235,66 @@ class ExportForm(RegionTypesFormMixin, BootstrapFormMixin, forms.Form):
 
         return super().clean()
 
-    def process(self):
+    def get_parts(self):
         # allow no parts = all parts
-        parts = self.cleaned_data['parts'] or self.document.parts.all()
+        return self.cleaned_data['parts'] or self.document.parts.all()
+
+    def is_streamable(self):
+        """
+        Small exports without images are sent in the response instead of going through a task.
+        """
+        if self.cleaned_data['include_images'] or not settings.EXPORT_STREAMING_MAX_LINES:
+            return False
+        nb_lines = Line.objects.filter(document_part__in=self.get_parts()).count()
+        return nb_lines <= settings.EXPORT_STREAMING_MAX_LINES
+
+    def stream(self):
+        # the export is rendered by this process instead of the task, enforce the same quota
+        if not settings.DISABLE_QUOTAS and self.user.cpu_minutes_limit() is not None:
+            if not self.user.has_free_cpu_minutes():
+                raise PermissionDenied(_("You don't have any CPU minutes left."))
+
+        file_format = self.cleaned_data['file_format']
+        report = TaskReport.objects.create(
+            user=self.user,
+            document=self.document,
+            label=_('Export %(document_name)s') % {'document_name': self.document.name},
+            method='imports.tasks.document_export',
+        )
+        exporter = ENABLED_EXPORTERS[file_format]["class"](
+            list(self.get_parts().values_list('pk', flat=True)),
+            list(self.cleaned_data['region_types']),
+            False,
+            self.user,
+            self.document,
+            report,
+            self.cleaned_data['transcription'],
+        )
+
+        def stream_content():
+            report.start()
+            try:
+                yield from exporter.stream()
+            except GeneratorExit:
+                # the client went away before the end of the file
+                report.error(_("The download was interrupted."))
+                raise
+            except Exception as e:
+                # the response already started, the client gets a truncated file
+                report.error(str(e))
+                raise
+            else:
+                report.end()
+            finally:
+                # rendered by a single request process
+                report.calc_cpu_cost(1)
+
+        response = StreamingHttpResponse(stream_content(), content_type=exporter.content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % exporter.filename
+        return response
+
+    def process(self):
+        parts = self.get_parts()
         file_format = self.cleaned_data['file_format']
         transcription = self.cleaned_data['transcription']
 
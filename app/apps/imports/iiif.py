@@ -0,0 +1,244 @@
+"""
+Concurrent download of the images of a IIIF manifest.
+
+Images are fetched by a few threads sharing a pooled requests.Session, the requests to a same
+host are spaced by settings.IIIF_IMPORT_HOST_DELAY seconds and postponed when the server
+answers with a Retry-After header. Results are yielded in the order of the urls, so that parts
+are created in the order of the canvases.
+
+When settings.IIIF_IMPORT_TARGET_WIDTH is set, the info.json of each image service is fetched
+(and cached) to request the smallest size at least that wide instead of the full image.
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = [500, 502, 503, 504, 507, 508]
+# image services rarely change, their description is kept for a day
+INFO_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+class DownloadError(Exception):
+    def __init__(self, message, url=None):
+        super().__init__(message)
+        self.url = url
+
+
+def get_service(resource):
+    """
+    Returns the image service of a canvas resource, raises KeyError or IndexError if it has none.
+    """
+    service = resource["service"]
+    if isinstance(service, list):
+        service = service[0]
+    if not (service.get("@id") or service.get("id")):
+        raise KeyError("@id")
+    return service
+
+
+def get_service_level(profile):
+    """
+    Returns the compliance level announced by a IIIF image service profile (any API version).
+    """
+    if isinstance(profile, list):
+        profile = profile[0] if profile else ""
+    match = re.search(r"level(\d)", str(profile or ""))
+    return int(match.group(1)) if match else 0
+
+
+def get_image_url(service, info=None, target_width=0):
+    """
+    Builds the url of the image of a service, with the smallest size advertised by its info.json
+    that is at least target_width wide, or target_width itself if the service can scale images.
+    """
+    service_id = service.get("@id") or service["id"]
+    version3 = "ImageService3" in str(service.get("type") or service.get("@type")) or "/3/" in str(
+        service.get("@context")
+    )
+    size = getattr(settings, "IIIF_IMPORT_QUALITY", "full")
+    if size == "full" and version3:
+        size = "max"
+
+    if isinstance(info, dict) and target_width and (info.get("width") or 0) > target_width:
+        sizes = [s for s in info.get("sizes") or [] if (s.get("width") or 0) >= target_width]
+        if sizes:
+            best = min(sizes, key=lambda s: s["width"])
+            # version 3 only accepts the exact advertised sizes from level 0 services
+            size = "%d,%d" % (best["width"], best["height"]) if version3 else "%d," % best["width"]
+        elif get_service_level(info.get("profile")) >= 1:
+            size = "%d," % target_width
+
+    uri_template = "{image}/{region}/{size}/{rotation}/{quality}.{format}"
+    return uri_template.format(
+        image=service_id,
+        region="full",
+        size=size,
+        rotation=0,
+        quality="default",
+        format="jpg",
+    )  # we could gain some time by fetching png, but it's not implemented everywhere.
+
+
+def parse_retry_after(value, default=1):
+    """
+    Returns the number of seconds to wait from a Retry-After header, given in seconds or as a date.
+    """
+    if value is None:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class HostRateLimiter:
+    """
+    Spaces the requests sent to each host by at least delay seconds.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.next_slot = defaultdict(float)
+
+    def wait(self, host):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot[host])
+            self.next_slot[host] = slot + self.delay
+        if slot > now:
+            time.sleep(slot - now)
+
+    def postpone(self, host, seconds):
+        with self.lock:
+            self.next_slot[host] = max(self.next_slot[host], time.monotonic() + seconds)
+
+
+class IIIFDownloader:
+    def __init__(self, workers=None, host_delay=None, retry_limit=4, timeout=10, target_width=None):
+        self.workers = workers or getattr(settings, 'IIIF_IMPORT_WORKERS', 4)
+        if target_width is None:
+            target_width = getattr(settings, 'IIIF_IMPORT_TARGET_WIDTH', 0)
+        self.target_width = target_width
+        if host_delay is None:
+            host_delay = getattr(settings, 'IIIF_IMPORT_HOST_DELAY', 0.1)
+        self.rate_limiter = HostRateLimiter(host_delay)
+        self.retry_limit = retry_limit
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url):
+        """Retrieve a iiif image from a iiif server
+
+        This method will retry on certain 5XX errors, network and timeout.
+        It will only retry a fixed number of times, and it backs off a little
+        more on each retry. Failure to retrieve the image within the retry limit
+        will result in a DownloadError being raised. All other unsuccessful
+        requests will raise a DownloadError as well.
+        """
+        host = urlparse(url).netloc
+        current_retry = 0
+        while current_retry < self.retry_limit:
+            current_retry = current_retry + 1
+            self.rate_limiter.wait(host)
+            try:
+                response = self.session.get(url, verify=False, timeout=self.timeout)
+                response.raise_for_status()
+                return response.content
+
+            except requests.exceptions.HTTPError as http_error:
+                status_code = http_error.response.status_code
+                if status_code == 429 or status_code in RETRY_STATUS_CODES:
+                    # the server might tell us when we are free to go, if not add a little backoff
+                    default = 1 if status_code == 429 else 0.1 * current_retry
+                    retry_after = parse_retry_after(http_error.response.headers.get('Retry-After'), default)
+                    self.rate_limiter.postpone(host, retry_after)
+                    continue
+
+                # We probably got a 4XX error, but whatever it is just raise it
+                raise DownloadError(http_error, url=url)
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                # network error or timeout, retry
+                self.rate_limiter.postpone(host, 0.1 * current_retry)
+                continue
+
+        # Max retries has been exceeded
+        raise DownloadError(f"After {current_retry} tries, the server still errors out loading"
+                            f": {url}", url=url)
+
+    def fetch_info(self, service):
+        """
+        Returns the info.json of an image service, or None if it can't be retrieved.
+        """
+        service_id = (service.get("@id") or service["id"]).rstrip("/")
+        key = "iiif-info-%s" % hashlib.md5(service_id.encode()).hexdigest()
+        info = cache.get(key)
+        if info is None:
+            try:
+                info = json.loads(self.fetch(service_id + "/info.json"))
+            except (DownloadError, ValueError) as e:
+                logger.warning("Couldn't retrieve the description of %s: %s", service_id, e)
+                return None
+            cache.set(key, info, INFO_CACHE_TIMEOUT)
+        return info
+
+    def fetch_image(self, service):
+        """
+        Returns the url and the content of the image of a service, with the size closest
+        to the target width if there is one.
+        """
+        info = self.fetch_info(service) if self.target_width else None
+        url = get_image_url(service, info, self.target_width)
+        return url, self.fetch(url)
+
+    def download(self, items, fetch=None):
+        """
+        Yields a (result, error) tuple for each item, in order, result being fetch(item) (by
+        default the content at the url item), while the next ones are downloaded in the background.
+        At most twice as many images as workers are kept in memory.
+        """
+        fetch = fetch or self.fetch
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = deque()
+        items = iter(items)
+        try:
+            for item in items:
+                pending.append(executor.submit(fetch, item))
+                if len(pending) >= self.workers * 2:
+                    break
+            while pending:
+                future = pending.popleft()
+                try:
+                    result = (future.result(), None)
+                except DownloadError as e:
+                    result = (None, e)
+                for item in items:
+                    pending.append(executor.submit(fetch, item))
+                    break
+                yield result
+        finally:
+            # the consumer may stop early, e.g. once the disk quota is reached
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.session.close()
@@ -53,6 +53,9 @@ class METSProcessor:
         self.url_validator = URLValidator()
 
     def retrieve_in_archive(self, filename):
+        if isinstance(self.archive, zipfile.ZipFile):
+            # reuse the central directory already read by the parser
+            return self.archive.open(filename)
         with zipfile.ZipFile(self.archive) as archive:
             return archive.open(filename)
 
@@ -2,18 +2,20 @@ import json
 import logging
 import os
 import re
-import time
 import uuid
 import zipfile
+from contextlib import closing
 from statistics import mean
 
 import pyvips
 import requests
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.validators import get_available_image_extensions
 from django.db import transaction
+from django.db.models import Max
 from django.forms import ValidationError
+from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 from easy_thumbnails.files import get_thumbnailer
@@ -29,7 +31,9 @@ from core.models import (
     Metadata,
     Transcription,
 )
+from imports.iiif import IIIFDownloader, get_image_url, get_service
 from imports.mets import METSProcessor
+from imports.pdf import rasterize
 from users.consumers import send_event
 from versioning.models import NoChangeException
 
@@ -46,10 +50,6 @@ class ParseError(Exception):
     pass
 
 
-class DownloadError(ParseError):
-    pass
-
-
 class ParserDocument:
     """
     The base class for parsing files to populate a core.Document object
@@ -85,6 +85,24 @@ class ParserDocument:
         # this is only called if the import went to completion.
         pass
 
+    def save_image(self, part, filename, fh):
+        """
+        Streams the image from fh to the storage of part in chunks, the CRC of archive members
+        is checked once they are fully read, a corrupted one raises a ParseError.
+        """
+        storage = part.image.storage
+        name = storage.get_available_name(
+            part.image.field.generate_filename(part, filename), max_length=part.image.field.max_length
+        )
+        part.image_file_size = 0
+        try:
+            part.image.save(filename, File(fh, name=filename))
+        except zipfile.BadZipFile as e:
+            # don't leave the part of the image written before the error behind
+            storage.delete(name)
+            raise ParseError(e.args[0])
+        part.image_file_size = part.image.size
+
     def post_process_image(self, part):
         # generate the card thumbnail right away to show the image card
         if getattr(settings, 'THUMBNAIL_ENABLE', True):
@@ -123,46 +141,47 @@ class PdfParser(ParserDocument):
             self.report
         ), "A TaskReport instance should be provided while parsing data."
 
-        buff = self.file.read()
-        doc = pyvips.Image.pdfload_buffer(buff, n=-1, access='sequential')
-        n_pages = doc.get('n-pages')
+        path = self.file.path
+        pdfname = os.path.basename(self.file.name)
+        page_nb = start_at
         try:
-            for page_nb in range(start_at, n_pages):
-                # If quotas are enforced, assert that the user still has free disk storage
-                if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
-                    raise DiskQuotaReachedError(
-                        _(f"You ran out of disk storage. {n_pages - page_nb} pages were left to import (over {n_pages - start_at})")
-                    )
+            n_pages = pyvips.Image.pdfload(path, access='sequential').get('n-pages')
+            page_nbs = range(start_at, n_pages)
+            # the pool of rendering processes is shut down if the import stops early
+            with closing(rasterize(path, page_nbs)) as pages:
+                for page_nb, (png, error) in zip(page_nbs, pages):
+                    if error is not None:
+                        raise pyvips.error.Error(error)
+
+                    # If quotas are enforced, assert that the user still has free disk storage
+                    if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
+                        raise DiskQuotaReachedError(
+                            _(f"You ran out of disk storage. {n_pages - page_nb} pages were left to import (over {n_pages - start_at})")
+                        )
 
-                page = pyvips.Image.pdfload_buffer(buff,
-                                                   page=page_nb,
-                                                   dpi=300,
-                                                   access='sequential')
-                pdfname = os.path.basename(self.file.name)
-                fname = '%s_page_%d.png' % (pdfname, page_nb + 1)
-                try:
-                    part = DocumentPart.objects.filter(
-                        document=self.document,
-                        original_filename=fname
-                    )[0]
-                except IndexError:
-                    # we do not use DoesNotExist because documents could have
-                    # duplicate image names at some point.
-                    part = DocumentPart(
-                        document=self.document,
-                        original_filename=fname
-                    )
+                    fname = '%s_page_%d.png' % (pdfname, page_nb + 1)
+                    try:
+                        part = DocumentPart.objects.filter(
+                            document=self.document,
+                            original_filename=fname
+                        )[0]
+                    except IndexError:
+                        # we do not use DoesNotExist because documents could have
+                        # duplicate image names at some point.
+                        part = DocumentPart(
+                            document=self.document,
+                            original_filename=fname
+                        )
 
-                part.image_file_size = 0
-                part.image.save(fname, ContentFile(page.write_to_buffer('.png')))
-                part.image_file_size = part.image.size
-                part.source = f"pdf//{pdfname}"
-                part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
-                part.save()
-                self.post_process_image(part)
+                    part.image_file_size = 0
+                    part.image.save(fname, ContentFile(png))
+                    part.image_file_size = part.image.size
+                    part.source = f"pdf//{pdfname}"
+                    part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
+                    part.save()
+                    self.post_process_image(part)
 
-                yield part
-                page_nb = page_nb + 1
+                    yield part
 
         except pyvips.error.Error as e:
             self.report.append(
@@ -184,31 +203,34 @@ class ZipParser(ParserDocument):
 
     DEFAULT_NAME = _("Zip Import")
 
+    @cached_property
+    def archive(self):
+        # the central directory is only read once, members are checked while they are extracted
+        return zipfile.ZipFile(self.file)
+
+    def close_archive(self):
+        archive = self.__dict__.pop("archive", None)
+        if archive is not None:
+            archive.close()
+
     def validate(self):
         try:
-            with zipfile.ZipFile(self.file) as zfh:
-                if zfh.testzip() is not None:
-                    raise ParseError(_("File appears to not be a valid zip."))
-                # for i,finfo in enumerate(zfh.infolist()):
-                #     with zfh.open(finfo) as zipedfh:
-                #         parser = make_parser(self.document, zipedfh)
-                #         parser.validate()
+            self.archive
         except Exception as e:
             logger.exception(e)
             raise ParseError(_("Zip file appears to be corrupted."))
 
     @property
     def total(self):
-        # TODO: we open the file twice on upload
-        with zipfile.ZipFile(self.file) as zfh:
-            return len(zfh.infolist())
+        return len(self.archive.infolist())
 
     def parse(self, start_at=0, override=False, user=None):
         assert (
             self.report
         ), "A TaskReport instance should be provided while parsing data."
 
-        with zipfile.ZipFile(self.file) as zfh:
+        zfh = self.archive
+        try:
             total = len(zfh.infolist())
             for index, finfo in enumerate(zfh.infolist()):
                 if index < start_at:
@@ -236,9 +258,7 @@ class ZipParser(ParserDocument):
                                     document=self.document,
                                     original_filename=filename
                                 )
-                            part.image_file_size = 0
-                            part.image.save(filename, ContentFile(zipedfh.read()))
-                            part.image_file_size = part.image.size
+                            self.save_image(part, filename, zipedfh)
                             part.source = "zip//{0}/{1}".format(
                                 os.path.basename(self.file.name),
                                 filename
@@ -267,6 +287,8 @@ class ZipParser(ParserDocument):
                         self.report.append(msg, logger_fct=logger.warning)
                         if user:
                             user.notify(msg, id="import:warning", level="warning")
+        finally:
+            self.close_archive()
 
     def clean(self):
         # if the import went well we are safe to delete the file
@@ -293,9 +315,7 @@ class METSBaseParser():
                 document=self.document,
                 original_filename=filename
             )
-        part.image_file_size = 0
-        part.image.save(filename, ContentFile(image.read()))
-        part.image_file_size = part.image.size
+        self.save_image(part, filename, image)
         part.source = source
         part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
         part.save()
@@ -416,8 +436,9 @@ class METSZipParser(ZipParser, METSBaseParser):
             self.report
         ), "A TaskReport instance should be provided while parsing data."
 
-        # Searching for the METS file in the archive
-        with zipfile.ZipFile(self.file) as archive:
+        archive = self.archive
+        try:
+            # Searching for the METS file in the archive
             total = len(archive.infolist())
             xml_filenames = [filename for filename in archive.namelist() if os.path.splitext(filename)[1][1:] == "xml"]
 
@@ -435,23 +456,22 @@ class METSZipParser(ZipParser, METSBaseParser):
                         mets_file_content = root
                         break
 
-        # If we didn't find a METS file in the archive after browsing everything, something is wrong
-        if mets_file_content is None:
-            raise ParseError(
-                "Couldn't find the METS file that should be there to define the archive."
-            )
+            # If we didn't find a METS file in the archive after browsing everything, something is wrong
+            if mets_file_content is None:
+                raise ParseError(
+                    "Couldn't find the METS file that should be there to define the archive."
+                )
 
-        # Retrieving all the pages described by the METS file
-        try:
-            mets_pages, metadata = METSProcessor(mets_file_content, report=self.report, archive=self.file).process()
-        except ParseError:
-            raise
-        except Exception as e:
-            raise ParseError(f"An error occurred during the processing of the METS file contained in the archive: {e}")
+            # Retrieving all the pages described by the METS file
+            try:
+                mets_pages, metadata = METSProcessor(mets_file_content, report=self.report, archive=archive).process()
+            except ParseError:
+                raise
+            except Exception as e:
+                raise ParseError(f"An error occurred during the processing of the METS file contained in the archive: {e}")
 
-        self.store_document_metadata(metadata)
+            self.store_document_metadata(metadata)
 
-        with zipfile.ZipFile(self.file) as archive:
             info_list = [info.filename for info in archive.infolist()]
 
             for index, mets_page in enumerate(mets_pages):
@@ -464,13 +484,27 @@ class METSZipParser(ZipParser, METSBaseParser):
                     with archive.open(mets_page.image) as zipped_image:
                         filename = os.path.basename(zipped_image.name)
                         image_source = "mets//{0}/{1}".format(os.path.basename(self.file.name), filename)
-                        part = self.parse_image(user, total, index, start_at, filename,
-                                                zipped_image, image_source)
-                        # If we have a page with an image + multiple sources, we don't want to
-                        # store the same metadata multiple times and spam the database for nothing
-                        if not metadata_already_stored:
-                            self.store_part_metadata(mets_page.metadata, part)
-                            metadata_already_stored = True
+                        try:
+                            part = self.parse_image(user, total, index, start_at, filename,
+                                                    zipped_image, image_source)
+                        except ParseError as e:
+                            # We let go to try other pages
+                            msg = _(
+                                "Parse error in {filename}: {xmlfile}: {error}, skipping it."
+                            ).format(
+                                filename=self.file.name,
+                                xmlfile=filename,
+                                error=e.args[0],
+                            )
+                            self.report.append(msg, logger_fct=logger.warning)
+                            if user:
+                                user.notify(msg, id="import:warning", level="warning")
+                        else:
+                            # If we have a page with an image + multiple sources, we don't want to
+                            # store the same metadata multiple times and spam the database for nothing
+                            if not metadata_already_stored:
+                                self.store_part_metadata(mets_page.metadata, part)
+                                metadata_already_stored = True
 
                 for index, (layer_name, source) in enumerate(mets_page.sources.items()):
                     if info_list.index(source) < start_at:
@@ -502,6 +536,8 @@ class METSZipParser(ZipParser, METSBaseParser):
                             self.report.append(msg, logger_fct=logger.warning)
                             if user:
                                 user.notify(msg, id="import:warning", level="warning")
+        finally:
+            self.close_archive()
 
     def clean(self):
         # if the import went well we are safe to delete the file
@@ -537,6 +573,9 @@ class XMLParser(ParserDocument):
         # instance attribute storing all line confidences, for computing the average at the end
         # of the import
         self.all_line_confidences = []
+        # block and line types by name, created on the fly
+        self.block_types = {}
+        self.line_types = {}
 
     def validate(self):
         if self.schema_location in self.ACCEPTED_SCHEMAS:
@@ -589,35 +628,207 @@ class XMLParser(ParserDocument):
     def get_transcription_content(self, lineTag):
         raise NotImplementedError
 
-    def make_transcription(self, line, lineTag, content, avg_confidence=None, user=None):
-        try:
-            # lazily creates the Transcription on the fly if need be cf transcription() property
-            lt = LineTranscription.objects.get(
-                transcription=self.transcription, line=line
-            )
-        except LineTranscription.DoesNotExist:
-            lt = LineTranscription(
-                version_source="import",
-                version_author=user and user.username or "",
-                transcription=self.transcription,
-                line=line,
-            )
-        else:
+    def get_block_type(self, name):
+        # types are looked up once per import
+        if name not in self.block_types:
+            typo, created = self.document.valid_block_types.get_or_create(name=name)
+            if created:
+                self.report.append(
+                    _("Block type {0} was automatically added to the ontology").format(typo.name)
+                )
+            self.block_types[name] = typo
+        return self.block_types[name]
+
+    def get_line_type(self, name):
+        if name not in self.line_types:
+            typo, created = self.document.valid_line_types.get_or_create(name=name)
+            if created:
+                self.report.append(
+                    _("Line type {0} was automatically added to the ontology").format(typo.name)
+                )
+            self.line_types[name] = typo
+        return self.line_types[name]
+
+    def make_transcription(self, lt, content, avg_confidence=None, user=None):
+        """
+        Sets the imported content of a LineTranscription, saving the current content
+        of an existing one in its history. Does not save it.
+        """
+        if lt.pk:
             try:
                 lt.new_version(author=user and user.username,
                                source='import')  # save current content in history
             except NoChangeException:
                 pass
-        finally:
-            lt.content = content
-            if avg_confidence:
-                lt.avg_confidence = avg_confidence
-            lt.save()
+            # bulk_update doesn't set auto_now fields
+            lt.version_updated_at = timezone.now()
+        lt.content = content
+        if avg_confidence:
+            lt.avg_confidence = avg_confidence
+
+    def parse_part(self, part, pageTag, override=False, user=None):
+        """
+        Imports the blocks, lines and transcriptions of a page in a part, existing objects are
+        matched by external_id and everything is written in bulk at the end.
+        Returns the number of blocks and lines found in the page.
+        """
+        if override:
+            part.lines.all().delete()
+            part.blocks.all().delete()
+
+        existing_blocks = {}
+        for block in Block.objects.filter(document_part=part).exclude(external_id=None).order_by('-pk'):
+            existing_blocks[block.external_id] = block
+        existing_lines = {}
+        for line in Line.objects.filter(document_part=part).exclude(external_id=None).order_by('-pk'):
+            existing_lines[line.external_id] = line
+        # only fetched once a line has content, not to create an empty transcription
+        existing_transcriptions = None
+        # new blocks and lines are appended after the existing ones, as OrderedModel.save does
+        orders = part.blocks.aggregate(max_order=Max('order'))['max_order']
+        next_block_order = 0 if orders is None else orders + 1
+        orders = part.lines.aggregate(max_order=Max('order'))['max_order']
+        next_line_order = 0 if orders is None else orders + 1
+
+        new_blocks, updated_blocks = [], []
+        new_lines, updated_lines = [], []
+        # ids of the lines in new_lines
+        pending_lines = set()
+        # LineTranscriptions to write, by id of their line
+        transcriptions = {}
+
+        # list to store all computed avg confidences for lines on this document part
+        part_line_confidences = []
+
+        blocks = self.get_blocks(pageTag)
+        n_blocks = len(blocks)
+        n_lines = 0
 
+        for block_id, blockTag in blocks:
+            if block_id and not block_id.startswith("eSc_dummyblock_"):
+                block = existing_blocks.get(block_id)
+                if block is None:
+                    # not found, create it then
+                    block = Block(document_part=part, external_id=block_id)
+                try:
+                    self.update_block(block, blockTag)
+                except TypeError:
+                    block = None
+                else:
+                    try:
+                        block.full_clean(exclude=['document_part', 'typology'], validate_unique=False)
+                    except ValidationError as e:
+                        self.report.append(
+                            _(
+                                "Block in '{filen}' line N°{line} was skipped because: {error}"
+                            ).format(
+                                filen=self.file.name,
+                                line=blockTag.sourceline,
+                                error=e,
+                            )
+                        )
+                        if not block.pk:
+                            block = None
+                    else:
+                        if block.pk:
+                            updated_blocks.append(block)
+                        elif block_id not in existing_blocks:
+                            block.order = next_block_order
+                            next_block_order += 1
+                            new_blocks.append(block)
+                        # the same id may be used again later in the file
+                        existing_blocks[block_id] = block
+            else:
+                block = None
+
+            lines = self.get_lines(blockTag)
+            n_lines += len(lines)
+
+            for line_id, lineTag in lines:
+                line = existing_lines.get(line_id) if line_id else None
+                if line is None:
+                    # not found, create it then
+                    line = Line(document_part=part, block=block, external_id=line_id)
+
+                self.update_line(line, lineTag)
+                try:
+                    line.full_clean(exclude=['document_part', 'block', 'typology'], validate_unique=False)
+                except ValidationError as e:
+                    self.report.append(
+                        _(
+                            "Line in '{filen}' line N°{line} (id: {lineid}) was skipped because: {error}"
+                        ).format(
+                            filen=self.file.name,
+                            line=blockTag.sourceline,
+                            lineid=line_id,
+                            error=e,
+                        )
+                    )
+                else:
+                    if line.pk:
+                        updated_lines.append(line)
+                    elif not (line_id and line_id in existing_lines):
+                        if line.external_id is None:
+                            line.make_external_id()
+                        line.order = next_line_order
+                        next_line_order += 1
+                        new_lines.append(line)
+                        pending_lines.add(id(line))
+                        if line_id:
+                            existing_lines[line_id] = line
+
+                tc = self.get_transcription_content(lineTag)
+                ac = self.get_avg_confidence(lineTag)
+                if ac:
+                    self.all_line_confidences.append(ac)
+                    part_line_confidences.append(ac)
+                # lines that couldn't be created don't get a transcription
+                if tc and (line.pk or id(line) in pending_lines):
+                    if existing_transcriptions is None:
+                        existing_transcriptions = {
+                            lt.line_id: lt
+                            for lt in LineTranscription.objects.filter(
+                                transcription=self.transcription, line__document_part=part
+                            )
+                        }
+                    lt = transcriptions.get(id(line))
+                    if lt is None and line.pk:
+                        lt = existing_transcriptions.get(line.pk)
+                    if lt is None:
+                        lt = LineTranscription(
+                            version_source="import",
+                            version_author=user and user.username or "",
+                            transcription=self.transcription,
+                            line=line,
+                        )
+                    self.make_transcription(lt, tc, avg_confidence=ac, user=user)
+                    transcriptions[id(line)] = lt
+
+        Block.objects.bulk_create(new_blocks)
+        Block.objects.bulk_update(set(updated_blocks), ['box', 'typology'])
+        Line.objects.bulk_create(new_lines)
+        Line.objects.bulk_update(set(updated_lines), ['baseline', 'mask', 'typology'])
+        transcriptions = list(transcriptions.values())
+        LineTranscription.objects.bulk_create([lt for lt in transcriptions if not lt.pk])
+        LineTranscription.objects.bulk_update(
+            [lt for lt in transcriptions if lt.pk],
+            ['content', 'avg_confidence', 'revision', 'versions', 'version_author',
+             'version_source', 'version_created_at', 'version_updated_at'],
+        )
+
+        if transcriptions:
             # update the avg confidence across the whole transcription
             if self.all_line_confidences:
-                lt.transcription.avg_confidence = mean(self.all_line_confidences)
-            lt.transcription.save()
+                self.transcription.avg_confidence = mean(self.all_line_confidences)
+            self.transcription.save()
+
+        if part_line_confidences:
+            # if applicable, store max avg confidence / best transcription on document part
+            part_avg_confidence = mean(part_line_confidences)
+            if not part.max_avg_confidence or part_avg_confidence > part.max_avg_confidence:
+                part.max_avg_confidence = part_avg_confidence
+
+        return n_blocks, n_lines
 
     def parse(self, start_at=0, override=False, user=None):
         assert (
@@ -645,93 +856,9 @@ class XMLParser(ParserDocument):
             else:
                 # if something fails, revert everything for this document part
                 with transaction.atomic():
-                    if override:
-                        part.lines.all().delete()
-                        part.blocks.all().delete()
-
-                    # list to store all computed avg confidences for lines on this document part
-                    part_line_confidences = []
-                    # store the max average confidence for comparison
-                    max_avg_confidence = part.max_avg_confidence
-
-                    blocks = self.get_blocks(pageTag)
-                    n_blocks += len(blocks)
-
-                    for block_id, blockTag in blocks:
-                        if block_id and not block_id.startswith("eSc_dummyblock_"):
-                            try:
-                                block = Block.objects.get(document_part=part, external_id=block_id)
-                            except Block.DoesNotExist:
-                                # not found, create it then
-                                block = Block(document_part=part, external_id=block_id)
-                            try:
-                                self.update_block(block, blockTag)
-                            except TypeError:
-                                block = None
-                            else:
-                                try:
-                                    block.full_clean()
-                                except ValidationError as e:
-                                    self.report.append(
-                                        _(
-                                            "Block in '{filen}' line N°{line} was skipped because: {error}"
-                                        ).format(
-                                            filen=self.file.name,
-                                            line=blockTag.sourceline,
-                                            error=e,
-                                        )
-                                    )
-                                else:
-                                    block.save()
-                        else:
-                            block = None
-
-                        lines = self.get_lines(blockTag)
-                        n_lines += len(lines)
-
-                        for line_id, lineTag in lines:
-                            if line_id:
-                                try:
-                                    line = Line.objects.get(document_part=part, external_id=line_id)
-                                except Line.DoesNotExist:
-                                    line = None
-                            else:
-                                line = None
-
-                            if line is None:
-                                # not found, create it then
-                                line = Line(document_part=part, block=block, external_id=line_id)
-
-                            self.update_line(line, lineTag)
-                            try:
-                                line.full_clean()
-                            except ValidationError as e:
-                                self.report.append(
-                                    _(
-                                        "Line in '{filen}' line N°{line} (id: {lineid}) was skipped because: {error}"
-                                    ).format(
-                                        filen=self.file.name,
-                                        line=blockTag.sourceline,
-                                        lineid=line_id,
-                                        error=e,
-                                    )
-                                )
-                            else:
-                                line.save()
-
-                            # needs to be done after line is created!
-                            tc = self.get_transcription_content(lineTag)
-                            ac = self.get_avg_confidence(lineTag)
-                            if ac:
-                                self.all_line_confidences.append(ac)
-                                part_line_confidences.append(ac)
-                            if tc:
-                                self.make_transcription(line, lineTag, tc, avg_confidence=ac, user=user)
-                    if part_line_confidences:
-                        # if applicable, store max avg confidence / best transcription on document part
-                        part_avg_confidence = mean(part_line_confidences)
-                        if not max_avg_confidence or (max_avg_confidence and part_avg_confidence > max_avg_confidence):
-                            part.max_avg_confidence = part_avg_confidence
+                    part_blocks, part_lines = self.parse_part(part, pageTag, override=override, user=user)
+                n_blocks += part_blocks
+                n_lines += part_lines
 
                 # TODO: store glyphs too
                 logger.info("Uncompressed and parsed %s (%i page(s), %i block(s), %i line(s))" % (self.file.name, n_pages, n_blocks, n_lines))
@@ -803,12 +930,7 @@ The ALTO file should contain a Description/sourceImageInformation/fileName tag f
             type_ = None
 
         if type_:
-            typo, created = self.document.valid_block_types.get_or_create(name=type_)
-            block.typology = typo
-            if created:
-                self.report.append(
-                    _("Block type {0} was automatically added to the ontology").format(typo.name)
-                )
+            block.typology = self.get_block_type(type_)
 
     def update_line(self, line, lineTag):
         baseline = lineTag.get("BASELINE")
@@ -866,12 +988,7 @@ The ALTO file should contain a Description/sourceImageInformation/fileName tag f
             type_ = None
 
         if type_:
-            typo, created = self.document.valid_line_types.get_or_create(name=type_)
-            line.typology = typo
-            if created:
-                self.report.append(
-                    _("Line type {0} was automatically added to the ontology").format(typo.name)
-                )
+            line.typology = self.get_line_type(type_)
 
     def get_transcription_content(self, lineTag):
         return " ".join(
@@ -936,12 +1053,7 @@ The PAGE file should contain an attribute imageFilename in Page tag for matching
                     type_ = match.groups()[0]
 
         if type_:
-            typo, created = self.document.valid_block_types.get_or_create(name=type_)
-            block.typology = typo
-            if created:
-                self.report.append(
-                    _("Block type {0} was automatically added to the ontology").format(typo.name)
-                )
+            block.typology = self.get_block_type(type_)
 
     def update_line(self, line, lineTag):
         try:
@@ -974,12 +1086,7 @@ The PAGE file should contain an attribute imageFilename in Page tag for matching
                     type_ = match.groups()[0]
 
         if type_:
-            typo, created = self.document.valid_line_types.get_or_create(name=type_)
-            line.typology = typo
-            if created:
-                self.report.append(
-                    _("Line type {0} was automatically added to the ontology").format(typo.name)
-                )
+            line.typology = self.get_line_type(type_)
 
     def clean_coords(self, coordTag):
         try:
@@ -1044,53 +1151,6 @@ class IIIFManifestParser(ParserDocument):
     def total(self):
         return len(self.canvases)
 
-    @staticmethod
-    def get_image(url: str, retry_limit: int = 4) -> requests.Response:
-        """Retrieve a iiif image from a iiif server
-
-        This method will retry on certain 5XX errors, network and timeout.
-        It will only retry a fixed number of times (default 3),
-        and it backs off a little more on each retry. Failure to retrieve
-        the image within the retry limit will result in a DownloadError
-        being raised. All other unsuccessful requests will raise a
-        DownloadError as well.
-        """
-
-        current_retry = 0
-        while current_retry < retry_limit:
-            current_retry = current_retry + 1
-            time.sleep(0.1 * current_retry)  # avoid being throttled; add a little backoff
-            try:
-                response = requests.get(url, stream=True, verify=False, timeout=10)
-                response.raise_for_status()
-                return response
-
-            except requests.exceptions.HTTPError as http_error:
-                # retry on transient 5XX errors, but keep a record of the retry count
-                if http_error.response.status_code in [500, 502, 503, 504, 507, 508]:
-                    continue
-
-                if http_error.response.status_code == 429:
-                    # the server might tell us when we are free to go, if not let's wait 1s
-                    sleep_time = http_error.response.headers.get('Retry-After', 1)
-                    time.sleep(sleep_time)
-                    continue
-
-                # We probably got a 4XX error, but whatever it is just raise it
-                raise DownloadError(http_error)
-
-            except requests.exceptions.ConnectionError:
-                # network error, retry
-                continue
-
-            except requests.exceptions.Timeout:
-                # timeout, retry
-                continue
-
-        # Max retries has been exceeded
-        raise DownloadError(f"After {current_retry} tries, the server still errors out loading"
-                            f": {url}")
-
     def parse(self, start_at=0, override=False, user=None):
         assert (
             self.report
@@ -1108,30 +1168,44 @@ class IIIFManifestParser(ParserDocument):
             pass
 
         total = len(self.canvases)
+        images = []
         for i, canvas in enumerate(self.canvases):
             if i < start_at:
                 continue
-
-            # If quotas are enforced, assert that the user still has free disk storage
-            if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
-                raise DiskQuotaReachedError(
-                    _(f"You ran out of disk storage. {total - i} canvases were left to import (over {total - start_at})")
-                )
-
             try:
                 resource = canvas["images"][0]["resource"]
-                uri_template = "{image}/{region}/{size}/{rotation}/{quality}.{format}"
-                url = uri_template.format(
-                    image=resource["service"]["@id"],
-                    region="full",
-                    size=getattr(settings, "IIIF_IMPORT_QUALITY", "full"),
-                    rotation=0,
-                    quality="default",
-                    format="jpg",
-                )  # we could gain some time by fetching png, but it's not implemented everywhere.
-                # TODO, we should probably grab the iiif image manifest, it will tell
-                # us important things about the supported file types and the available sizing.
-                r = self.get_image(url)
+                images.append((i, resource, get_service(resource)))
+            except (KeyError, IndexError) as e:
+                self.report.append(
+                    _("Error while fetching {filename}: {error}").format(
+                        filename=canvas.get("@id", i) if isinstance(canvas, dict) else i, error=e
+                    )
+                )
+
+        # images are downloaded in the background while the parts are created in order
+        downloader = IIIFDownloader()
+        downloads = downloader.download((service for i, resource, service in images), fetch=downloader.fetch_image)
+        try:
+            for (i, resource, service), (image, error) in zip(images, downloads):
+                # If quotas are enforced, assert that the user still has free disk storage
+                if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
+                    raise DiskQuotaReachedError(
+                        _(f"You ran out of disk storage. {total - i} canvases were left to import (over {total - start_at})")
+                    )
+
+                url, content = image if error is None else (error.url or get_image_url(service), None)
+                # iiif file names are always default.jpg or close to
+                name = "%d_%s_%s" % (i, uuid.uuid4().hex[:5], url.split("/")[-1])
+                if error is not None:
+                    self.report.append(
+                        _("Error while fetching {filename}: {error}").format(
+                            filename=name, error=error
+                        )
+                    )
+                    error_msg = f"Could not download image: {url}"
+                    user.notify(error_msg, level="warning", id="import:warning")
+                    self.report.append(error_msg)
+                    continue
 
                 try:
                     part = DocumentPart.objects.filter(
@@ -1145,28 +1219,16 @@ class IIIFManifestParser(ParserDocument):
                         source=url)
                 if "label" in resource:
                     part.name = resource["label"]
-                # iiif file names are always default.jpg or close to
-                name = "%d_%s_%s" % (i, uuid.uuid4().hex[:5], url.split("/")[-1])
                 part.original_filename = name
                 part.image_file_size = 0
-                part.image.save(name, ContentFile(r.content), save=False)
+                part.image.save(name, ContentFile(content), save=False)
                 part.image_file_size = part.image.size
                 part.save()
                 self.post_process_image(part)
 
                 yield part
-                time.sleep(0.1)  # avoid being throttled
-
-            except (KeyError, IndexError, DownloadError) as e:
-                self.report.append(
-                    _("Error while fetching {filename}: {error}").format(
-                        filename=name, error=e
-                    )
-                )
-                if isinstance(e, DownloadError):
-                    error_msg = f"Could not download image: {url}"
-                    user.notify(error_msg, level="warning", id="import:warning")
-                    self.report.append(error_msg)
+        finally:
+            downloads.close()
 
 
 class TranskribusPageXmlParser(PagexmlParser):
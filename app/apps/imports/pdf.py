@@ -0,0 +1,56 @@
+"""
+Rasterization of the pages of a PDF import.
+
+Pages are loaded straight from the uploaded file, which poppler maps instead of the whole
+document being read in memory and parsed again for every page, and are rendered and encoded
+to PNG by a pool of settings.PDF_IMPORT_PROCESSES processes. Results are yielded in page order.
+"""
+from collections import deque
+from multiprocessing import current_process, get_context
+
+import pyvips
+from django.conf import settings
+
+PDF_IMPORT_DPI = 300
+
+
+def render_page(path, page_nb, dpi=PDF_IMPORT_DPI):
+    """
+    Returns a (png, error) tuple for the page page_nb of the pdf at path,
+    error being the message of the libvips error that prevented its rendering.
+    """
+    try:
+        page = pyvips.Image.pdfload(path, page=page_nb, dpi=dpi, access='sequential')
+        return page.write_to_buffer('.png'), None
+    except pyvips.error.Error as e:
+        return None, e.args[0]
+
+
+def rasterize(path, pages, processes=None):
+    """
+    Yields the result of render_page for every page number of pages, in order, while the next
+    ones are rendered in the background. At most twice as many pages as processes are kept in memory.
+    """
+    if processes is None:
+        processes = getattr(settings, 'PDF_IMPORT_PROCESSES', 0)
+    if processes <= 1:
+        for page_nb in pages:
+            yield render_page(path, page_nb)
+        return
+
+    # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
+    current_process().daemon = False
+    # libvips can't be used in a forked child once its threads are started, workers start afresh
+    with get_context("spawn").Pool(processes) as pool:
+        pending = deque()
+        pages = iter(pages)
+        for page_nb in pages:
+            pending.append(pool.apply_async(render_page, (path, page_nb)))
+            if len(pending) >= processes * 2:
+                break
+        while pending:
+            result = pending.popleft().get()
+            for page_nb in pages:
+                pending.append(pool.apply_async(render_page, (path, page_nb)))
+                break
+            yield result
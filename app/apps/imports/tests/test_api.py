@@ -1,9 +1,12 @@
+import io
 import os.path
+import zipfile
 from unittest import mock
 
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
+from django.test import override_settings
 from django.urls import reverse
 
 from core.models import (
@@ -81,7 +84,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_single.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(62):
+            with self.assertNumQueries(43):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -105,7 +108,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_single_baselines.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(46):
+            with self.assertNumQueries(43):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -129,7 +132,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test.zip'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(81):
+            with self.assertNumQueries(59):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -154,7 +157,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_composedblock.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(88):
+            with self.assertNumQueries(57):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -351,7 +354,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_pagexml.zip'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(418):  # there's a lot of lines in there
+            with self.assertNumQueries(57):  # there's a lot of lines in there
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -383,7 +386,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_pagexml_types.xml'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(94):
+            with self.assertNumQueries(58):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -440,7 +443,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         with open(mock_path, 'rb') as fh:
             # mock the image grabbing
             mock_resp = mock.Mock(content=fh.read(), status_code=200)
-            with mock.patch('requests.get', return_value=mock_resp):
+            with mock.patch('requests.Session.get', return_value=mock_resp):
                 for part in imp.process():  # exhaust the generator
                     pass
 
@@ -480,7 +483,8 @@ class ImportEndpointTestCase(CoreFactoryTestCase):
         # Note image grabbing get mocked with the same .json file but it doesn't matter
         with open(mock_iiif, 'rb') as fh:
             mock_resp = mock.Mock(content=fh.read(), status_code=200)
-            with mock.patch('requests.get', return_value=mock_resp):
+            with mock.patch('requests.get', return_value=mock_resp), \
+                    mock.patch('requests.Session.get', return_value=mock_resp):
                 with mock.patch('imports.parsers.ParserDocument.post_process_image'):
                     uri = reverse('api:import-list', kwargs={'document_pk': self.doc.pk})
                     resp = self.client.post(uri, {
@@ -606,7 +610,7 @@ class DocumentExportTestCase(CoreFactoryTestCase):
 
     def test_alto(self):
         self.client.force_login(self.user)
-        with self.assertNumQueries(32):
+        with self.assertNumQueries(28):
             response = self.client.post(reverse('api:document-export',
                                                 kwargs={'pk': self.trans.document.pk}),
                                         {'transcription': self.trans.pk,
@@ -631,7 +635,7 @@ class DocumentExportTestCase(CoreFactoryTestCase):
                     transcription=self.trans,
                     content='line %d:%d' % (i, j))
         self.client.force_login(self.user)
-        with self.assertNumQueries(32):
+        with self.assertNumQueries(28):
             response = self.client.post(reverse('api:document-export',
                                                 kwargs={'pk': self.trans.document.pk}),
                                         {'transcription': self.trans.pk,
@@ -640,6 +644,65 @@ class DocumentExportTestCase(CoreFactoryTestCase):
                                          'region_types': self.region_types_choices})
             self.assertEqual(response.status_code, 200)
 
+    def test_stream_text(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('api:document-stream-export',
+                                            kwargs={'pk': self.trans.document.pk}),
+                                    {'transcription': self.trans.pk,
+                                     'file_format': 'text',
+                                     'parts': [str(p.pk) for p in self.parts],
+                                     'region_types': self.region_types_choices})
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual([line for line in content.splitlines() if not line.startswith('---')],
+                         ["line 1:1", "line 1:2", "line 1:3", "line 2:1", "line 2:2", "line 2:3"])
+        report = TaskReport.objects.get()
+        self.assertEqual(report.workflow_state, TaskReport.WORKFLOW_STATE_DONE)
+        self.assertIsNotNone(report.cpu_cost)
+
+    def test_stream_interrupted(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('api:document-stream-export',
+                                            kwargs={'pk': self.trans.document.pk}),
+                                    {'transcription': self.trans.pk,
+                                     'file_format': 'text',
+                                     'parts': [str(p.pk) for p in self.parts],
+                                     'region_types': self.region_types_choices})
+        self.assertEqual(response.status_code, 200)
+        next(iter(response.streaming_content))
+        # the client disconnects
+        response.close()
+        report = TaskReport.objects.get()
+        self.assertEqual(report.workflow_state, TaskReport.WORKFLOW_STATE_ERROR)
+        self.assertIsNotNone(report.cpu_cost)
+
+    def test_stream_alto(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('api:document-stream-export',
+                                            kwargs={'pk': self.trans.document.pk}),
+                                    {'transcription': self.trans.pk,
+                                     'file_format': 'alto',
+                                     'parts': [str(p.pk) for p in self.parts],
+                                     'region_types': self.region_types_choices})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(len(archive.namelist()), 3)
+        self.assertIn('METS.xml', archive.namelist())
+
+    @override_settings(EXPORT_STREAMING_MAX_LINES=5)
+    def test_stream_too_large(self):
+        self.client.force_login(self.user)
+        with mock.patch('imports.forms.document_export.delay') as delay:
+            response = self.client.post(reverse('api:document-stream-export',
+                                                kwargs={'pk': self.trans.document.pk}),
+                                        {'transcription': self.trans.pk,
+                                         'file_format': 'alto',
+                                         'parts': [str(p.pk) for p in self.parts],
+                                         'region_types': self.region_types_choices})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(delay.call_count, 1)
+
     def test_invalid(self):
         self.client.force_login(self.user)
         # invalid file format
@@ -4,12 +4,15 @@ import shutil
 from unittest.mock import patch
 from zipfile import ZipFile
 
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from lxml import etree
 
 from core.models import Block, BlockType, DocumentPart, Line, LineTranscription
 from core.tests.factory import CoreFactoryTestCase
 from escriptorium.test_settings import MEDIA_ROOT
+from imports import export_cache
 from imports.export import (
     AltoExporter,
     OpenITIMARkdownExporter,
@@ -331,6 +334,63 @@ class ExportersTestCase(CoreFactoryTestCase):
                 "mets_without_images.xml"
             ))
 
+    @override_settings(EXPORT_PROCESSES=2)
+    def test_alto_exporter_render_parallel(self, timezone_mock):
+        exporter = AltoExporter(
+            self.all_parts_pks,
+            self.all_regions_types,
+            self.include_images,
+            *self.params,
+        )
+        exporter.render()
+
+        with ZipFile(exporter.filepath, "r") as archive:
+            self.assertListEqual(
+                archive.namelist(),
+                [self.part_xml_export_filename, self.part2_xml_export_filename, "METS.xml"],
+            )
+            self.assertEqual(*format_xml_contents(
+                archive.read(self.part_xml_export_filename),
+                "alto_export_full_part1.xml"
+            ))
+            self.assertEqual(*format_xml_contents(
+                archive.read(self.part2_xml_export_filename),
+                "alto_export_full_part2.xml"
+            ))
+
+    @override_settings(EXPORT_CACHE_SIZE=10)
+    def test_alto_exporter_render_cached(self, timezone_mock):
+        exporter = AltoExporter(
+            self.all_parts_pks, self.all_regions_types, self.include_images, *self.params
+        )
+        exporter.render()
+        self.assertEqual(len(list(export_cache.get_cache_dir().glob("*/*.xml"))), 2)
+
+        # only the modified part is rendered again
+        LineTranscription.objects.filter(line__document_part=self.part2).update(content="changed")
+        exporter = AltoExporter(
+            self.all_parts_pks, self.all_regions_types, self.include_images, *self.params
+        )
+        with patch.object(exporter, "get_parts", wraps=exporter.get_parts) as get_parts:
+            exporter.render()
+            get_parts.assert_called_once_with([self.part2.pk])
+
+        with ZipFile(exporter.filepath, "r") as archive:
+            self.assertEqual(*format_xml_contents(
+                archive.read(self.part_xml_export_filename),
+                "alto_export_full_part1.xml"
+            ))
+            self.assertIn(b'CONTENT="changed"', archive.read(self.part2_xml_export_filename))
+
+    def test_alto_exporter_cache_template_sources(self, timezone_mock):
+        exporter = AltoExporter(
+            self.all_parts_pks, self.all_regions_types, self.include_images, *self.params
+        )
+        self.assertListEqual(
+            [os.path.basename(path) for path, _mtime in exporter.get_template_sources()],
+            ["alto.xml", "alto_line.xml"],
+        )
+
     def test_alto_exporter_render_only_one_part(self, timezone_mock):
         parts_pk = [self.part.pk]
         exporter = AltoExporter(
@@ -434,6 +494,24 @@ class ExportersTestCase(CoreFactoryTestCase):
             )
 
     @override_settings(VERSION_DATE="1.0.0-testing")
+    def test_openiti_markdown_exporter_queries(self, timezone_mock):
+        exporter = OpenITIMARkdownExporter(
+            self.all_parts_pks, self.all_regions_types, self.include_images, *self.params
+        )
+        with CaptureQueriesContext(connection) as context:
+            exporter.render()
+        nb_queries = len(context.captured_queries)
+
+        part_pks = self.all_parts_pks + [
+            self.factory.make_part(document=self.params[1]).pk for _ in range(3)
+        ]
+        exporter = OpenITIMARkdownExporter(
+            part_pks, self.all_regions_types, self.include_images, *self.params
+        )
+        with CaptureQueriesContext(connection) as context:
+            exporter.render()
+        self.assertEqual(len(context.captured_queries), nb_queries)
+
     def test_openiti_markdown_exporter_render_only_one_part(self, timezone_mock):
         parts_pk = [self.part.pk]
         exporter = OpenITIMARkdownExporter(
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.test import SimpleTestCase
+
+from imports.iiif import (
+    DownloadError,
+    IIIFDownloader,
+    get_image_url,
+    parse_retry_after,
+)
+
+INFO = {
+    "@context": "http://iiif.io/api/image/2/context.json",
+    "width": 6000,
+    "height": 8000,
+    "profile": ["http://iiif.io/api/image/2/level0.json"],
+    "sizes": [
+        {"width": 750, "height": 1000},
+        {"width": 1500, "height": 2000},
+        {"width": 3000, "height": 4000},
+    ],
+}
+
+
+class ImageServerHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in IIIF image server, /<n>/full/full/0/default.jpg answers 'image <n>'.
+    """
+    throttled = set()
+
+    def do_GET(self):
+        if self.path.endswith("/info.json"):
+            body = json.dumps(INFO).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        n = int(self.path.split("/")[1])
+        if n == 3:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if n == 2 and n not in self.throttled:
+            self.throttled.add(n)
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        # the first images are the slowest to come back
+        time.sleep(0.05 * max(0, 4 - n))
+        body = f"image {n}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class IIIFDownloaderTestCase(SimpleTestCase):
+    def setUp(self):
+        ImageServerHandler.throttled = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageServerHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download_in_order(self):
+        urls = [f"{self.base_url}/{n}/full/full/0/default.jpg" for n in range(8)]
+        results = list(IIIFDownloader(workers=3, host_delay=0).download(urls))
+
+        self.assertEqual(len(results), 8)
+        for n, (content, error) in enumerate(results):
+            if n == 3:
+                self.assertIsNone(content)
+                self.assertIsInstance(error, DownloadError)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual(content, f"image {n}".encode())
+        # the throttled image was fetched again
+        self.assertEqual(ImageServerHandler.throttled, {2})
+
+    def test_stop_early(self):
+        urls = [f"{self.base_url}/{n}/full/full/0/default.jpg" for n in range(100)]
+        downloads = IIIFDownloader(workers=2, host_delay=0).download(urls)
+        self.assertEqual(next(downloads), (b"image 0", None))
+        downloads.close()
+
+    def test_fetch_image_size(self):
+        downloader = IIIFDownloader(workers=1, host_delay=0, target_width=1000)
+        url, content = downloader.fetch_image({"@id": f"{self.base_url}/5"})
+        self.assertEqual(url, f"{self.base_url}/5/full/1500,/0/default.jpg")
+        self.assertEqual(content, b"image 5")
+
+    def test_get_image_url(self):
+        service = {"@id": "https://iiif.test/img"}
+        self.assertEqual(get_image_url(service), "https://iiif.test/img/full/full/0/default.jpg")
+        # no info or image smaller than the target
+        self.assertEqual(get_image_url(service, None, 1000), "https://iiif.test/img/full/full/0/default.jpg")
+        self.assertEqual(get_image_url(service, INFO, 7000), "https://iiif.test/img/full/full/0/default.jpg")
+        self.assertEqual(get_image_url(service, INFO, 750), "https://iiif.test/img/full/750,/0/default.jpg")
+        # no size large enough, a level 0 service can't scale the image
+        info = dict(INFO, sizes=[{"width": 100, "height": 133}])
+        self.assertEqual(get_image_url(service, info, 1000), "https://iiif.test/img/full/full/0/default.jpg")
+        info["profile"] = ["http://iiif.io/api/image/2/level1.json"]
+        self.assertEqual(get_image_url(service, info, 1000), "https://iiif.test/img/full/1000,/0/default.jpg")
+        # version 3 services use max and exact sizes
+        service3 = {"id": "https://iiif.test/img", "type": "ImageService3"}
+        self.assertEqual(get_image_url(service3), "https://iiif.test/img/full/max/0/default.jpg")
+        self.assertEqual(get_image_url(service3, INFO, 1000), "https://iiif.test/img/full/1500,2000/0/default.jpg")
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after(None), 1)
+        self.assertEqual(parse_retry_after("3"), 3)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertEqual(parse_retry_after("soon", default=2), 2)
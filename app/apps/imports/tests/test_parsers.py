@@ -1,8 +1,12 @@
 import os
+from io import BytesIO
 from unittest.mock import Mock, patch
-from zipfile import ZipFile
+from zipfile import ZIP_STORED, ZipFile
 
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from lxml import etree
+from PIL import Image
 from requests.exceptions import RequestException
 
 from core.models import (
@@ -14,7 +18,12 @@ from core.models import (
     Metadata,
 )
 from core.tests.factory import CoreFactoryTestCase
-from imports.parsers import METSRemoteParser, METSZipParser, ParseError
+from imports.parsers import (
+    METSRemoteParser,
+    METSZipParser,
+    ParseError,
+    ZipParser,
+)
 from reporting.models import TaskReport
 
 SAMPLES_DIR = os.path.join(
@@ -24,6 +33,23 @@ SAMPLES_DIR = os.path.join(
 
 PFX = "{http://www.loc.gov/METS/}"
 
+METS_ARCHIVE = """<mets xmlns="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <fileSec>
+    <fileGrp USE="image">
+      <file ID="image1"><FLocat xlink:href="page1.png"/></file>
+      <file ID="image2"><FLocat xlink:href="page2.png"/></file>
+      <file ID="image3"><FLocat xlink:href="page3.png"/></file>
+    </fileGrp>
+  </fileSec>
+  <structMap TYPE="physical">
+    <div TYPE="document">
+      <div TYPE="page"><fptr FILEID="image1"/></div>
+      <div TYPE="page"><fptr FILEID="image2"/></div>
+      <div TYPE="page"><fptr FILEID="image3"/></div>
+    </div>
+  </structMap>
+</mets>"""
+
 
 def mocked_get(uri):
     with ZipFile(SAMPLES_DIR + "/complex_archive.zip") as archive:
@@ -262,3 +288,82 @@ class METSZipParserTestCase(CoreFactoryTestCase):
         self.assertEqual(Block.objects.count(), 17)
         self.assertEqual(Line.objects.count(), 66)
         self.assertEqual(LineTranscription.objects.count(), 129)
+
+
+class ZipParserTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = self.factory.make_user()
+        self.document = self.factory.make_document()
+        self.report = TaskReport.objects.create(
+            user=self.user,
+            label="Import from an archive",
+            document=self.document,
+            method="imports.tasks.document_import",
+        )
+
+    def make_archive(self, corrupted=(), mets=False):
+        if mets:
+            # larger than what is read to identify the image while processing the METS file,
+            # so that the corruption is only detected when the image is saved
+            image = BytesIO()
+            Image.frombytes("L", (128, 128), os.urandom(128 * 128)).save(image, "png")
+            image = image.getvalue()
+        else:
+            with open(os.path.join(os.path.dirname(__file__), "mocks", "test.png"), "rb") as fh:
+                image = fh.read()
+        buff = BytesIO()
+        with ZipFile(buff, "w", compression=ZIP_STORED) as archive:
+            for name in ("page1.png", "page2.png", "page3.png"):
+                archive.writestr(name, image)
+            if mets:
+                archive.writestr("mets.xml", METS_ARCHIVE)
+            infos = archive.infolist()
+        data = bytearray(buff.getvalue())
+        for info in infos:
+            if info.filename in corrupted:
+                # flip a byte in the middle of the member's data, the central directory is still valid
+                offset = info.header_offset + 30 + len(info.filename) + len(info.extra) + info.file_size // 2
+                data[offset] ^= 0xFF
+        return ContentFile(bytes(data), name="images.zip")
+
+    def test_parse(self):
+        parser = ZipParser(self.document, self.make_archive(), self.report)
+        parser.validate()
+        self.assertEqual(parser.total, 3)
+        list(parser.parse(user=self.user))
+
+        self.assertListEqual(list(self.document.parts.values_list("original_filename", flat=True)), [
+            "page1.png", "page2.png", "page3.png",
+        ])
+        part = self.document.parts.first()
+        self.assertEqual(part.image_file_size, part.image.size)
+        self.assertEqual(part.source, "zip//images.zip/page1.png")
+
+    def test_parse_resume(self):
+        parser = ZipParser(self.document, self.make_archive(), self.report)
+        list(parser.parse(start_at=2, user=self.user))
+        self.assertListEqual(list(self.document.parts.values_list("original_filename", flat=True)), ["page3.png"])
+
+    def test_parse_corrupted_member(self):
+        parser = ZipParser(self.document, self.make_archive(corrupted=["page2.png"]), self.report)
+        # the CRCs are only checked during the extraction
+        parser.validate()
+        list(parser.parse(user=self.user))
+
+        self.assertListEqual(list(self.document.parts.values_list("original_filename", flat=True)), [
+            "page1.png", "page3.png",
+        ])
+        self.assertIn("page2.png", self.report.messages)
+        self.assertFalse(default_storage.exists(f"documents/{self.document.pk}/page2.png"))
+
+    def test_parse_corrupted_mets_member(self):
+        parser = METSZipParser(self.document, self.make_archive(corrupted=["page2.png"], mets=True), self.report)
+        list(parser.parse(user=self.user))
+
+        self.assertListEqual(list(self.document.parts.values_list("original_filename", flat=True)), [
+            "page1.png", "page3.png",
+        ])
+        self.assertIn("page2.png: Bad CRC-32", self.report.messages)
+        self.assertFalse(default_storage.exists(f"documents/{self.document.pk}/page2.png"))
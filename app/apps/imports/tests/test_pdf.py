@@ -0,0 +1,39 @@
+import os
+import tempfile
+from io import BytesIO
+
+from django.test import SimpleTestCase, override_settings
+from PIL import Image
+
+from imports.pdf import PDF_IMPORT_DPI, rasterize
+
+
+class RasterizeTestCase(SimpleTestCase):
+    # one width per page, in points, to tell them apart once rendered
+    WIDTHS = [300, 100, 400, 200, 250]
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        pages = [Image.new('RGB', (width, 100), color=(255, 255, 255)) for width in self.WIDTHS]
+        pages[0].save(self.path, format='PDF', resolution=72, save_all=True, append_images=pages[1:])
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_rasterize(self):
+        for processes in [0, 2]:
+            with self.subTest(processes=processes), override_settings(PDF_IMPORT_PROCESSES=processes):
+                results = list(rasterize(self.path, range(len(self.WIDTHS))))
+                self.assertEqual(len(results), len(self.WIDTHS))
+                for (png, error), width in zip(results, self.WIDTHS):
+                    self.assertIsNone(error)
+                    with Image.open(BytesIO(png)) as im:
+                        self.assertAlmostEqual(im.width, width * PDF_IMPORT_DPI / 72, delta=1)
+
+    def test_rasterize_error(self):
+        # a missing page is reported without stopping the others
+        with override_settings(PDF_IMPORT_PROCESSES=2):
+            results = list(rasterize(self.path, [0, len(self.WIDTHS), 1]))
+        self.assertEqual([png is None for png, error in results], [False, True, False])
+        self.assertIsNotNone(results[1][1])
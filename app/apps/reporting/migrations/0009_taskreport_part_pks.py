@@ -0,0 +1,19 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reporting', '0008_taskgroup_taskreport_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskreport',
+            name='part_pks',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.PositiveIntegerField(), blank=True, default=list, size=None),
+        ),
+    ]
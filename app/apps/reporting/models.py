@@ -2,7 +2,9 @@ from datetime import datetime, timezone
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.fields import ArrayField
 from django.db import models
+from django.db.models import F, Func, Value
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 
@@ -10,6 +12,9 @@ from escriptorium.celery import app
 
 User = get_user_model()
 
+# tasks processing a chunk of parts, they check their report before each part instead of being terminated
+CHUNKED_TASKS = ["core.tasks.segment_parts", "core.tasks.transcribe_parts"]
+
 
 class TaskGroup(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -55,6 +60,9 @@ class TaskReport(models.Model):
     # shared_task method name
     method = models.CharField(max_length=512, blank=True, null=True)
 
+    # parts of a chunked task that are still to be processed, a single part is canceled by removing it
+    part_pks = ArrayField(models.PositiveIntegerField(), blank=True, default=list)
+
     cpu_cost = models.FloatField(blank=True, null=True)
     gpu_cost = models.FloatField(blank=True, null=True)
 
@@ -93,7 +101,8 @@ class TaskReport(models.Model):
             canceled_by = f"user {username}"
         self.append(f"Canceled by {canceled_by}")
 
-        app.control.revoke(self.task_id, terminate=True)
+        # a running chunked task stops by itself before its next part
+        app.control.revoke(self.task_id, terminate=self.method not in CHUNKED_TASKS)
         self.save()
 
     def error(self, message):
@@ -128,3 +137,10 @@ class TaskReport(models.Model):
 
 
 TASK_FINAL_STATES = [TaskReport.WORKFLOW_STATE_ERROR, TaskReport.WORKFLOW_STATE_DONE, TaskReport.WORKFLOW_STATE_CANCELED]
+
+
+def remove_report_part(reports, part_pk):
+    """
+    Removes a part from the parts still to be processed by a queryset of chunked task reports.
+    """
+    return reports.update(part_pks=Func(F("part_pks"), Value(part_pk), function="array_remove"))
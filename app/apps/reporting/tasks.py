@@ -11,6 +11,12 @@ from users.consumers import send_event
 
 logger = logging.getLogger(__name__)
 
+# chunked tasks are reported to the client as their per part counterpart
+CLIENT_PROCESS_NAME_MAP = {
+    'segment_parts': 'segment',
+    'transcribe_parts': 'transcribe',
+}
+
 
 def update_client_state(task_kwargs, task_name, status, task_id=None, data=None):
     part_pks = []
@@ -20,12 +26,14 @@ def update_client_state(task_kwargs, task_name, status, task_id=None, data=None)
         part_pks = task_kwargs["part_pks"]
 
     DocumentPart = apps.get_model('core', 'DocumentPart')
+    process = task_name.split('.')[-1]
+    process = CLIENT_PROCESS_NAME_MAP.get(process, process)
 
     for part_pk in part_pks:
         part = DocumentPart.objects.get(pk=part_pk)
         send_event('document', part.document.pk, "part:workflow", {
             "id": part.pk,
-            "process": task_name.split('.')[-1],
+            "process": process,
             "status": status,
             "task_id": task_id,
             "data": data or {}
@@ -103,6 +111,8 @@ def create_task_reporting(sender, body, **kwargs):
 
     # TODO: Define an explicit "report_label" kwarg on all tasks
     default_report_label = f"Report for celery task {task_id} of type {sender}"
+    from reporting.models import CHUNKED_TASKS
+
     TaskReport.objects.create(
         user=user,
         group=task_group,
@@ -111,7 +121,8 @@ def create_task_reporting(sender, body, **kwargs):
         document_part=part,
         ocr_model=model,
         task_id=task_id,
-        method=sender
+        method=sender,
+        part_pks=task_kwargs.get("part_pks", []) if sender in CHUNKED_TASKS else []
     )
 
 
@@ -131,8 +142,11 @@ def start_task_reporting(task_id, task, *args, **kwargs):
 
     report.start()
 
-    # Update the frontend display consequently
-    update_client_state(kwargs.get("kwargs", {}), task.name, "ongoing", task_id=task_id)
+    # Update the frontend display consequently, chunked tasks send the state of each part themselves
+    from reporting.models import CHUNKED_TASKS
+
+    if task.name not in CHUNKED_TASKS:
+        update_client_state(kwargs.get("kwargs", {}), task.name, "ongoing", task_id=task_id)
 
 
 @task_postrun.connect
@@ -150,13 +164,18 @@ def end_task_reporting(task_id, task, *args, **kwargs):
 
     # Checking if the report wasn't already ended by tasks like "document_export" or "document_import"
     # or canceled by the Document.cancel_tasks API endpoint
-    from reporting.models import TASK_FINAL_STATES
+    from reporting.models import CHUNKED_TASKS, TASK_FINAL_STATES
 
+    chunked = task.name in CHUNKED_TASKS
     if report.workflow_state not in TASK_FINAL_STATES:
-        if kwargs.get("state") == states.SUCCESS:
-            report.end()
+        retval = kwargs.get("retval")
+        if kwargs.get("state") != states.SUCCESS:
+            report.error(str(retval))
+        elif chunked and retval and retval.get("error"):
+            # chunked tasks return the outcome of each of their parts
+            report.error("Failed to process the parts {pks}.".format(pks=", ".join(map(str, retval["error"]))))
         else:
-            report.error(str(kwargs.get("retval")))
+            report.end()
 
     # Update the frontend display consequently
     client_status_mapping = {
@@ -164,8 +183,12 @@ def end_task_reporting(task_id, task, *args, **kwargs):
         TaskReport.WORKFLOW_STATE_DONE: 'done'
     }
 
+    task_kwargs = kwargs.get("kwargs", {})
+    if chunked:
+        # the processed parts were already updated by the task, don't overwrite their state
+        task_kwargs = {"part_pks": report.part_pks}
     if report.workflow_state in client_status_mapping:
-        update_client_state(kwargs.get("kwargs", {}), task.name, client_status_mapping[report.workflow_state], task_id=task_id, data=kwargs.get('result'))
+        update_client_state(task_kwargs, task.name, client_status_mapping[report.workflow_state], task_id=task_id, data=kwargs.get('result'))
 
     report.calc_cpu_cost(os.cpu_count())
     # Listing tasks parametrized to run on 'gpu' Celery queue
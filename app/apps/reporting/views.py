@@ -122,12 +122,6 @@ class QuotasLeaderboard(LoginRequiredMixin, TemplateView):
                 last_day_runtime=Sum(runtime, filter=filter_last_day)
             ).order_by(F('total_runtime').desc(nulls_last=True))[offset:offset + self.paginate_by]
         )
-        disk_usages_left = dict(qs.values('id').annotate(disk_usage=Sum('ocrmodel__file_size')).values_list('id', 'disk_usage'))
-        disk_usages_right = dict(qs.values('id').annotate(disk_usage=Sum('document__parts__image_file_size')).values_list('id', 'disk_usage'))
-
-        for user in results:
-            user.disk_usage = (disk_usages_left[user.id] or 0) + (disk_usages_right[user.id] or 0)
-
         # Pagination
         paginator = CustomPaginator(results, self.paginate_by, total=qs.count())
 
@@ -6,7 +6,12 @@ from django.core.management.base import BaseCommand
 from django.utils.translation import gettext as _
 
 from escriptorium.utils import send_email
-from users.models import MEGABYTES_TO_BYTES, QuotaEvent, User
+from users.models import (
+    MEGABYTES_TO_BYTES,
+    QuotaEvent,
+    User,
+    reconcile_disk_usage,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -19,15 +24,19 @@ class Command(BaseCommand):
             logger.info('Quotas are disabled on this instance, no need to run this command')
             return
 
+        # fix the disk usage counters drifting from the actual sizes of the files, e.g. after bulk updates
+        reconcile_disk_usage(User.objects.all())
+
         for user in User.objects.all():
-            has_disk_storage = user.has_free_disk_storage()
+            disk_storage_limit = user.disk_storage_limit()
+            has_disk_storage = disk_storage_limit is None or disk_storage_limit > user.disk_usage
             has_cpu_minutes = user.has_free_cpu_minutes()
             has_gpu_minutes = user.has_free_gpu_minutes()
 
             if has_disk_storage and has_cpu_minutes and has_gpu_minutes:
                 continue
 
-            disk_storage_usage = user.calc_disk_usage()
+            disk_storage_usage = user.disk_usage
             cpu_minutes_usage = user.calc_cpu_usage()
             gpu_minutes_usage = user.calc_gpu_usage()
             events = QuotaEvent.objects.filter(
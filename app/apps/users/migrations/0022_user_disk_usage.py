@@ -0,0 +1,42 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def forward(apps, se):
+    User = apps.get_model('users', 'User')
+    OcrModel = apps.get_model('core', 'OcrModel')
+    DocumentPart = apps.get_model('core', 'DocumentPart')
+
+    models_size = (OcrModel.objects.filter(owner=OuterRef('pk')).order_by()
+                   .values('owner').annotate(size=Sum('file_size')).values('size'))
+    images_size = (DocumentPart.objects.filter(document__owner=OuterRef('pk')).order_by()
+                   .values('document__owner').annotate(size=Sum('image_file_size')).values('size'))
+    User.objects.update(disk_usage=(
+        Coalesce(Subquery(models_size), 0, output_field=models.BigIntegerField())
+        + Coalesce(Subquery(images_size), 0, output_field=models.BigIntegerField())
+    ))
+
+
+def backward(apps, se):
+    # no need to do anything
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0073_remove_documentpart_bw_backend_and_more'),
+        ('users', '0021_alter_user_legacy_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='disk_usage',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(forward, backward),
+    ]
@@ -3,10 +3,12 @@ import os
 import uuid
 from datetime import date, datetime, timedelta
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, Group
 from django.db import models
-from django.db.models import Sum
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.utils.translation import gettext as _
 from rest_framework.authtoken.models import Token
@@ -18,6 +20,22 @@ logger = logging.getLogger(__name__)
 MEGABYTES_TO_BYTES = 1048576
 
 
+class SQLCounterField(models.BigIntegerField):
+    """
+    A counter only ever changed in SQL, with F() expressions. Updating an instance leaves the
+    stored value as is instead of writing back the one it was loaded with, which may be stale.
+    """
+    def pre_save(self, model_instance, add):
+        if add:
+            return super().pre_save(model_instance, add)
+        return F(self.attname)
+
+    def deconstruct(self):
+        # same column as a BigIntegerField, nothing for the migrations to alter
+        name, path, args, kwargs = super().deconstruct()
+        return name, 'django.db.models.BigIntegerField', args, kwargs
+
+
 class User(AbstractUser):
     email = models.EmailField(
         verbose_name=_('email address'),
@@ -37,6 +55,9 @@ class User(AbstractUser):
     quota_cpu = models.PositiveIntegerField(null=True, blank=True)
     # quota_gpu is to be defined in GPU-min (spread over a week)
     quota_gpu = models.PositiveIntegerField(null=True, blank=True)
+    # disk_usage is in bytes, it is maintained when images and models are saved or deleted
+    # and reconciled with their actual sizes by the check_quotas command
+    disk_usage = SQLCounterField(default=0, editable=False)
 
     class Meta:
         permissions = (('can_invite', 'Can invite users'),)
@@ -59,9 +80,8 @@ class User(AbstractUser):
         return store_path
 
     def calc_disk_usage(self):
-        models_size = self.ocrmodel_set.aggregate(Sum('file_size'))['file_size__sum'] or 0
-        images_size = self.document_set.aggregate(Sum('parts__image_file_size'))['parts__image_file_size__sum'] or 0
-        return models_size + images_size
+        self.refresh_from_db(fields=['disk_usage'])
+        return self.disk_usage
 
     def disk_storage_limit(self):
         if self.quota_disk_storage is not None:
@@ -268,6 +288,30 @@ class GroupOwner(models.Model):
         return str(self.group)
 
 
+def update_disk_usage(users, delta):
+    """
+    Adds delta bytes to the disk usage of a queryset of users, in a single query.
+    """
+    return users.update(disk_usage=F('disk_usage') + delta)
+
+
+def reconcile_disk_usage(users):
+    """
+    Recomputes the disk usage of a queryset of users from the sizes of their images and models,
+    in a single query.
+    """
+    OcrModel = apps.get_model('core', 'OcrModel')
+    DocumentPart = apps.get_model('core', 'DocumentPart')
+    models_size = (OcrModel.objects.filter(owner=OuterRef('pk')).order_by()
+                   .values('owner').annotate(size=Sum('file_size')).values('size'))
+    images_size = (DocumentPart.objects.filter(document__owner=OuterRef('pk')).order_by()
+                   .values('document__owner').annotate(size=Sum('image_file_size')).values('size'))
+    return users.update(disk_usage=(
+        Coalesce(Subquery(models_size), 0, output_field=models.BigIntegerField())
+        + Coalesce(Subquery(images_size), 0, output_field=models.BigIntegerField())
+    ))
+
+
 class QuotaEvent(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='quota_events')
     # reached_disk_storage is to be defined in Mb
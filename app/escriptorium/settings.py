@@ -220,6 +220,9 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACKS_LATE = True
 
+# number of parts handled by a single task when segmenting or transcribing in bulk mode
+BULK_PROCESS_CHUNK_SIZE = int(os.getenv('BULK_PROCESS_CHUNK_SIZE', 20))
+
 # time in seconds a user has to wait after a task is started before being able to recover
 TASK_RECOVER_DELAY = 60 * 60 * 24  # 1 day
 
@@ -398,9 +401,22 @@ VERSION_DATE = os.getenv('VERSION_DATE', '<development>')
 KRAKEN_VERSION = 'Kraken version ' + importlib.metadata.version('kraken')
 
 IIIF_IMPORT_QUALITY = 'full'
+# Number of images of a IIIF manifest downloaded concurrently, and minimum delay in seconds between
+# two requests to the same image server
+IIIF_IMPORT_WORKERS = int(os.getenv('IIIF_IMPORT_WORKERS', 4))
+IIIF_IMPORT_HOST_DELAY = float(os.getenv('IIIF_IMPORT_HOST_DELAY', 0.1))
+# Width in pixels to download IIIF images at, the smallest size at least that wide advertised by the
+# image service is used, 0 always fetches the full image
+IIIF_IMPORT_TARGET_WIDTH = int(os.getenv('IIIF_IMPORT_TARGET_WIDTH', 0))
 
 KRAKEN_TRAINING_DEVICE = os.getenv('KRAKEN_TRAINING_DEVICE', 'cpu')
 KRAKEN_TRAINING_LOAD_THREADS = int(os.getenv('KRAKEN_TRAINING_LOAD_THREADS', 0))
+# Size in Mb of the per worker process cache of loaded kraken models, 0 disables it
+KRAKEN_MODEL_CACHE_SIZE = int(os.getenv('KRAKEN_MODEL_CACHE_SIZE', 512))
+# Compiled recognition training datasets are reused as long as the ground truth doesn't change,
+# size in Mb of the cache on disk, 0 disables it
+KRAKEN_DATASET_CACHE_DIR = os.getenv('KRAKEN_DATASET_CACHE_DIR', os.path.join(BASE_DIR, 'training_datasets'))
+KRAKEN_DATASET_CACHE_SIZE = int(os.getenv('KRAKEN_DATASET_CACHE_SIZE', 10240))
 
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
@@ -451,8 +467,23 @@ EXPORT_OPENITI_MARKDOWN_ENABLED = os.getenv('EXPORT_OPENITI_MARKDOWN', "False").
 # Boolean used to enable the OpenITI TEI XML export mode
 EXPORT_TEI_XML_ENABLED = os.getenv('EXPORT_TEI_XML', "False").lower() not in ("false", "0")
 
+# Number of processes rendering the parts of a document export in parallel, 0 renders them in the task
+EXPORT_PROCESSES = int(os.getenv('EXPORT_PROCESSES', 0))
+# Number of processes rendering the pages of a PDF import in parallel, 0 renders them in the task
+PDF_IMPORT_PROCESSES = int(os.getenv('PDF_IMPORT_PROCESSES', 0))
+# Size in Mb of the cache of rendered PAGE/ALTO pages reused by later exports, disabled (0) by default
+EXPORT_CACHE_SIZE = int(os.getenv('EXPORT_CACHE_SIZE', 0))
+# Exports of at most that many lines are streamed in the response instead of going through a task,
+# 0 always uses the task
+EXPORT_STREAMING_MAX_LINES = int(os.getenv('EXPORT_STREAMING_MAX_LINES', 5000))
+
 # Boolean used to enable text alignment with Passim
 TEXT_ALIGNMENT_ENABLED = os.getenv('TEXT_ALIGNMENT', "False").lower() not in ("false", "0")
+# Unix socket of the alignment service started by the jvm workers, which keeps a Spark session
+# warm between alignments, unset runs seriatim from the command line for every alignment
+ALIGNMENT_SERVICE_SOCKET = os.getenv('ALIGNMENT_SERVICE_SOCKET')
+# Module run by the alignment service for every job
+PASSIM_SERIATIM_MODULE = os.getenv('PASSIM_SERIATIM_MODULE', 'passim.seriatim')
 
 # Sentry support
 SENTRY_DSN = os.getenv('SENTRY_DSN')
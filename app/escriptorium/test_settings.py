@@ -33,6 +33,9 @@ CACHES = {
 }
 
 KRAKEN_TRAINING_LOAD_THREADS = 0
+KRAKEN_MODEL_CACHE_SIZE = 0
+KRAKEN_DATASET_CACHE_SIZE = 0
+EXPORT_CACHE_SIZE = 0
 
 # Disables easy-thumbnail spamming
 THUMBNAIL_OPTIMIZE_COMMAND = {}